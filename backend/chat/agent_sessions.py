@@ -0,0 +1,117 @@
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .bedrock import BedrockAgent
+from .instrumentation import AGENT_SESSION_CHARS, AGENT_SESSION_TURNS, AGENT_SESSIONS, AGENT_TURN_SECONDS
+from .models import Conversation
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ('session_id', 'agent_session', 'agent_session_turns', 'agent_session_chars', 'agent_session_used_at')
+
+
+def session_config() -> dict:
+    return getattr(settings, 'CHAT_AGENT_SESSIONS', {})
+
+
+class AgentSession:
+    """The agent session a chat turn runs in, as read when the turn started"""
+
+    def __init__(self, conversation_id, session_id: str, turns: int = 0, chars: int = 0):
+        self.conversation_id = conversation_id
+        self.session_id = session_id
+        self.turns = turns
+        self.chars = chars
+
+
+def rotation_reason(state: dict, now=None):
+    """Why the conversation needs a new agent session, or None to keep the current one"""
+    config = session_config()
+    now = now or timezone.now()
+    if not state['agent_session']:
+        return 'new'
+    used_at = state['agent_session_used_at']
+    if used_at is not None and now - used_at > timedelta(seconds=config.get('IDLE_SECONDS', 600)):
+        return 'idle'
+    if (state['agent_session_turns'] >= config.get('MAX_TURNS', 40)
+            or state['agent_session_chars'] >= config.get('MAX_CHARS', 100000)):
+        return 'size'
+    return None
+
+
+def _end_in_background(session_id: str):
+    def run():
+        try:
+            BedrockAgent().end_session(session_id)
+        except Exception:
+            logger.warning("Ending agent session %s failed", session_id, exc_info=True)
+    threading.Thread(target=run, name='agent-session-end', daemon=True).start()
+
+
+def checkout_session(conversation_id):
+    """The agent session for this conversation's next turn, rotating it if it went idle or grew too large.
+
+    Returns None if the conversation doesn't exist.
+    """
+    state = Conversation.objects.filter(pk=conversation_id).values(*_FIELDS).first()
+    if state is None:
+        return None
+    now = timezone.now()
+    reason = rotation_reason(state, now)
+    if reason is None:
+        return AgentSession(conversation_id, state['agent_session'],
+                            state['agent_session_turns'], state['agent_session_chars'])
+
+    # The conversation's own id names its first session; later ones get a suffix
+    if state['agent_session_used_at'] is None:
+        session_id = state['session_id']
+    else:
+        session_id = f"{state['session_id'][:90]}-{uuid.uuid4().hex[:8]}"
+    rotated = Conversation.objects.filter(pk=conversation_id, agent_session=state['agent_session']).update(
+        agent_session=session_id, agent_session_turns=0, agent_session_chars=0, agent_session_used_at=now
+    )
+    if not rotated:
+        # A concurrent turn rotated first; join its session
+        state = Conversation.objects.filter(pk=conversation_id).values(*_FIELDS).first()
+        return AgentSession(conversation_id, state['agent_session'],
+                            state['agent_session_turns'], state['agent_session_chars'])
+
+    AGENT_SESSIONS.inc(reason=reason)
+    # Idle sessions have already expired upstream; oversized ones are still holding context
+    if reason == 'size':
+        _end_in_background(state['agent_session'])
+    return AgentSession(conversation_id, session_id)
+
+
+def record_turn(session: AgentSession, chars: int, seconds: float):
+    """Account one finished turn (prompt plus reply characters) against its session"""
+    Conversation.objects.filter(pk=session.conversation_id, agent_session=session.session_id).update(
+        agent_session_turns=F('agent_session_turns') + 1,
+        agent_session_chars=F('agent_session_chars') + chars,
+        agent_session_used_at=timezone.now(),
+    )
+    AGENT_SESSION_TURNS.observe(session.turns + 1)
+    AGENT_SESSION_CHARS.observe(session.chars + chars)
+    AGENT_TURN_SECONDS.observe(seconds, session='new' if session.turns == 0 else 'reused')
+
+
+def end_session(conversation_id) -> bool:
+    """Close the conversation's agent session now, e.g. when the user finishes the conversation.
+
+    The next turn starts a new session at once; the upstream one is ended in
+    the background, so the caller never waits on the agent for it.
+    """
+    state = Conversation.objects.filter(pk=conversation_id).values('agent_session').first()
+    if not state or not state['agent_session']:
+        return False
+    ended = Conversation.objects.filter(pk=conversation_id, agent_session=state['agent_session']).update(
+        agent_session='', agent_session_turns=0, agent_session_chars=0
+    )
+    if ended:
+        _end_in_background(state['agent_session'])
+        AGENT_SESSIONS.inc(reason='ended')
+    return bool(ended)
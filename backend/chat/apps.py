@@ -5,6 +5,26 @@ class ChatConfig(AppConfig):
     name = 'chat'
 
     def ready(self):
-        from .views import speech_to_text_utils
-        # This will initialize the Whisper model
-        speech_to_text_utils
\ No newline at end of file
+        # Deleted conversations leave tombstones for sidebar delta syncs
+        from django.db.models.signals import post_delete
+        from .models import Conversation
+        from .sync import record_tombstone
+        post_delete.connect(record_tombstone, sender=Conversation, dispatch_uid='chat.sync.record_tombstone')
+
+        # Whisper loads lazily on the first transcription unless asked to load early
+        import os
+        from .stt import get_model, stt_config, warm_up_in_background
+        config = stt_config()
+        if config.get('BACKEND', 'local') == 'local' and config.get('PRELOAD'):
+            # Before gunicorn --preload forks, so workers share the weights copy-on-write.
+            # No inference until after the fork: torch's thread pools don't survive one.
+            get_model()
+            if config.get('WARM_UP'):
+                os.register_at_fork(after_in_child=warm_up_in_background)
+        elif config.get('WARM_UP'):
+            warm_up_in_background()
+
+        # Optionally build the shared Bedrock clients before the first request
+        from .bedrock import env_flag, get_client_registry
+        if env_flag('BEDROCK_WARM_UP'):
+            get_client_registry().warm_up()
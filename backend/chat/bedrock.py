@@ -1,33 +1,149 @@
 import boto3
 import json
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
 from dotenv import load_dotenv
+import logging
 import re
+import threading
+import time
+import uuid
+from .instrumentation import BEDROCK_DURATION, BEDROCK_ERRORS, BEDROCK_FIRST_CHUNK, registry as metrics
+from .scheduler import BACKGROUND, INTERACTIVE, THROTTLE_CODES, UpstreamRejected, get_upstream_scheduler
 
 load_dotenv()
 
-class BedrockAgent:
-    def __init__(self):
-        self.session = boto3.Session(
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION')
-        )
-        
-        self.bedrock_runtime = self.session.client(
-            service_name='bedrock-runtime',
-            region_name=os.getenv('AWS_REGION')
-        )
-        
-        self.bedrock_agent_runtime = self.session.client(
-            service_name='bedrock-agent-runtime',
-            region_name=os.getenv('AWS_REGION')
+logger = logging.getLogger(__name__)
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+class BedrockClientRegistry:
+    """Process-wide, thread-safe cache of boto3 clients.
+
+    boto3 clients are thread-safe, so one client per service is shared by every
+    request. That keeps its urllib3 connection pool (and TLS sessions) alive
+    between chat turns instead of rebuilding a Session on every call.
+    """
+
+    SERVICES = ('bedrock-runtime', 'bedrock-agent-runtime')
+
+    def __init__(self, region_name=None, endpoint_url=None, max_pool_connections=None,
+                 connect_timeout=None, read_timeout=None, max_attempts=None,
+                 retry_mode=None, tcp_keepalive=None):
+        self.region_name = region_name or os.getenv('AWS_REGION')
+        self.endpoint_url = endpoint_url or os.getenv('BEDROCK_ENDPOINT_URL') or None
+        self.max_pool_connections = max_pool_connections or int(os.getenv('BEDROCK_MAX_POOL_CONNECTIONS', 256))
+        self.config = Config(
+            region_name=self.region_name,
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=connect_timeout or float(os.getenv('BEDROCK_CONNECT_TIMEOUT', 5)),
+            read_timeout=read_timeout or float(os.getenv('BEDROCK_READ_TIMEOUT', 120)),
+            retries={
+                'max_attempts': max_attempts or int(os.getenv('BEDROCK_MAX_ATTEMPTS', 3)),
+                'mode': retry_mode or os.getenv('BEDROCK_RETRY_MODE', 'adaptive'),
+            },
+            tcp_keepalive=env_flag('BEDROCK_TCP_KEEPALIVE', True) if tcp_keepalive is None else tcp_keepalive,
+            # Local stub endpoints don't resolve the agent host prefix
+            inject_host_prefix=self.endpoint_url is None,
         )
-        
+        self._lock = threading.Lock()
+        self._session = None
+        self._clients = {}
+        self._in_flight = 0
+        self._stats = {'clients_created': 0, 'calls': 0, 'errors': 0, 'peak_in_flight': 0}
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = boto3.Session(
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                region_name=self.region_name
+            )
+        return self._session
+
+    def client(self, service_name: str):
+        client = self._clients.get(service_name)
+        if client is not None:
+            return client
+        with self._lock:
+            # Session.client() is not thread-safe, so creation stays under the lock
+            if service_name not in self._clients:
+                self._clients[service_name] = self._get_session().client(
+                    service_name=service_name,
+                    region_name=self.region_name,
+                    endpoint_url=self.endpoint_url,
+                    config=self.config
+                )
+                self._stats['clients_created'] += 1
+            return self._clients[service_name]
+
+    def warm_up(self):
+        """Build every client up front so the first chat turn doesn't pay for it"""
+        for service_name in self.SERVICES:
+            self.client(service_name)
+
+    def acquire(self):
+        with self._lock:
+            self._in_flight += 1
+            self._stats['calls'] += 1
+            self._stats['peak_in_flight'] = max(self._stats['peak_in_flight'], self._in_flight)
+
+    def release(self, failed: bool = False):
+        with self._lock:
+            self._in_flight -= 1
+            if failed:
+                self._stats['errors'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                'in_flight': self._in_flight,
+                'max_pool_connections': self.max_pool_connections,
+                'pool_utilization': self._in_flight / self.max_pool_connections,
+            }
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_client_registry() -> BedrockClientRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = BedrockClientRegistry()
+                metrics.register_stats('bedrock_clients', _registry.stats)
+    return _registry
+
+def configure_client_registry(**kwargs) -> BedrockClientRegistry:
+    """Replace the shared registry, e.g. to point it at a local stub endpoint"""
+    global _registry
+    with _registry_lock:
+        _registry = BedrockClientRegistry(**kwargs)
+        metrics.register_stats('bedrock_clients', _registry.stats)
+    return _registry
+
+class BedrockAgent:
+    """Per-call facade over the shared client registry; cheap to instantiate"""
+
+    def __init__(self, registry: BedrockClientRegistry = None):
+        self.registry = registry or get_client_registry()
         self.agent_id = os.getenv('BEDROCK_AGENT_ID')
         self.agent_alias_id = os.getenv('BEDROCK_AGENT_ALIAS_ID')
 
+    @property
+    def bedrock_runtime(self):
+        return self.registry.client('bedrock-runtime')
+
+    @property
+    def bedrock_agent_runtime(self):
+        return self.registry.client('bedrock-agent-runtime')
+
     def sanitize_session_id(self, email: str) -> str:
         """Convert email to valid session ID format"""
         if not email or email == 'guest':
@@ -35,48 +151,94 @@ class BedrockAgent:
         # Replace @ and any other invalid characters with '-'
         return re.sub(r'[^0-9a-zA-Z._:-]', '-', email)
 
-    def invoke_agent(self, message, session_id):
+    def invoke_agent(self, message, session_id, raise_errors: bool = False, end_session: bool = False,
+                     lane: str = INTERACTIVE):
+        # Waits for an upstream slot (raising UpstreamRejected on timeout); held until the stream is drained
+        with get_upstream_scheduler().slot(lane) as slot:
+            yield from self._invoke_agent(message, session_id, raise_errors, end_session, slot)
+
+    def _invoke_agent(self, message, session_id, raise_errors: bool, end_session: bool, slot: dict):
+        # The pooled connection is held until the event stream is drained
+        self.registry.acquire()
+        failed = False
+        abandoned = False
+        started = time.perf_counter()
+        first_chunk = True
         try:
             response = self.bedrock_agent_runtime.invoke_agent(
                 agentId=self.agent_id,
                 agentAliasId=self.agent_alias_id,
                 sessionId=self.sanitize_session_id(session_id),
-                inputText=message
+                inputText=message,
+                endSession=end_session
             )
-            
-            # First, collect the full response
-            event_stream = response.get('completion')
-            completion_text = ""
-            
-            for event in event_stream:
+
+            for event in response.get('completion'):
                 if 'chunk' in event:
-                    chunk_data = event['chunk'].get('bytes').decode('utf-8')
-                    completion_text += chunk_data
+                    if first_chunk:
+                        BEDROCK_FIRST_CHUNK.observe(time.perf_counter() - started)
+                        first_chunk = False
                     # Yield each chunk as it comes
-                    yield chunk_data
-            
+                    yield event['chunk'].get('bytes').decode('utf-8')
+
         except ClientError as error:
+            failed = True
+            code = error.response.get('Error', {}).get('Code', 'Unknown')
+            slot['throttled'] = code in THROTTLE_CODES
+            BEDROCK_ERRORS.inc(code=code)
+            if raise_errors:
+                raise
+            logger.warning("InvokeAgent failed: %s", error)
             yield f"Error: {str(error)}"
+        except Exception as error:
+            # Read timeouts, connection errors and the like are failures too, not successful calls
+            failed = True
+            BEDROCK_ERRORS.inc(code=type(error).__name__)
+            raise
+        except GeneratorExit:
+            # The consumer stopped reading: neither a failure nor a complete call
+            abandoned = True
+            raise
+        finally:
+            if not failed and not abandoned:
+                BEDROCK_DURATION.observe(time.perf_counter() - started)
+            self.registry.release(failed)
 
-    def generate_stream(self, prompt: str, user_email: str = None):
+    def end_session(self, session_id: str):
+        """Close an agent session so the service drops its server-side context"""
+        for _ in self.invoke_agent('', session_id, raise_errors=True, end_session=True, lane=BACKGROUND):
+            pass
+
+    def generate_stream(self, prompt: str, user_email: str = None, session_id: str = None):
         try:
-            # Use sanitized user_email as session ID
-            session_id = user_email if user_email and user_email != 'guest' else 'temp-session'
+            # Callers pass the conversation's agent session; the email-keyed fallback is shared by every thread
+            if session_id is None:
+                session_id = user_email if user_email and user_email != 'guest' else 'temp-session'
             for chunk in self.invoke_agent(prompt, session_id):
                 yield chunk
+        except UpstreamRejected:
+            # Overload isn't an agent error; let the view tell the client to retry
+            raise
         except Exception as e:
-            print(f"Error in generate_stream: {e}")
+            logger.exception("Error in generate_stream: %s", e)
             yield ""
 
-    def generate_response(self, prompt: str, user_email: str = None) -> str:
-        """Generate a single response without streaming"""
+    def generate_response(self, prompt: str, user_email: str = None, raise_errors: bool = False,
+                          session_id: str = None, lane: str = INTERACTIVE) -> str:
+        """Generate a single response without streaming.
+
+        Without a ``session_id`` each call gets a session of its own, so one-off
+        requests (profile extraction) never pile up context in a shared session.
+        """
         try:
-            # Use sanitized user_email as session ID
-            session_id = user_email if user_email and user_email != 'guest' else 'temp-session'
+            if session_id is None:
+                session_id = f'oneshot-{uuid.uuid4().hex}'
             full_response = ""
-            for chunk in self.invoke_agent(prompt, session_id):
+            for chunk in self.invoke_agent(prompt, session_id, raise_errors=raise_errors, lane=lane):
                 full_response += chunk
             return full_response
         except Exception as e:
-            print(f"Error generating response: {e}")
+            if raise_errors:
+                raise
+            logger.exception("Error generating response: %s", e)
             return ""
@@ -0,0 +1,184 @@
+import base64
+import json
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _encode_headers(headers: dict) -> bytes:
+    encoded = b''
+    for name, value in headers.items():
+        name_bytes = name.encode('utf-8')
+        value_bytes = value.encode('utf-8')
+        # Header value type 7 is a UTF-8 string
+        encoded += struct.pack('>B', len(name_bytes)) + name_bytes
+        encoded += struct.pack('>BH', 7, len(value_bytes)) + value_bytes
+    return encoded
+
+
+def encode_event(headers: dict, payload: bytes) -> bytes:
+    """Frame one message in the AWS event-stream binary format"""
+    header_bytes = _encode_headers(headers)
+    total_length = 12 + len(header_bytes) + len(payload) + 4
+    prelude = struct.pack('>II', total_length, len(header_bytes))
+    prelude += struct.pack('>I', zlib.crc32(prelude) & 0xffffffff)
+    message = prelude + header_bytes + payload
+    return message + struct.pack('>I', zlib.crc32(message) & 0xffffffff)
+
+
+def encode_chunk(text: str) -> bytes:
+    payload = json.dumps({'bytes': base64.b64encode(text.encode('utf-8')).decode('ascii')})
+    return encode_event({
+        ':event-type': 'chunk',
+        ':message-type': 'event',
+        ':content-type': 'application/json',
+    }, payload.encode('utf-8'))
+
+
+class StubBedrockServer:
+    """Local stand-in for the bedrock-agent-runtime InvokeAgent API.
+
+    Point a BedrockClientRegistry at ``endpoint_url`` to exercise the real
+    botocore client, connection pool and event-stream parser without AWS.
+    ``responder`` maps an input text to the list of chunks to stream back.
+    """
+
+    def __init__(self, chunks=None, responder=None, first_chunk_delay: float = 0.0,
+                 chunk_delay: float = 0.0, throttle=None):
+        self.chunks = chunks if chunks is not None else ['Hello', ' from', ' the', ' stub']
+        self.responder = responder
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        # Callable returning True when a request should be rejected with a 429
+        self.throttle = throttle
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Frames are small; don't let Nagle + delayed ACKs hold them back
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                session_id = self.path.rstrip('/').split('/')[-2]
+                request = json.loads(body or b'{}')
+                input_text = request.get('inputText', '')
+                with stub._lock:
+                    stub.requests.append({
+                        'session_id': session_id, 'input_text': input_text,
+                        'end_session': bool(request.get('endSession')),
+                    })
+
+                if stub.throttle and stub.throttle():
+                    payload = json.dumps({'message': 'Rate exceeded'}).encode('utf-8')
+                    self.send_response(429)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('x-amzn-ErrorType', 'ThrottlingException')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+
+                chunks = stub.responder(input_text) if stub.responder else stub.chunks
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+                self.send_header('x-amzn-bedrock-agent-content-type', 'application/json')
+                self.send_header('x-amz-bedrock-agent-session-id', session_id)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for index, chunk in enumerate(chunks):
+                        delay = stub.first_chunk_delay if index == 0 else stub.chunk_delay
+                        if delay:
+                            time.sleep(delay)
+                        frame = encode_chunk(chunk)
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(frame), frame))
+                        self.wfile.flush()
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        class Server(ThreadingHTTPServer):
+            # The default listen backlog of 5 drops connection bursts from load tests
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _serve_in_child(connection, kwargs):
+    stub = StubBedrockServer(**kwargs).start()
+    connection.send(stub.endpoint_url)
+    # Serve until the parent closes its end of the pipe
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    stub.stop()
+
+
+class StubBedrockProcess:
+    """StubBedrockServer in a child process, for load tests where the stub's
+    own threads would otherwise compete with the code under test for the GIL"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.endpoint_url = None
+        self._process = None
+        self._connection = None
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context('fork').Process(
+            target=_serve_in_child, args=(child, self.kwargs), daemon=True
+        )
+        self._process.start()
+        self._connection = parent
+        self.endpoint_url = parent.recv()
+        return self
+
+    def stop(self):
+        if self._process:
+            self._connection.close()
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
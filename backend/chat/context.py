@@ -0,0 +1,95 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .models import ProfileFact
+
+CONTEXT_HEADER = "Important information about this user:\n"
+
+# Categories the extraction prompt asks for, most useful first
+CATEGORY_PRIORITY = ['first name', 'goals', 'challenges', 'important life events', 'preferences']
+
+
+def _cache():
+    return caches[getattr(settings, 'USER_CONTEXT_CACHE', 'default')]
+
+
+def _email_key(user_email: str) -> str:
+    return hashlib.sha1(user_email.encode('utf-8')).hexdigest()
+
+
+def _version_key(user_email: str) -> str:
+    return f'user-context:version:{_email_key(user_email)}'
+
+
+def _new_version() -> int:
+    # Time-based so a version key evicted from the cache can't resurrect stale entries
+    return int(time.time() * 1000)
+
+
+def build_context(key_information: dict, max_chars: int = None) -> str:
+    """Render profile facts as prompt context, bounded to ``max_chars``.
+
+    Categories are ordered by usefulness and filled round-robin, newest item
+    first, so every category keeps a voice when the budget is tight.
+    """
+    if max_chars is None:
+        max_chars = getattr(settings, 'USER_CONTEXT_MAX_CHARS', 2000)
+    categories = [c for c in key_information if isinstance(key_information[c], list) and key_information[c]]
+    categories.sort(key=lambda c: CATEGORY_PRIORITY.index(c.lower()) if c.lower() in CATEGORY_PRIORITY
+                    else len(CATEGORY_PRIORITY))
+    if not categories:
+        return ""
+
+    remaining = {c: [str(item) for item in reversed(key_information[c])] for c in categories}
+    chosen = {c: [] for c in categories}
+    used = len(CONTEXT_HEADER)
+    while any(remaining.values()):
+        for category in categories:
+            if not remaining[category]:
+                continue
+            item = remaining[category].pop(0)
+            # A category's first item pays for its "Title: " prefix and newline
+            cost = len(item) + (len(category) + 3 if not chosen[category] else 2)
+            if used + cost > max_chars:
+                remaining[category] = []
+                continue
+            chosen[category].append(item)
+            used += cost
+
+    lines = [f"{c.title()}: {', '.join(items)}\n" for c, items in chosen.items() if items]
+    return CONTEXT_HEADER + "".join(lines) if lines else ""
+
+
+def load_key_information(user_email: str, limit: int = None) -> dict:
+    """The user's ``limit`` most recently seen facts by category, oldest first, in one indexed query"""
+    if limit is None:
+        limit = getattr(settings, 'USER_CONTEXT_MAX_FACTS', 200)
+    facts = ProfileFact.objects.filter(user_email=user_email).order_by(
+        '-last_seen', '-mentions', '-id'
+    ).values_list('category', 'item')[:limit]
+    key_information = {}
+    for category, item in reversed(facts):
+        key_information.setdefault(category, []).append(item)
+    return key_information
+
+
+def get_user_context(user_email: str) -> str:
+    """Cached profile context; a hit costs two cache lookups and no DB query"""
+    cache = _cache()
+    version = cache.get_or_set(_version_key(user_email), _new_version, timeout=None)
+    key = f'user-context:{_email_key(user_email)}:{version}'
+    context = cache.get(key)
+    if context is None:
+        context = build_context(load_key_information(user_email))
+        cache.set(key, context, timeout=getattr(settings, 'USER_CONTEXT_CACHE_TIMEOUT', 900))
+    return context
+
+
+def invalidate_user_context(user_email: str):
+    """Bump the profile version so the next lookup rebuilds the context"""
+    cache = _cache()
+    try:
+        cache.incr(_version_key(user_email))
+    except ValueError:
+        cache.set(_version_key(user_email), _new_version(), timeout=None)
@@ -0,0 +1,62 @@
+from collections import Counter
+from datetime import timedelta
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Feedback, FeedbackRollup
+
+
+def _add_to_rollup(counts: Counter):
+    """Add ``{(day, feedback_type, rating): n}`` to the rollup, one upsert per group"""
+    quote = connection.ops.quote_name
+    table = quote(FeedbackRollup._meta.db_table)
+    count = quote('count')
+    sql = (
+        f"INSERT INTO {table} ({quote('day')}, {quote('feedback_type')}, {quote('rating')}, {count}) "
+        f"VALUES (%s, %s, %s, %s) ON CONFLICT ({quote('day')}, {quote('feedback_type')}, {quote('rating')}) "
+        f"DO UPDATE SET {count} = {table}.{count} + excluded.{count}"
+    )
+    # Sorted, so concurrent batches lock the same rows in the same order
+    params = [(day.isoformat(), feedback_type, rating, n) for (day, feedback_type, rating), n in sorted(counts.items())]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def record_feedback(items) -> list:
+    """Save validated feedback items with one INSERT and fold them into the daily rollup"""
+    with transaction.atomic():
+        feedback = Feedback.objects.bulk_create([Feedback(**item) for item in items])
+        _add_to_rollup(Counter(
+            (timezone.localdate(item.created_at), item.feedback_type, item.rating) for item in feedback
+        ))
+    return feedback
+
+
+def _summarize(counts: dict) -> dict:
+    total = sum(counts.values())
+    return {
+        'count': total,
+        'average_rating': round(sum(rating * n for rating, n in counts.items()) / total, 2) if total else None,
+        'ratings': {str(rating): counts[rating] for rating in sorted(counts)},
+    }
+
+
+def feedback_summary(days: int, feedback_type: str = None) -> dict:
+    """Rating distributions per type per day for the last ``days`` days, read from the rollup alone"""
+    since = timezone.localdate() - timedelta(days=days - 1)
+    rows = FeedbackRollup.objects.filter(day__gte=since)
+    if feedback_type:
+        rows = rows.filter(feedback_type=feedback_type)
+
+    per_day = {}
+    totals = {}
+    for day, kind, rating, count in rows.order_by('day', 'feedback_type', 'rating').values_list(
+            'day', 'feedback_type', 'rating', 'count'):
+        per_day.setdefault((day, kind), {})[rating] = count
+        by_rating = totals.setdefault(kind, {})
+        by_rating[rating] = by_rating.get(rating, 0) + count
+    return {
+        'since': since.isoformat(),
+        'days': [{'date': day.isoformat(), 'feedback_type': kind, **_summarize(counts)}
+                 for (day, kind), counts in per_day.items()],
+        'totals': {kind: _summarize(counts) for kind, counts in totals.items()},
+    }
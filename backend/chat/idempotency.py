@@ -0,0 +1,215 @@
+import hashlib
+import json
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.response import Response
+from .instrumentation import IDEMPOTENT_REQUESTS, registry as metrics
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+def idempotency_config() -> dict:
+    return getattr(settings, 'CHAT_IDEMPOTENCY', {})
+
+
+class MemoryIdempotencyStore:
+    """Idempotency records kept in this process.
+
+    ``claim`` atomically either records a pending request under the key (and
+    returns None: the caller runs it) or returns the record already there.
+    Pending records expire after ``lock_ttl`` so a crashed request can't hold
+    its key forever; completed ones after the ``ttl`` given to ``complete``.
+    """
+
+    def __init__(self, max_keys: int = 100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._records = {}  # key -> (expires, record), oldest first
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _get(self, key: str):
+        found = self._records.get(key)
+        if found is None or found[0] <= self.clock():
+            return None
+        return found[1]
+
+    def _set(self, key: str, record: dict, ttl: float):
+        now = self.clock()
+        self._records.pop(key, None)
+        self._records[key] = (now + ttl, record)
+        # Records are (re)inserted last, so the oldest ones are trimmed first
+        while len(self._records) > self.max_keys or next(iter(self._records.values()))[0] <= now:
+            del self._records[next(iter(self._records))]
+
+    def claim(self, key: str, record: dict, lock_ttl: float):
+        with self._lock:
+            existing = self._get(key)
+            if existing is not None:
+                return existing
+            self._set(key, record, lock_ttl)
+            return None
+
+    def complete(self, key: str, record: dict, ttl: float):
+        with self._lock:
+            self._set(key, record, ttl)
+            self._changed.notify_all()
+
+    def release(self, key: str):
+        with self._lock:
+            self._records.pop(key, None)
+            self._changed.notify_all()
+
+    def wait(self, key: str, timeout: float):
+        """The key's record once it is no longer pending (or None if released), or the pending one on timeout"""
+        with self._lock:
+            deadline = self.clock() + timeout
+            while True:
+                record = self._get(key)
+                remaining = deadline - self.clock()
+                if record is None or record['state'] != PENDING or remaining <= 0:
+                    return record
+                self._changed.wait(remaining)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'keys': len(self._records)}
+
+
+class CacheIdempotencyStore:
+    """Idempotency records in a Django cache, shared by every worker using it.
+
+    Claims rely on ``cache.add`` being atomic, which holds for Redis and
+    Memcached. Waiters poll every ``poll_seconds``.
+    """
+
+    def __init__(self, cache, poll_seconds: float = 0.05):
+        self.cache = cache
+        self.poll_seconds = poll_seconds
+
+    def claim(self, key: str, record: dict, lock_ttl: float):
+        if self.cache.add(key, record, lock_ttl):
+            return None
+        # Expired or released between the add and the get: let the caller try again as a duplicate
+        return self.cache.get(key) or record
+
+    def complete(self, key: str, record: dict, ttl: float):
+        self.cache.set(key, record, ttl)
+
+    def release(self, key: str):
+        self.cache.delete(key)
+
+    def wait(self, key: str, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.cache.get(key)
+            if record is None or record['state'] != PENDING or time.monotonic() >= deadline:
+                return record
+            time.sleep(self.poll_seconds)
+
+    def stats(self) -> dict:
+        return {}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_idempotency_store():
+    """The configured store, or None when Idempotency-Key is ignored"""
+    global _store
+    config = idempotency_config()
+    if not config.get('ENABLED', True):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if config.get('BACKEND', 'memory') == 'cache':
+                    _store = CacheIdempotencyStore(caches[config.get('CACHE', 'chat_idempotency')],
+                                                   poll_seconds=config.get('POLL_SECONDS', 0.05))
+                else:
+                    _store = MemoryIdempotencyStore(max_keys=config.get('MAX_KEYS', 100000))
+                metrics.register_stats('idempotency', _store.stats)
+    return _store
+
+
+def request_fingerprint(data) -> str:
+    items = data.dict() if hasattr(data, 'dict') else data
+    return hashlib.sha256(json.dumps(items, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _result(response):
+    """What a duplicate gets back, or None if the response shouldn't be replayed"""
+    if isinstance(response, StreamingHttpResponse):
+        stream_id = response.get('X-Stream-Id')
+        return {'stream_id': stream_id} if stream_id else None
+    # Server errors and rate limiting are worth retrying for real
+    if isinstance(response, Response) and response.status_code < 500 \
+            and response.status_code != status.HTTP_429_TOO_MANY_REQUESTS:
+        return {'status': response.status_code, 'data': response.data}
+    return None
+
+
+def idempotent(request, scope: str, owner: str, execute, replay_stream=None):
+    """Run ``execute()`` once per Idempotency-Key.
+
+    Completed results are kept for TTL_SECONDS and replayed to repeats of the
+    request. A repeat that arrives while the first is still running waits for
+    it (up to WAIT_SECONDS) and then gets the same result; for a streamed
+    reply, ``replay_stream(stream_id)`` attaches it to the same generation.
+    Keys are scoped to ``scope`` and ``owner``; reusing one for a different
+    request body is a 422.
+    """
+    key = request.headers.get('Idempotency-Key')
+    store = get_idempotency_store() if key else None
+    if store is None:
+        return execute()
+    if len(key) > 255:
+        return Response({'error': 'Idempotency-Key is too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+    config = idempotency_config()
+    store_key = 'idempotency:' + hashlib.sha256(f'{scope}\n{owner}\n{key}'.encode('utf-8')).hexdigest()
+    fingerprint = request_fingerprint(request.data)
+    record = store.claim(store_key, {'state': PENDING, 'fingerprint': fingerprint},
+                         config.get('LOCK_SECONDS', 60))
+    if record is None:
+        IDEMPOTENT_REQUESTS.inc(outcome='executed')
+        try:
+            response = execute()
+        except BaseException:
+            store.release(store_key)
+            raise
+        result = _result(response)
+        if result is None:
+            store.release(store_key)
+        else:
+            store.complete(store_key, {'state': DONE, 'fingerprint': fingerprint, **result},
+                           config.get('TTL_SECONDS', 86400))
+        return response
+
+    if record['fingerprint'] != fingerprint:
+        IDEMPOTENT_REQUESTS.inc(outcome='mismatch')
+        return Response({'error': 'Idempotency-Key was already used for a different request'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    if record['state'] == PENDING:
+        record = store.wait(store_key, config.get('WAIT_SECONDS', 10))
+    if record is None or record['state'] == PENDING:
+        # Still running, or it failed and was released: the client should try again
+        IDEMPOTENT_REQUESTS.inc(outcome='in_progress')
+        response = Response({'error': 'A request with this Idempotency-Key is still in progress'},
+                            status=status.HTTP_409_CONFLICT)
+        response['Retry-After'] = '1'
+        return response
+
+    IDEMPOTENT_REQUESTS.inc(outcome='replayed')
+    if 'stream_id' in record and replay_stream is not None:
+        response = replay_stream(record['stream_id'])
+    else:
+        response = Response(record.get('data'), status=record.get('status', status.HTTP_200_OK))
+    response['Idempotent-Replayed'] = 'true'
+    return response
@@ -0,0 +1,400 @@
+import contextlib
+import contextvars
+import json
+import logging
+import math
+import random
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+
+def instrumentation_config() -> dict:
+    return getattr(settings, 'INSTRUMENTATION', {})
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, '') for name in self.labels), 0)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(tuple(labels.get(name, '') for name in self.labels))
+        return series[2] if series else 0
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {count}'
+
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text format.
+
+    Each worker process keeps its own numbers; Prometheus scrapes every
+    worker (or sums them) rather than this code sharing state between them.
+    Components that already keep a ``stats()`` dict register it and are
+    exported as gauges.
+    """
+
+    def __init__(self, namespace: str = 'soar'):
+        self.namespace = namespace
+        self._metrics = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        metric = Counter(f'{self.namespace}_{name}', help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(f'{self.namespace}_{name}', help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats):
+        """Export the numeric values of ``stats()`` as ``<namespace>_<prefix>_<key>`` gauges"""
+        with self._lock:
+            self._stats[prefix] = stats
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        with self._lock:
+            sources = list(self._stats.items())
+        for prefix, stats in sources:
+            try:
+                values = stats()
+            except Exception:
+                logger.exception("Collecting %s stats failed", prefix)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    name = f'{self.namespace}_{prefix}_{key}'
+                    lines.append(f'# TYPE {name} gauge')
+                    lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.counter('http_requests_total', "Requests by route and status", ('method', 'route', 'status'))
+HTTP_DURATION = registry.histogram('http_request_duration_seconds',
+                                   "Time until the response (or, when streaming, its headers) is ready",
+                                   ('method', 'route'))
+DB_QUERIES = registry.histogram('db_queries_per_request', "SQL queries per sampled request", ('route',),
+                                buckets=COUNT_BUCKETS)
+DB_SECONDS = registry.histogram('db_seconds_per_request', "SQL time per sampled request", ('route',))
+BEDROCK_FIRST_CHUNK = registry.histogram('bedrock_first_chunk_seconds', "InvokeAgent time to first chunk")
+BEDROCK_DURATION = registry.histogram('bedrock_call_seconds', "InvokeAgent time until the stream is drained")
+BEDROCK_ERRORS = registry.counter('bedrock_errors_total', "InvokeAgent failures by error code", ('code',))
+STREAMS = registry.counter('chat_streams_total', "Chat reply streams by outcome", ('outcome',))
+STREAM_FIRST_CHUNK = registry.histogram('chat_stream_first_chunk_seconds', "Stream start to first chunk sent")
+STREAM_DURATION = registry.histogram('chat_stream_duration_seconds', "Stream start to last chunk sent")
+STREAM_CHUNKS = registry.counter('chat_stream_chunks_total', "Chunks sent to clients")
+STREAM_BYTES = registry.counter('chat_stream_bytes_total', "Reply text bytes sent to clients")
+AGENT_SESSIONS = registry.counter('agent_session_events_total',
+                                  "Agent sessions started (new, idle, size) or ended, by reason", ('reason',))
+AGENT_SESSION_TURNS = registry.histogram('agent_session_turns', "Turns an agent session has seen, per turn",
+                                         buckets=COUNT_BUCKETS)
+AGENT_SESSION_CHARS = registry.histogram('agent_session_chars', "Characters an agent session has seen, per turn",
+                                         buckets=(1000, 5000, 10000, 25000, 50000, 100000, 250000))
+AGENT_TURN_SECONDS = registry.histogram('agent_turn_seconds', "Chat turn time to the last upstream chunk",
+                                        ('session',))
+UPSTREAM_QUEUE_WAIT = registry.histogram('upstream_queue_wait_seconds', "Time agent calls waited for a slot",
+                                         ('lane',))
+UPSTREAM_REJECTED = registry.counter('upstream_rejected_total', "Agent calls turned away, by reason",
+                                     ('reason', 'lane'))
+UPSTREAM_THROTTLED = registry.counter('upstream_throttled_total', "Agent calls the service throttled")
+PROFILE_TURNS = registry.counter('profile_extraction_turns_total',
+                                "Logged-in turns offered for profile extraction, by decision (skipped, queued)",
+                                ('decision',))
+PROFILE_CALLS = registry.counter('profile_extraction_calls_total', "Profile extraction calls made (one per batch)")
+STT_AUDIO_SECONDS = registry.counter('stt_audio_seconds_total', "Seconds of audio transcribed")
+STT_INFERENCE = registry.histogram('stt_inference_seconds', "Wall time per transcribed segment")
+STT_PREPROCESS = registry.histogram('stt_preprocess_seconds', "Decode, resample and silence trimming per upload")
+STT_TRIMMED_SECONDS = registry.counter('stt_trimmed_audio_seconds_total',
+                                       "Seconds of uploaded audio cut as silence before transcription")
+STT_REJECTED = registry.counter('stt_rejected_total', "Uploads rejected before transcription, by reason",
+                                ('reason',))
+CHAT_STREAM_RESUMES = registry.counter('chat_stream_resumes_total',
+                                      "Reconnects with Last-Event-ID, by outcome (resumed, expired)", ('outcome',))
+CHAT_STREAMS_DETACHED = registry.counter('chat_streams_detached_total',
+                                         "Replies that went on generating after their client went away")
+IDEMPOTENT_REQUESTS = registry.counter('idempotent_requests_total',
+                                      "Requests with an Idempotency-Key, by outcome (executed, replayed, "
+                                      "in_progress, mismatch)", ('outcome',))
+VOICE_SESSIONS = registry.counter('voice_sessions_total', "Live voice sockets closed, by outcome", ('outcome',))
+VOICE_DECODES = registry.counter('voice_decodes_total', "Sliding-window decodes of live voice audio, by kind",
+                                 ('kind',))
+VOICE_FINAL_LATENCY = registry.histogram('voice_final_seconds', "Time from a live recording's stop to its final transcript")
+
+
+def _should_sample() -> bool:
+    rate = instrumentation_config().get('SAMPLE_RATE', 0.1)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def log_event(event: str, **fields):
+    logger.info(event, extra={'fields': {'event': event, **fields}})
+
+
+class RequestSpan:
+    def __init__(self, sampled: bool):
+        self.sampled = sampled
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.fields = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_seconds += time.perf_counter() - started
+
+
+_current_span = contextvars.ContextVar('request_span', default=None)
+
+
+def _span_wrapper(execute, sql, params, many, context):
+    # Looked up per query: the span travels in the context, which sync_to_async copies into its threads
+    span = _current_span.get()
+    if span is None or not span.sampled:
+        return execute(sql, params, many, context)
+    return span(execute, sql, params, many, context)
+
+
+def _install_span_wrapper(sender=None, connection=None, **kwargs):
+    if _span_wrapper not in connection.execute_wrappers:
+        # First, so execute_wrapper() blocks that pop what they appended are undisturbed
+        connection.execute_wrappers.insert(0, _span_wrapper)
+
+
+# Every connection, on whichever thread opens it, reports to the span of the request using it
+connection_created.connect(_install_span_wrapper)
+
+
+def annotate(**fields):
+    """Attach fields to the current request's log line, if it is being sampled"""
+    span = _current_span.get()
+    if span is not None and span.sampled:
+        span.fields.update(fields)
+
+
+class InstrumentationMiddleware:
+    """Per-request metrics, plus DB spans and a JSON log line for sampled (or slow) requests.
+
+    Unsampled requests cost a couple of counter updates and a context lookup
+    per query. Runs natively on either stack, so ASGI requests reach the
+    async views without a thread hop; queries that sync views run on
+    sync_to_async threads still count towards the request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = instrumentation_config()
+        if not config.get('ENABLED', True):
+            return self.get_response(request)
+
+        span = RequestSpan(_should_sample())
+        started = time.perf_counter()
+        with self.measure(span):
+            response = self.get_response(request)
+        self.record(request, response, span, time.perf_counter() - started, config)
+        return response
+
+    async def __acall__(self, request):
+        config = instrumentation_config()
+        if not config.get('ENABLED', True):
+            return await self.get_response(request)
+
+        span = RequestSpan(_should_sample())
+        started = time.perf_counter()
+        with self.measure(span):
+            response = await self.get_response(request)
+        self.record(request, response, span, time.perf_counter() - started, config)
+        return response
+
+    @contextlib.contextmanager
+    def measure(self, span: RequestSpan):
+        if span.sampled:
+            # Connections opened before this module was imported never sent connection_created
+            for connection in connections.all():
+                _install_span_wrapper(connection=connection)
+        token = _current_span.set(span)
+        try:
+            yield
+        finally:
+            _current_span.reset(token)
+
+    def record(self, request, response, span: RequestSpan, duration: float, config: dict):
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match else 'unmatched'
+        HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+        HTTP_DURATION.observe(duration, method=request.method, route=route)
+        if span.sampled:
+            DB_QUERIES.observe(span.db_queries, route=route)
+            DB_SECONDS.observe(span.db_seconds, route=route)
+        if span.sampled or duration >= config.get('SLOW_REQUEST_SECONDS', 1.0):
+            log_event(
+                'request', method=request.method, route=route, status=response.status_code,
+                duration_ms=round(duration * 1000, 1), streaming=response.streaming,
+                db_queries=span.db_queries if span.sampled else None,
+                db_ms=round(span.db_seconds * 1000, 1) if span.sampled else None,
+                **span.fields
+            )
+
+
+class StreamTimer:
+    """Times one reply stream from the view's side: first chunk, chunks, bytes, duration.
+
+    Streams outlive the middleware's view of the request, so they report
+    their own metrics and (when sampled) log line when they finish.
+    """
+
+    def __init__(self, **fields):
+        self.started = time.perf_counter()
+        self.first_chunk = None
+        self.chunks = 0
+        self.bytes = 0
+        self.fields = fields
+        self.sampled = _should_sample()
+
+    def chunk(self, text: str):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.started
+        self.chunks += 1
+        self.bytes += len(text.encode('utf-8'))
+
+    def finish(self, outcome: str = 'ok'):
+        duration = time.perf_counter() - self.started
+        STREAMS.inc(outcome=outcome)
+        STREAM_CHUNKS.inc(self.chunks)
+        STREAM_BYTES.inc(self.bytes)
+        STREAM_DURATION.observe(duration)
+        if self.first_chunk is not None:
+            STREAM_FIRST_CHUNK.observe(self.first_chunk)
+        if self.sampled or outcome != 'ok':
+            log_event(
+                'chat.stream', outcome=outcome, duration_ms=round(duration * 1000, 1),
+                first_chunk_ms=round(self.first_chunk * 1000, 1) if self.first_chunk is not None else None,
+                chunks=self.chunks, bytes=self.bytes, **self.fields
+            )
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint: scrapers send INSTRUMENTATION['METRICS_TOKEN'] as a bearer token;
+    without one configured, only signed-in staff can read it"""
+    token = instrumentation_config().get('METRICS_TOKEN')
+    if token:
+        allowed = request.headers.get('Authorization') == f'Bearer {token}'
+    else:
+        allowed = request.user.is_authenticated and request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={'fields': {...}}`` is merged in"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
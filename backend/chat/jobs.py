@@ -0,0 +1,463 @@
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .instrumentation import PROFILE_CALLS, PROFILE_TURNS, registry as metrics
+from .models import ProfileExtractionJob
+
+logger = logging.getLogger(__name__)
+
+
+class Claim:
+    """A batch of pending turns for one user, handed to a single worker.
+
+    ``token`` identifies this lease on the batch: once it expires and another
+    worker reclaims the batch, the old holder's token no longer matches.
+    """
+
+    def __init__(self, user_email: str, turns, enqueued_at: float, attempts: int, handle=None, token=None):
+        self.user_email = user_email
+        self.turns = turns
+        self.enqueued_at = enqueued_at
+        self.attempts = attempts
+        self.handle = handle
+        self.token = token
+
+
+class DatabaseJobBackend:
+    """Jobs live in ProfileExtractionJob rows, so they survive restarts"""
+
+    def __init__(self, lease_seconds: int = 300):
+        self.lease = timedelta(seconds=lease_seconds)
+
+    def enqueue(self, user_email: str, message: str, response: str, delay: float = 0, max_wait: float = None):
+        now = timezone.now()
+        run_after = now + timedelta(seconds=delay)
+        if not delay:
+            ProfileExtractionJob.objects.create(user_email=user_email, message=message, response=response)
+            return
+        # Push the user's waiting turns back with the new one, so they go out as one batch once the user
+        # goes quiet, but never later than max_wait after the oldest of them
+        waiting = ProfileExtractionJob.objects.filter(
+            user_email=user_email, status=ProfileExtractionJob.PENDING, attempts=0, run_after__gt=now
+        )
+        with transaction.atomic():
+            oldest = waiting.order_by('created_at').values_list('created_at', flat=True).first()
+            if oldest is not None and max_wait is not None:
+                run_after = max(now, min(run_after, oldest + timedelta(seconds=max_wait)))
+            waiting.update(run_after=run_after)
+            ProfileExtractionJob.objects.create(
+                user_email=user_email, message=message, response=response, run_after=run_after
+            )
+
+    def flush(self, user_email: str):
+        now = timezone.now()
+        ProfileExtractionJob.objects.filter(
+            user_email=user_email, status=ProfileExtractionJob.PENDING, attempts=0, run_after__gt=now
+        ).update(run_after=now)
+
+    def _due(self, now):
+        # Running rows whose lease ran out belong to a worker that died mid-job
+        return ProfileExtractionJob.objects.filter(
+            Q(status=ProfileExtractionJob.PENDING, run_after__lte=now) |
+            Q(status=ProfileExtractionJob.RUNNING, started_at__lt=now - self.lease)
+        )
+
+    def claim(self, batch_size: int, exclude=()):
+        now = timezone.now()
+        with transaction.atomic():
+            busy = ProfileExtractionJob.objects.filter(
+                status=ProfileExtractionJob.RUNNING, started_at__gte=now - self.lease
+            ).values('user_email')
+            head = (self._due(now).select_for_update(skip_locked=True)
+                    .exclude(user_email__in=busy).exclude(user_email__in=list(exclude))
+                    .order_by('run_after', 'id').first())
+            if head is None:
+                return None
+            jobs = list(self._due(now).select_for_update(skip_locked=True)
+                        .filter(user_email=head.user_email).order_by('id')[:batch_size])
+            ids = [job.id for job in jobs]
+            ProfileExtractionJob.objects.filter(id__in=ids).update(
+                status=ProfileExtractionJob.RUNNING, started_at=now
+            )
+        return Claim(
+            user_email=head.user_email,
+            turns=[(job.message, job.response) for job in jobs],
+            enqueued_at=min(job.created_at for job in jobs).timestamp(),
+            attempts=max(job.attempts for job in jobs),
+            handle=ids,
+            token=now,
+        )
+
+    def _held(self, claim: Claim):
+        # A reclaim stamps a new started_at, so a stale worker's rows no longer match
+        return ProfileExtractionJob.objects.filter(
+            id__in=claim.handle, status=ProfileExtractionJob.RUNNING, started_at=claim.token
+        )
+
+    def holds(self, claim: Claim) -> bool:
+        """Whether the claim's lease is still current; inside a transaction, also locks its jobs until commit"""
+        return len(self._held(claim).select_for_update().values_list('id', flat=True)) == len(claim.handle)
+
+    def complete(self, claim: Claim) -> bool:
+        """Mark the batch done; False (and nothing changed) if the lease passed to another worker"""
+        return self._held(claim).update(
+            status=ProfileExtractionJob.DONE, finished_at=timezone.now(), last_error=''
+        ) > 0
+
+    def retry(self, claim: Claim, delay: float, error: str, give_up: bool, attempts: int):
+        now = timezone.now()
+        self._held(claim).update(
+            status=ProfileExtractionJob.FAILED if give_up else ProfileExtractionJob.PENDING,
+            attempts=attempts,
+            run_after=now + timedelta(seconds=delay),
+            finished_at=now if give_up else None,
+            last_error=error,
+        )
+
+    def depth(self) -> int:
+        return ProfileExtractionJob.objects.filter(
+            status__in=[ProfileExtractionJob.PENDING, ProfileExtractionJob.RUNNING]
+        ).count()
+
+
+# Move the next batch into the user's processing list unless a dead worker left one behind
+_REDIS_DRAIN = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+if #items == 0 then
+    items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    redis.call('LTRIM', KEYS[1], tonumber(ARGV[1]), -1)
+    if #items > 0 then
+        redis.call('RPUSH', KEYS[2], unpack(items))
+    end
+end
+return items
+"""
+
+# Queue a turn and move the user's due time to ARGV[2], but no later than ARGV[3] seconds after their oldest turn
+_REDIS_ENQUEUE = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+local due = tonumber(ARGV[2])
+local oldest = cjson.decode(redis.call('LINDEX', KEYS[1], 0))
+if tonumber(ARGV[3]) >= 0 then
+    due = math.min(due, math.max(tonumber(ARGV[4]), oldest['enqueued_at'] + tonumber(ARGV[3])))
+end
+redis.call('ZADD', KEYS[2], due, ARGV[5])
+return 1
+"""
+
+# Drop the processing list, release the user and retire them from the ready set if idle; only the
+# worker whose token is still in the lock may do this
+_REDIS_FINISH = """
+if redis.call('GET', KEYS[4]) ~= ARGV[3] then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[4])
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+else
+    -- GT keeps a later due time set by turns that arrived while this batch ran
+    redis.call('ZADD', KEYS[3], 'GT', ARGV[2], ARGV[1])
+end
+return 1
+"""
+
+
+class RedisJobBackend:
+    """Jobs live in per-user Redis lists; works with any Redis-compatible server"""
+
+    def __init__(self, url: str, prefix: str = 'soar:profile-jobs', lease_seconds: int = 300):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured("PROFILE_JOBS['BACKEND'] = 'redis' requires the redis package")
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self._enqueue = self.redis.register_script(_REDIS_ENQUEUE)
+        self._drain = self.redis.register_script(_REDIS_DRAIN)
+        self._finish = self.redis.register_script(_REDIS_FINISH)
+
+    def _keys(self, user_email: str):
+        return (
+            f'{self.prefix}:queue:{user_email}',
+            f'{self.prefix}:processing:{user_email}',
+            f'{self.prefix}:ready',
+            f'{self.prefix}:lock:{user_email}',
+        )
+
+    def enqueue(self, user_email: str, message: str, response: str, delay: float = 0, max_wait: float = None):
+        queue, _, ready, _ = self._keys(user_email)
+        now = time.time()
+        job = json.dumps({'message': message, 'response': response, 'enqueued_at': now, 'attempts': 0})
+        if not delay:
+            pipe = self.redis.pipeline()
+            pipe.rpush(queue, job)
+            pipe.zadd(ready, {user_email: now}, nx=True)
+            pipe.execute()
+            return
+        self._enqueue(keys=[queue, ready], args=[job, now + delay, -1 if max_wait is None else max_wait, now,
+                                                 user_email])
+
+    def flush(self, user_email: str):
+        now = time.time()
+        ready = f'{self.prefix}:ready'
+        # XX: only users with queued turns; LT: never later than they already were
+        self.redis.zadd(ready, {user_email: now}, xx=True, lt=True)
+
+    def claim(self, batch_size: int, exclude=()):
+        ready = f'{self.prefix}:ready'
+        for raw_email in self.redis.zrangebyscore(ready, '-inf', time.time(), start=0, num=20):
+            user_email = raw_email.decode('utf-8')
+            if user_email in exclude:
+                continue
+            queue, processing, _, lock = self._keys(user_email)
+            # The lock expires on its own if the worker holding it dies
+            token = uuid.uuid4().hex
+            if not self.redis.set(lock, token, nx=True, ex=self.lease_seconds):
+                continue
+            items = [json.loads(item) for item in self._drain(keys=[queue, processing], args=[batch_size])]
+            if not items:
+                self._finish(keys=[queue, processing, ready, lock], args=[user_email, time.time(), token])
+                continue
+            return Claim(
+                user_email=user_email,
+                turns=[(item['message'], item['response']) for item in items],
+                enqueued_at=min(item['enqueued_at'] for item in items),
+                attempts=max(item['attempts'] for item in items),
+                handle=items,
+                token=token,
+            )
+        return None
+
+    def holds(self, claim: Claim) -> bool:
+        lock = self._keys(claim.user_email)[3]
+        return self.redis.get(lock) == claim.token.encode('ascii')
+
+    def complete(self, claim: Claim) -> bool:
+        queue, processing, ready, lock = self._keys(claim.user_email)
+        return bool(self._finish(keys=[queue, processing, ready, lock],
+                                 args=[claim.user_email, time.time(), claim.token]))
+
+    def retry(self, claim: Claim, delay: float, error: str, give_up: bool, attempts: int):
+        queue, processing, ready, lock = self._keys(claim.user_email)
+        if not self.holds(claim):
+            return  # Another worker has the batch now
+        if give_up:
+            self.redis.rpush(f'{self.prefix}:failed', *[
+                json.dumps({**item, 'user_email': claim.user_email, 'error': error}) for item in claim.handle
+            ])
+        else:
+            items = [json.dumps({**item, 'attempts': attempts}) for item in claim.handle]
+            # Put the batch back at the head of the queue, keeping its order
+            self.redis.lpush(queue, *reversed(items))
+        self._finish(keys=[queue, processing, ready, lock], args=[claim.user_email, time.time() + delay, claim.token])
+
+    def depth(self) -> int:
+        users = self.redis.zrange(f'{self.prefix}:ready', 0, -1)
+        pipe = self.redis.pipeline()
+        for raw_email in users:
+            queue, processing, _, _ = self._keys(raw_email.decode('utf-8'))
+            pipe.llen(queue)
+            pipe.llen(processing)
+        return sum(pipe.execute())
+
+
+class ProfileJobQueue:
+    """Bounded worker pool that drains profile-extraction jobs in the background.
+
+    All pending turns for a user are coalesced into one extraction call, and a
+    user is only ever processed by one worker at a time. Failed batches are
+    retried with exponential backoff before being marked as failed.
+    ``processor(user_email, turns, lease=...)`` should call ``lease()`` in the
+    transaction that stores its result and drop the result if it returns
+    False: the batch outlived its lease and was handed to another worker.
+
+    ``gate(message)`` drops turns unlikely to hold anything worth extracting
+    before they are queued. With ``idle_seconds`` a user's turns wait until
+    they have been quiet that long (or ``max_wait_seconds`` have passed, or
+    ``flush`` is called) and then go out as one batch.
+    """
+
+    def __init__(self, backend, processor, workers: int = 2, batch_size: int = 20,
+                 max_attempts: int = 5, backoff_seconds: float = 2.0, max_backoff_seconds: float = 300.0,
+                 poll_interval: float = 1.0, gate=None, idle_seconds: float = 0, max_wait_seconds: float = None):
+        self.backend = backend
+        self.processor = processor
+        self.gate = gate
+        self.idle_seconds = idle_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._active_users = set()
+        self._stopping = False
+        self._stats = {
+            'enqueued': 0, 'skipped': 0, 'batches': 0, 'jobs_processed': 0, 'retries': 0, 'failures': 0, 'stale': 0,
+            'last_latency_seconds': 0.0, 'max_latency_seconds': 0.0, 'total_latency_seconds': 0.0,
+        }
+
+    def enqueue(self, user_email: str, message: str, response: str) -> bool:
+        """Queue a turn for extraction; returns False if the gate skipped it"""
+        if self.gate is not None and not self.gate(message):
+            PROFILE_TURNS.inc(decision='skipped')
+            with self._lock:
+                self._stats['skipped'] += 1
+            return False
+        self.backend.enqueue(user_email, message, response, delay=self.idle_seconds,
+                             max_wait=self.max_wait_seconds)
+        PROFILE_TURNS.inc(decision='queued')
+        with self._lock:
+            self._stats['enqueued'] += 1
+            self._wakeup.notify()
+        self.start()
+        return True
+
+    def flush(self, user_email: str):
+        """Make the user's waiting turns due now, e.g. when their conversation ends"""
+        if self.idle_seconds:
+            self.backend.flush(user_email)
+            with self._lock:
+                self._wakeup.notify()
+
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            self._stopping = False
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._worker, name=f'profile-jobs-{len(self._threads)}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return
+            try:
+                processed = self.run_once()
+            except Exception:
+                logger.exception("Profile job worker crashed while claiming work")
+                processed = False
+            finally:
+                close_old_connections()
+            if not processed:
+                with self._lock:
+                    if not self._stopping:
+                        self._wakeup.wait(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """Claim and process one batch; returns False when nothing was due"""
+        with self._lock:
+            busy = set(self._active_users)
+        claim = self.backend.claim(self.batch_size, exclude=busy)
+        if claim is None:
+            return False
+        with self._lock:
+            if claim.user_email in self._active_users:
+                # Another worker in this process grabbed the user in the meantime
+                self.backend.retry(claim, 0, '', give_up=False, attempts=claim.attempts)
+                return True
+            self._active_users.add(claim.user_email)
+        try:
+            PROFILE_CALLS.inc()
+            self.processor(claim.user_email, claim.turns, lease=functools.partial(self.backend.holds, claim))
+        except Exception as e:
+            attempts = claim.attempts + 1
+            give_up = attempts >= self.max_attempts
+            delay = min(self.backoff_seconds * (2 ** claim.attempts), self.max_backoff_seconds)
+            logger.warning("Profile extraction for %s failed (attempt %s): %s", claim.user_email, attempts, e)
+            self.backend.retry(claim, delay, str(e), give_up, attempts)
+            with self._lock:
+                self._stats['failures' if give_up else 'retries'] += 1
+        else:
+            if not self.backend.complete(claim):
+                logger.warning("Profile extraction for %s outlived its lease; its result was dropped", claim.user_email)
+                with self._lock:
+                    self._stats['stale'] += 1
+                return True
+            latency = time.time() - claim.enqueued_at
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['jobs_processed'] += len(claim.turns)
+                self._stats['last_latency_seconds'] = latency
+                self._stats['max_latency_seconds'] = max(self._stats['max_latency_seconds'], latency)
+                self._stats['total_latency_seconds'] += latency
+        finally:
+            with self._lock:
+                self._active_users.discard(claim.user_email)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['workers'] = len([thread for thread in self._threads if thread.is_alive()])
+            stats['active_users'] = len(self._active_users)
+        stats['depth'] = self.backend.depth()
+        stats['avg_latency_seconds'] = stats['total_latency_seconds'] / stats['batches'] if stats['batches'] else 0.0
+        # Share of processed or skipped turns that didn't need an extraction call of their own
+        turns = stats['skipped'] + stats['jobs_processed']
+        stats['calls_saved_ratio'] = (turns - stats['batches']) / turns if turns else 0.0
+        return stats
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def build_backend(config: dict):
+    if config.get('BACKEND', 'db') == 'redis':
+        return RedisJobBackend(config['REDIS_URL'], lease_seconds=config.get('LEASE_SECONDS', 300))
+    return DatabaseJobBackend(lease_seconds=config.get('LEASE_SECONDS', 300))
+
+
+def get_profile_job_queue() -> ProfileJobQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                from .profiles import should_extract, update_user_profile
+                config = getattr(settings, 'PROFILE_JOBS', {})
+                gate_config = config.get('GATE', {})
+                _queue = ProfileJobQueue(
+                    build_backend(config),
+                    update_user_profile,
+                    workers=config.get('WORKERS', 2),
+                    batch_size=config.get('BATCH_SIZE', 20),
+                    max_attempts=config.get('MAX_ATTEMPTS', 5),
+                    backoff_seconds=config.get('BACKOFF_SECONDS', 2.0),
+                    max_backoff_seconds=config.get('MAX_BACKOFF_SECONDS', 300.0),
+                    gate=functools.partial(
+                        should_extract, long_message_chars=gate_config.get('LONG_MESSAGE_CHARS', 200)
+                    ) if gate_config.get('ENABLED', True) else None,
+                    idle_seconds=config.get('IDLE_SECONDS', 0),
+                    max_wait_seconds=config.get('MAX_WAIT_SECONDS'),
+                )
+                metrics.register_stats('profile_jobs', _queue.stats)
+    return _queue
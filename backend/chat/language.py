@@ -0,0 +1,53 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from langdetect import DetectorFactory, LangDetectException, detect_langs
+
+# langdetect is randomized unless seeded; the same text should always get the same answer
+DetectorFactory.seed = 0
+
+
+def _cache():
+    return caches[getattr(settings, 'CHAT_LANGUAGE_CACHE', 'default')]
+
+
+def normalize_language(code: str) -> str:
+    """Map detector codes onto Whisper's (langdetect says 'zh-cn', Whisper says 'zh')"""
+    return code.lower().split('-')[0]
+
+
+def detect_text_language(text: str, min_chars: int = 20, min_probability: float = 0.9):
+    """Language of ``text``, or None when it is too short or too ambiguous to call"""
+    if not text or len(text.strip()) < min_chars:
+        return None
+    try:
+        best = detect_langs(text)[0]
+    except LangDetectException:
+        return None
+    return normalize_language(best.lang) if best.prob >= min_probability else None
+
+
+def _keys(user_email: str = None, conversation_id=None):
+    # Conversation first: a user who switches language mid-conversation keeps it there
+    keys = []
+    if conversation_id:
+        keys.append(f'language:conversation:{conversation_id}')
+    if user_email and user_email != 'guest':
+        keys.append(f'language:user:{hashlib.sha1(user_email.encode("utf-8")).hexdigest()}')
+    return keys
+
+
+def get_language(user_email: str = None, conversation_id=None):
+    """The language last seen for this conversation or user, if any"""
+    keys = _keys(user_email, conversation_id)
+    if not keys:
+        return None
+    found = _cache().get_many(keys)
+    return next((found[key] for key in keys if key in found), None)
+
+
+def remember_language(language: str, user_email: str = None, conversation_id=None):
+    keys = _keys(user_email, conversation_id)
+    if language and keys:
+        _cache().set_many({key: language for key in keys},
+                          timeout=getattr(settings, 'CHAT_LANGUAGE_CACHE_TIMEOUT', 86400))
@@ -0,0 +1,314 @@
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import threading
+import time
+import uuid
+import wave
+from datetime import timedelta
+import numpy as np
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from .models import Conversation, Message
+
+WORDS = (
+    "goal plan week habit sleep study exam stress family friend work project focus energy run walk read "
+    "write journal budget save interview deadline motivation routine morning evening progress setback"
+).split()
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(seconds, prefix: str = '') -> dict:
+    """p50/p95/p99/max of a list of durations, in milliseconds"""
+    return {
+        f'{prefix}p50_ms': round(percentile(seconds, 50) * 1000, 1),
+        f'{prefix}p95_ms': round(percentile(seconds, 95) * 1000, 1),
+        f'{prefix}p99_ms': round(percentile(seconds, 99) * 1000, 1),
+        f'{prefix}max_ms': round(max(seconds) * 1000, 1) if seconds else 0.0,
+    }
+
+
+def max_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class QueryCounter:
+    """Counts SQL queries on every connection, including ones opened by
+    request threads while the counter is active"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._wrapped = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self._wrapped.add(connection)
+
+    def __enter__(self):
+        connection_created.connect(self._install)
+        for connection in connections.all():
+            self._install(connection=connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._install)
+        for connection in self._wrapped:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def seed_chat_data(users: int = 10, conversations: int = 1000, messages: int = 20, seed: int = 0,
+                   prefix: str = 'bench') -> list:
+    """Create ``users`` users with ``conversations`` conversations of ``messages`` messages each.
+
+    The same arguments always produce the same data, so runs on different
+    commits measure the same thing. Existing data for these users is replaced.
+    Returns the user emails.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    emails = [f'{prefix}-user{i}@example.com' for i in range(users)]
+    Conversation.objects.filter(user_email__in=emails).delete()
+
+    def sentence(low: int, high: int) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize() + '.'
+
+    for email in emails:
+        created = Conversation.objects.bulk_create([
+            Conversation(user_email=email, session_id=f'{prefix}-{uuid.UUID(int=rng.getrandbits(128))}')
+            for _ in range(conversations)
+        ], batch_size=1000)
+        batch = []
+        for conversation in created:
+            for index in range(messages):
+                is_user = index % 2 == 0
+                batch.append(Message(
+                    conversation=conversation,
+                    content=sentence(4, 20) if is_user else sentence(20, 80),
+                    is_user=is_user,
+                    user_email=email if is_user else None,
+                ))
+            conversation.message_count = messages
+            conversation.last_message = batch[-1].content if messages else ''
+            # Spread activity over the last 90 days so the sidebar ordering means something
+            conversation.updated_at = now - timedelta(seconds=rng.randint(0, 90 * 86400))
+            if len(batch) >= 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+        Conversation.objects.bulk_update(created, ['message_count', 'last_message', 'updated_at'], batch_size=1000)
+    return emails
+
+
+def wav_bytes(seconds: float, seed: int = 0, sample_rate: int = 16000, speech_ratio: float = 0.5) -> bytes:
+    """A mono 16-bit WAV shaped like a voice note: a quiet noise floor (about -60 dBFS) with
+    2 s bursts of syllable-modulated noise (about -20 dBFS) making up ``speech_ratio`` of it,
+    after half a second of lead-in silence"""
+    rng = np.random.default_rng(seed)
+    count = int(seconds * sample_rate)
+    samples = rng.standard_normal(count) * 30
+    burst = 2.0 * sample_rate
+    cycle = burst / speech_ratio if speech_ratio > 0 else count + 1
+    position = np.arange(count) - 0.5 * sample_rate
+    speaking = (position >= 0) & (position % cycle < burst)
+    syllables = 0.6 + 0.4 * np.abs(np.sin(np.arange(count) * np.pi * 4 / sample_rate))
+    samples[speaking] = rng.standard_normal(int(speaking.sum())) * 3000 * syllables[speaking]
+    samples = samples.astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def multipart_body(fields: dict, files: dict):
+    """Encode form fields and files as multipart/form-data; returns (body, content_type)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+async def asgi_request(application, method: str, path: str, query: str = '', body: bytes = b'',
+                       content_type: str = None, headers=None) -> dict:
+    """Run one request through the ASGI app in-process, timing the first and last body bytes"""
+    sent_body = False
+    started = time.perf_counter()
+    result = {'status': None, 'ttfb': None, 'total': None, 'bytes': 0}
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # Never disconnect; block until the handler is done with us
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            if message.get('body') and result['ttfb'] is None:
+                result['ttfb'] = time.perf_counter() - started
+            result['bytes'] += len(message.get('body', b''))
+            if not message.get('more_body'):
+                result['total'] = time.perf_counter() - started
+
+    request_headers = [(b'host', b'localhost'), (b'content-length', str(len(body)).encode())]
+    if content_type:
+        request_headers.append((b'content-type', content_type.encode()))
+    request_headers += [(name.encode(), value.encode()) for name, value in (headers or {}).items()]
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': query.encode(), 'root_path': '', 'headers': request_headers,
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 8000),
+    }
+    await application(scope, receive, send)
+    return result
+
+
+async def run_requests(make_request, count: int, concurrency: int = None, ramp_seconds: float = 0.0) -> dict:
+    """Run ``count`` requests (``make_request(i)`` returns a coroutine), at most ``concurrency`` at once.
+
+    One untimed request runs first so imports and first-call setup stay out
+    of the numbers.
+    """
+    await make_request(0)
+    gate = asyncio.Semaphore(concurrency or count)
+    peak_threads = threading.active_count()
+
+    async def one(index: int):
+        await asyncio.sleep(ramp_seconds * index / count)
+        async with gate:
+            return await make_request(index)
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_threads())
+    with QueryCounter() as queries:
+        started = time.perf_counter()
+        results = await asyncio.gather(*[one(i) for i in range(count)])
+        elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    ok = [r for r in results if r['status'] == 200 and r['total'] is not None]
+    statuses = {}
+    for r in results:
+        statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+    return {
+        'requests': count,
+        'ok': len(ok),
+        'statuses': statuses,
+        'wall_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 1) if elapsed else 0.0,
+        **summarize([r['total'] for r in ok]),
+        **summarize([r['ttfb'] for r in ok if r['ttfb'] is not None], prefix='ttfb_'),
+        'queries_per_request': round(queries.count / count, 2),
+        'peak_threads': peak_threads,
+        'max_rss_mb': max_rss_mb(),
+    }
+
+
+async def sse_scenario(conversation_id: int, streams: int, ramp_seconds: float = 0.0) -> dict:
+    """Concurrent chat streams; ``ttfb_*`` is time-to-first-chunk"""
+    from soar.asgi import application
+    body = json.dumps({'conversationId': conversation_id, 'message': 'Hi', 'user_email': 'guest'}).encode()
+    return await run_requests(
+        lambda i: asgi_request(application, 'POST', '/api/chat/message/', body=body,
+                               content_type='application/json'),
+        streams, ramp_seconds=ramp_seconds,
+    )
+
+
+async def sidebar_scenario(emails: list, loads: int, concurrency: int = 50, seed: int = 0) -> dict:
+    """Sidebar loads: the first page of conversations for a random seeded user"""
+    from soar.asgi import application
+    rng = random.Random(seed)
+    picks = [rng.choice(emails) for _ in range(loads + 1)]
+    return await run_requests(
+        lambda i: asgi_request(application, 'GET', '/api/chat/conversations/', query=f'email={picks[i]}'),
+        loads, concurrency=concurrency,
+    )
+
+
+async def stt_scenario(uploads: int, seconds: float = 10.0, concurrency: int = 8, stream: bool = False,
+                       speech_ratio: float = 0.5) -> dict:
+    """Speech-to-text uploads of ``seconds``-long WAV clips"""
+    from soar.asgi import application
+    clip = wav_bytes(seconds, speech_ratio=speech_ratio)
+    body, content_type = multipart_body({'user_email': 'guest'}, {'audio': ('clip.wav', clip, 'audio/wav')})
+    headers = {'accept': 'text/event-stream'} if stream else None
+    return await run_requests(
+        lambda i: asgi_request(application, 'POST', '/api/chat/speech-to-text/', body=body,
+                               content_type=content_type, headers=headers),
+        uploads, concurrency=concurrency,
+    )
+
+
+class SimulatedWhisperModel:
+    """Whisper stand-in that spends ``real_time_factor`` seconds per second of audio.
+
+    Used when the real weights aren't wanted (or available), so the STT
+    scenario measures the request pipeline around inference.
+    """
+    device = 'cpu'
+    is_multilingual = True
+
+    def __init__(self, real_time_factor: float = 0.05):
+        self.real_time_factor = real_time_factor
+
+    def transcribe(self, audio, **options):
+        time.sleep(len(audio) / 16000 * self.real_time_factor)
+        return {'text': ' simulated transcript', 'language': options.get('language') or 'en', 'segments': []}
+
+
+def compare_reports(baseline: dict, current: dict):
+    """Yield (scenario, metric, before, after, change%) for numeric metrics present in both reports"""
+    for scenario, metrics in current.get('scenarios', {}).items():
+        before = baseline.get('scenarios', {}).get(scenario, {})
+        for metric, value in metrics.items():
+            old = before.get(metric)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)):
+                change = (value - old) / old * 100 if old else 0.0
+                yield scenario, metric, old, value, round(change, 1)
@@ -0,0 +1,38 @@
+import time
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chat.models import Message
+from chat.search import SEARCH_CONFIG
+
+
+class Command(BaseCommand):
+    help = ("Fill in search_vector for messages written before the search trigger existed. "
+            "Works through the table in short id-ordered batches, each its own transaction, "
+            "so only the rows of the current batch are ever locked; safe to stop and rerun.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.05, help="Pause between batches, in seconds")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stdout.write("Full-text search vectors are PostgreSQL-only; nothing to do")
+            return
+
+        last_id = 0
+        total = 0
+        started = time.perf_counter()
+        while True:
+            ids = list(
+                Message.objects.filter(id__gt=last_id, search_vector__isnull=True)
+                .order_by('id').values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            Message.objects.filter(id__in=ids).update(search_vector=SearchVector('content', config=SEARCH_CONFIG))
+            last_id = ids[-1]
+            total += len(ids)
+            self.stdout.write(f"Indexed {total} messages (up to id {last_id})")
+            time.sleep(options['sleep'])
+        self.stdout.write(f"Done: {total} messages in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import platform
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.db import connection
+
+from chat.bedrock import configure_client_registry
+from chat.bedrock_stub import StubBedrockProcess
+from chat.loadtest import (
+    SimulatedWhisperModel, compare_reports, git_revision, seed_chat_data, sidebar_scenario, sse_scenario,
+    stt_scenario
+)
+from chat.models import Conversation
+from chat.scheduler import UpstreamScheduler
+from chat.stt import TranscriptionPool
+
+SCENARIOS = ['sse', 'sidebar', 'stt']
+
+
+class Command(BaseCommand):
+    help = ("Load-test the chat API in-process over ASGI against a local Bedrock stub and seeded data. "
+            "Reports latency percentiles, time-to-first-chunk, queries per request and RSS; "
+            "save with --output and pass the file to --compare on another commit")
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', default=SCENARIOS, help=f"Any of {', '.join(SCENARIOS)}")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the report as JSON to this file")
+        parser.add_argument('--compare', help="Print changes against a report saved with --output")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+        sse = parser.add_argument_group('sse: concurrent chat streams')
+        sse.add_argument('--streams', type=int, default=200)
+        sse.add_argument('--chunks', type=int, default=20)
+        sse.add_argument('--first-chunk-delay', type=float, default=0.2)
+        sse.add_argument('--chunk-delay', type=float, default=0.05)
+        sse.add_argument('--ramp-seconds', type=float, default=0.0,
+                         help="Spread stream start times evenly over this many seconds")
+
+        sidebar = parser.add_argument_group('sidebar: conversation list loads over seeded data')
+        sidebar.add_argument('--users', type=int, default=10)
+        sidebar.add_argument('--conversations', type=int, default=1000, help="Per user")
+        sidebar.add_argument('--messages', type=int, default=20, help="Per conversation")
+        sidebar.add_argument('--loads', type=int, default=500)
+        sidebar.add_argument('--concurrency', type=int, default=50)
+        sidebar.add_argument('--no-seed', action='store_true', help="Reuse data from seed_chat_data")
+
+        stt = parser.add_argument_group('stt: speech-to-text uploads')
+        stt.add_argument('--uploads', type=int, default=50)
+        stt.add_argument('--clip-seconds', type=float, default=10.0)
+        stt.add_argument('--stt-concurrency', type=int, default=8)
+        stt.add_argument('--stt-stream', action='store_true', help="Request per-segment SSE partials")
+        stt.add_argument('--speech-ratio', type=float, default=0.5,
+                         help="Share of each clip that is speech; the rest is silence for the VAD to trim")
+        stt.add_argument('--no-vad', action='store_true', help="Transcribe clips untrimmed, for comparison")
+        stt.add_argument('--real-time-factor', type=float, default=0.05,
+                         help="Simulated inference seconds per audio second")
+        stt.add_argument('--real-model', action='store_true', help="Use the configured Whisper model")
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+        report = {
+            'meta': {
+                'revision': git_revision(),
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'cpus': os.cpu_count(),
+                'options': {k: v for k, v in options.items() if k not in ('stdout', 'stderr', 'skip_checks')},
+            },
+            'scenarios': {},
+        }
+        for scenario in options['scenarios']:
+            self.stderr.write(f"Running {scenario}...")
+            report['scenarios'][scenario] = getattr(self, f'run_{scenario}')(options)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            for scenario, metrics in report['scenarios'].items():
+                self.stdout.write(f"[{scenario}]")
+                for key, value in metrics.items():
+                    self.stdout.write(f"{key:>24}: {value}")
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            self.stdout.write(f"\nChanges since {baseline['meta'].get('revision', '?')}:")
+            for scenario, metric, before, after, change in compare_reports(baseline, report):
+                self.stdout.write(f"{scenario:>8} {metric:>22}: {before:>10} -> {after:>10} ({change:+.1f}%)")
+
+    def run_sse(self, options) -> dict:
+        for key, value in (('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'),
+                           ('BEDROCK_AGENT_ID', 'BENCH'), ('BEDROCK_AGENT_ALIAS_ID', 'BENCH')):
+            os.environ.setdefault(key, value)
+        # The stub runs in its own process so its threads don't share our GIL
+        stub = StubBedrockProcess(
+            chunks=[f'token{i} ' for i in range(options['chunks'])],
+            first_chunk_delay=options['first_chunk_delay'],
+            chunk_delay=options['chunk_delay'],
+        ).start()
+        configure_client_registry(
+            region_name='us-east-1', endpoint_url=stub.endpoint_url, max_pool_connections=options['streams']
+        ).warm_up()
+        conversation = Conversation.objects.create(user_email='guest', session_id=f'bench-{time.time()}')
+        # Every stream comes from one guest, so lift the per-user rate limit and give each stream a slot
+        scheduler = UpstreamScheduler(max_concurrent=options['streams'], rate=0)
+        try:
+            with mock.patch('chat.scheduler._scheduler', scheduler):
+                return asyncio.run(sse_scenario(conversation.id, options['streams'], options['ramp_seconds']))
+        finally:
+            conversation.delete()
+            stub.stop()
+
+    def run_sidebar(self, options) -> dict:
+        if options['no_seed']:
+            emails = list(Conversation.objects.filter(user_email__startswith='bench-user')
+                          .values_list('user_email', flat=True).distinct())
+            if not emails:
+                raise CommandError("No seeded data found; run seed_chat_data or drop --no-seed")
+        else:
+            emails = seed_chat_data(options['users'], options['conversations'], options['messages'],
+                                    seed=options['seed'])
+        return asyncio.run(sidebar_scenario(emails, options['loads'], options['concurrency'], seed=options['seed']))
+
+    def run_stt(self, options) -> dict:
+        config = settings.CHAT_STT
+        if options['real_model']:
+            from chat.stt import get_transcription_pool
+            pool = get_transcription_pool()
+        else:
+            model = SimulatedWhisperModel(options['real_time_factor'])
+            pool = TranscriptionPool(lambda index: model, replicas=config.get('REPLICAS', 1),
+                                     max_pending=config.get('MAX_PENDING_SEGMENTS', 16))
+        with mock.patch('chat.views.get_transcription_pool', return_value=pool), \
+                override_settings(CHAT_STT={**config, 'VAD': not options['no_vad']}):
+            result = asyncio.run(stt_scenario(options['uploads'], options['clip_seconds'],
+                                              options['stt_concurrency'], options['stt_stream'],
+                                              options['speech_ratio']))
+        stats = pool.stats()
+        # run_requests sends one untimed warm-up upload first
+        uploaded = (options['uploads'] + 1) * options['clip_seconds']
+        return {
+            **result,
+            'uploaded_audio_seconds': uploaded,
+            'transcribed_audio_seconds': round(stats['audio_seconds'], 2),
+            'audio_seconds_saved_pct': round((1 - stats['audio_seconds'] / uploaded) * 100, 1) if uploaded else 0.0,
+            'pool': stats,
+        }
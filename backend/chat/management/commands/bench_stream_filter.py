@@ -0,0 +1,92 @@
+import json
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.stream_filter import PROFILE_KEYS, ReplyStream, coalesce
+
+PAYLOAD = '{"first name": ["Sam"], "goals": ["run a 10k"], "challenges": ["sleep"]}'
+
+
+def legacy_filter_chunk(chunk: str):
+    """The per-chunk filter MessageView used before ReplyStream"""
+    try:
+        json_obj = json.loads(chunk)
+        if any(key.lower() in json_obj for key in PROFILE_KEYS):
+            return None
+    except json.JSONDecodeError:
+        return chunk
+
+
+def synthetic_stream(rng: random.Random, chunks: int, max_chunk: int, leak: bool) -> list:
+    """Prose split into 1..max_chunk character pieces, with a profile payload split mid-stream"""
+    words = "you could try a short walk after dinner and write down one small win each day".split()
+    text = ' '.join(rng.choice(words) for _ in range(chunks * max_chunk // 5))
+    if leak:
+        middle = len(text) // 2
+        text = text[:middle] + ' ' + PAYLOAD + ' ' + text[middle:]
+    pieces, pos = [], 0
+    while pos < len(text):
+        size = rng.randint(1, max_chunk)
+        pieces.append(text[pos:pos + size])
+        pos += size
+    return pieces
+
+
+class Command(BaseCommand):
+    help = "Compare the old per-chunk json.loads filter with ReplyStream on synthetic streams of tiny chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=200)
+        parser.add_argument('--chunks', type=int, default=500, help="Approximate chunks per stream")
+        parser.add_argument('--max-chunk', type=int, default=4, help="Largest chunk, in characters")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        streams = [synthetic_stream(rng, options['chunks'], options['max_chunk'], leak=i % 2 == 0)
+                   for i in range(options['streams'])]
+        total_chunks = sum(len(stream) for stream in streams)
+
+        aborted = 0
+
+        def legacy(stream):
+            nonlocal aborted
+            full_response = ""
+            frames = 0
+            try:
+                for chunk in stream:
+                    chunk = legacy_filter_chunk(chunk)
+                    if chunk is None:
+                        continue
+                    full_response += chunk
+                    f"data: {json.dumps({'chunk': chunk})}\n\n"
+                    frames += 1
+            except TypeError:
+                # A chunk like "10" parses to an int and the membership test raises,
+                # which used to end the stream with an error frame
+                aborted += 1
+            return full_response, frames
+
+        def current(stream):
+            reply = ReplyStream(settings.CHAT_STREAM_FLUSH_SIZE, settings.CHAT_STREAM_FLUSH_INTERVAL)
+            frames = 0
+            for text in coalesce(stream, reply):
+                f"data: {json.dumps({'chunk': text})}\n\n"
+                frames += 1
+            return reply.text, frames
+
+        for name, run in (('json.loads per chunk', legacy), ('ReplyStream', current)):
+            started = time.perf_counter()
+            results = [run(stream) for stream in streams]
+            elapsed = time.perf_counter() - started
+            frames = sum(count for _, count in results)
+            leaked = sum(1 for text, _ in results if '"goals"' in text)
+            self.stdout.write(
+                f"{name:>22}: {elapsed / total_chunks * 1e6:6.2f} us/chunk, "
+                f"{frames / len(streams):7.1f} frames/stream, {leaked} of {len(streams) // 2 + len(streams) % 2} "
+                f"payloads leaked"
+            )
+        self.stdout.write(f"json.loads per chunk aborted {aborted} of {len(streams)} streams on numeric chunks")
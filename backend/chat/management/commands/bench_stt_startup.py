@@ -0,0 +1,105 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+SCENARIOS = ['setup', 'import', 'load', 'preload-fork']
+
+
+def memory_mb(pid='self') -> dict:
+    """Rss/Pss/private memory of a process; Pss splits shared pages between the processes mapping them"""
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    fields[name] = int(rest.split()[0]) / 1024
+    except OSError:
+        # Not Linux; peak RSS is the best we can do
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'private': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+class Command(BaseCommand):
+    help = ("Measure process startup time and memory for each way of loading the Whisper model: "
+            "'setup' is what every process pays now (lazy), 'import' and 'load' are the old eager path, "
+            "'preload-fork' loads once and forks workers that share the weights")
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', default=SCENARIOS)
+        parser.add_argument('--workers', type=int, default=4, help="Forked workers in preload-fork")
+        parser.add_argument('--child', help="Internal: run one scenario in this process")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options['child']:
+            self.stdout.write(json.dumps(self.run_child(options['child'], options['workers'])))
+            return
+
+        report = {}
+        for scenario in options['scenarios']:
+            started = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, sys.argv[0], 'bench_stt_startup', '--child', scenario,
+                 '--workers', str(options['workers'])],
+                capture_output=True, text=True
+            )
+            elapsed = time.perf_counter() - started
+            if proc.returncode:
+                report[scenario] = {'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+                continue
+            report[scenario] = {'seconds': round(elapsed, 2), **json.loads(proc.stdout.strip().splitlines()[-1])}
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for scenario, result in report.items():
+            if 'error' in result:
+                self.stdout.write(f"{scenario:>13}: skipped ({result['error']})")
+                continue
+            line = f"{scenario:>13}: {result['seconds']:6.2f}s  rss {result['rss']:8.1f} MB"
+            if 'workers' in result:
+                line += (f"  | {len(result['workers'])} workers: pss {result['workers_pss']:.1f} MB total, "
+                         f"{result['workers_private']:.1f} MB private total")
+            self.stdout.write(line)
+
+    def run_child(self, scenario: str, workers: int) -> dict:
+        # Django is already set up by manage.py by the time we get here
+        if scenario in ('import', 'load', 'preload-fork'):
+            import whisper  # noqa: F401
+        if scenario in ('load', 'preload-fork'):
+            from chat.stt import get_model
+            get_model()
+        result = memory_mb()
+        if scenario != 'preload-fork':
+            return result
+
+        # Each worker touches the weights the way inference would (reads only), then reports
+        pids = []
+        ready_read, ready_write = os.pipe()
+        release_read, release_write = os.pipe()
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                from chat.stt import get_model
+                sum(float(p.detach().sum()) for p in get_model().parameters())
+                os.write(ready_write, b'.')
+                os.read(release_read, 1)
+                os._exit(0)
+            pids.append(pid)
+        for _ in pids:
+            os.read(ready_read, 1)
+        measured = [memory_mb(pid) for pid in pids]
+        os.write(release_write, b'.' * len(pids))
+        for pid in pids:
+            os.waitpid(pid, 0)
+        result['workers'] = measured
+        result['workers_pss'] = sum(m.get('pss', m['rss']) for m in measured)
+        result['workers_private'] = sum(m.get('private', 0) for m in measured)
+        return result
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.jobs import get_profile_job_queue
+
+
+class Command(BaseCommand):
+    help = "Run the profile-extraction workers in the foreground (e.g. as a dedicated worker process)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain everything that is due, then exit")
+        parser.add_argument('--stats-interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        queue = get_profile_job_queue()
+        if options['once']:
+            while queue.run_once():
+                pass
+            self.stdout.write(str(queue.stats()))
+            return
+
+        queue.start()
+        try:
+            while True:
+                time.sleep(options['stats_interval'])
+                self.stdout.write(str(queue.stats()))
+        except KeyboardInterrupt:
+            queue.stop()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from chat.loadtest import seed_chat_data
+
+
+class Command(BaseCommand):
+    help = "Create deterministic benchmark users, conversations and messages (replaces any from a previous run)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--conversations', type=int, default=1000, help="Per user")
+        parser.add_argument('--messages', type=int, default=20, help="Per conversation")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='bench')
+
+    def handle(self, *args, **options):
+        emails = seed_chat_data(options['users'], options['conversations'], options['messages'],
+                                seed=options['seed'], prefix=options['prefix'])
+        self.stdout.write(f"Seeded {len(emails)} users with {options['conversations']} conversations "
+                          f"of {options['messages']} messages each")
@@ -0,0 +1,72 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from django.core.management.base import BaseCommand
+from chat.stt import (
+    SAMPLE_RATE, TranscriptionQueueFull, build_transcription_pool, get_model, stt_config, transcribe_audio
+)
+
+
+def _to_json(value):
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+
+class Command(BaseCommand):
+    help = ("Serve Whisper over HTTP for web workers running with CHAT_STT_BACKEND=sidecar, "
+            "so one process holds the model instead of every worker")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        config = stt_config()
+        pool = build_transcription_pool(config, backend='local')
+        get_model()
+        # One short inference so the first real request doesn't pay for allocator/thread-pool setup
+        list(transcribe_audio(pool, np.zeros(SAMPLE_RATE, np.float32)))
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, payload):
+                body = json.dumps(payload, default=_to_json).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/health':
+                    return self.send_json(404, {'error': 'Not found'})
+                self.send_json(200, {'status': 'ok', **pool.stats()})
+
+            def do_POST(self):
+                if self.path not in ('/transcribe', '/detect-language'):
+                    return self.send_json(404, {'error': 'Not found'})
+                audio = np.frombuffer(self.rfile.read(int(self.headers.get('Content-Length') or 0)), '<f4')
+                transcribe_options = json.loads(self.headers.get('X-Transcribe-Options') or '{}')
+                try:
+                    if self.path == '/detect-language':
+                        return self.send_json(200, {'language': pool.detect_language(audio)})
+                    # Clients send one segment at a time, so this is always a single result
+                    result = pool.submit_all([audio], **transcribe_options)[0].result()
+                except TranscriptionQueueFull:
+                    return self.send_json(503, {'error': 'Transcription is busy'})
+                except Exception as e:
+                    return self.send_json(500, {'error': str(e)})
+                self.send_json(200, {key: result.get(key) for key in ('text', 'language', 'segments')})
+
+        server = ThreadingHTTPServer((options['host'], options['port']), Handler)
+        server.daemon_threads = True
+        self.stdout.write(f"Serving speech-to-text on http://{options['host']}:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,225 @@
+import logging
+import threading
+import uuid
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from .bedrock import BedrockAgent
+from .instrumentation import registry as metrics
+from .models import Conversation, Message
+from .scheduler import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and a supportive assistant.
+Keep what matters for continuing the conversation: the user's situation, goals, feelings, decisions and anything the assistant promised or suggested. Drop small talk.
+Write at most {max_words} words of plain prose in the conversation's language. Respond with the summary only.
+
+Summary so far:
+{summary}
+
+New messages:
+{turns}"""
+
+
+def memory_config() -> dict:
+    return getattr(settings, 'CHAT_MEMORY', {})
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English; close enough to budget with
+    return len(text) // 4 + 1
+
+
+def _truncate(text: str, tokens: int) -> str:
+    limit = max(0, tokens) * 4
+    return text if len(text) <= limit else text[:limit].rstrip() + '…'
+
+
+def _speaker(message) -> str:
+    # User messages carry the sender's email (or 'guest'); replies don't
+    return 'User' if message['is_user'] or message['user_email'] else 'Assistant'
+
+
+class ConversationMemory:
+    """What the prompt gets to see of a conversation: its rolling summary plus the newest turns"""
+
+    def __init__(self, summary: str = '', turns=(), unsummarized: int = 0):
+        self.summary = summary
+        self.turns = list(turns)
+        self.unsummarized = unsummarized
+
+    def render(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation:\n{self.summary}\n")
+        parts.append("Current conversation:\n")
+        parts.extend(f"{speaker}: {text}\n" for speaker, text in self.turns)
+        return ''.join(parts)
+
+
+def load_memory(conversation_id, window: int = None, token_budget: int = None) -> ConversationMemory:
+    """The summary and as many of the newest ``window`` unsummarized messages as fit ``token_budget``.
+
+    Two indexed queries whatever the conversation's length, so prompt size
+    and build time stay flat as it grows.
+    """
+    config = memory_config()
+    window = config.get('WINDOW_MESSAGES', 12) if window is None else window
+    token_budget = config.get('HISTORY_TOKENS', 1500) if token_budget is None else token_budget
+
+    state = Conversation.objects.filter(pk=conversation_id).values(
+        'summary', 'summarized_through', 'summarized_count', 'message_count'
+    ).first()
+    if state is None:
+        return ConversationMemory()
+
+    summary = _truncate(state['summary'], config.get('SUMMARY_TOKENS', 400))
+    budget = token_budget - estimate_tokens(summary)
+    recent = Message.objects.filter(
+        conversation_id=conversation_id, id__gt=state['summarized_through']
+    ).order_by('-id').values('content', 'is_user', 'user_email')[:window] if window else []
+
+    turns = []
+    for message in recent:
+        text = message['content']
+        cost = estimate_tokens(text)
+        if cost > budget:
+            # Only the newest message is worth keeping in part; older ones are dropped whole
+            if turns or budget <= 0:
+                break
+            text = _truncate(text, budget)
+        budget -= cost
+        turns.append((_speaker(message), text))
+    turns.reverse()
+    return ConversationMemory(summary, turns, state['message_count'] - state['summarized_count'])
+
+
+def summarize_conversation(conversation_id, bedrock: BedrockAgent = None, window: int = None,
+                           max_fold: int = None) -> bool:
+    """Fold all but the newest ``window`` unsummarized messages into the conversation's summary.
+
+    At most ``max_fold`` messages are folded per call. The update only lands
+    if nobody else moved the summary on in the meantime. Returns whether the
+    summary changed; upstream errors are raised.
+    """
+    config = memory_config()
+    window = config.get('WINDOW_MESSAGES', 12) if window is None else window
+    max_fold = config.get('MAX_FOLD_MESSAGES', 100) if max_fold is None else max_fold
+
+    state = Conversation.objects.filter(pk=conversation_id).values('summary', 'summarized_through').first()
+    if state is None:
+        return False
+    tail = list(Message.objects.filter(
+        conversation_id=conversation_id, id__gt=state['summarized_through']
+    ).order_by('id').values('id', 'content', 'is_user', 'user_email')[:max_fold + window])
+    fold = tail[:max(0, len(tail) - window)][:max_fold]
+    if not fold:
+        return False
+
+    max_tokens = config.get('SUMMARY_TOKENS', 400)
+    prompt = SUMMARY_PROMPT.format(
+        max_words=max_tokens * 3 // 4,
+        summary=state['summary'] or '(none yet)',
+        turns='\n'.join(f"{_speaker(message)}: {message['content']}" for message in fold),
+    )
+    bedrock = bedrock or BedrockAgent()
+    # A throwaway session so the summary request never shows up in a chat session's history
+    summary = ''.join(bedrock.invoke_agent(
+        prompt, f'summary-{uuid.uuid4().hex}', raise_errors=True, lane=BACKGROUND
+    )).strip()
+    if not summary:
+        return False
+
+    return Conversation.objects.filter(
+        pk=conversation_id, summarized_through=state['summarized_through']
+    ).update(
+        summary=_truncate(summary, max_tokens),
+        summarized_through=fold[-1]['id'],
+        summarized_count=F('summarized_count') + len(fold),
+    ) == 1
+
+
+class SummaryScheduler:
+    """Summarizes conversations on a background thread, one at a time.
+
+    Requests for a conversation that is already waiting are merged. Nothing
+    is persisted: the need for a summary is recomputed from the conversation
+    row, so a request lost to a restart is simply made again on the next turn.
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.max_pending = max_pending
+        self._pending = {}  # insertion-ordered set of conversation ids
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stats = {'requested': 0, 'summarized': 0, 'skipped': 0, 'errors': 0, 'dropped': 0}
+
+    def request(self, conversation_id):
+        with self._lock:
+            self._stats['requested'] += 1
+            if conversation_id in self._pending:
+                return
+            if len(self._pending) >= self.max_pending:
+                self._stats['dropped'] += 1
+                return
+            self._pending[conversation_id] = None
+            self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-summaries', daemon=True)
+                self._thread.start()
+
+    def run_once(self) -> bool:
+        with self._lock:
+            if not self._pending:
+                return False
+            conversation_id = next(iter(self._pending))
+            del self._pending[conversation_id]
+        try:
+            changed = summarize_conversation(conversation_id)
+        except Exception:
+            logger.exception("Summarizing conversation %s failed", conversation_id)
+            outcome = 'errors'
+        else:
+            outcome = 'summarized' if changed else 'skipped'
+        with self._lock:
+            self._stats[outcome] += 1
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+            try:
+                self.run_once()
+            finally:
+                close_old_connections()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending)}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_summary_scheduler() -> SummaryScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = SummaryScheduler()
+                metrics.register_stats('summaries', _scheduler.stats)
+    return _scheduler
+
+
+def maybe_summarize(conversation_id, memory: ConversationMemory, new_messages: int = 2):
+    """Queue a summary once the unsummarized tail has grown past SUMMARIZE_AFTER messages"""
+    config = memory_config()
+    if not config.get('SUMMARIES', True):
+        return
+    if memory.unsummarized + new_messages > config.get('SUMMARIZE_AFTER', 24):
+        get_summary_scheduler().request(conversation_id)
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+def backfill_previews(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    Message = apps.get_model("chat", "Message")
+    for conversation in Conversation.objects.iterator(chunk_size=500):
+        messages = Message.objects.filter(conversation=conversation)
+        last = messages.order_by("-timestamp", "-id").first()
+        Conversation.objects.filter(pk=conversation.pk).update(
+            last_message=last.content if last else "",
+            message_count=messages.count(),
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0002_userprofile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="last_message",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="conversation",
+            index=models.Index(
+                fields=["user_email", "is_active", "-updated_at", "-id"],
+                name="chat_conver_user_em_1f58c1_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["conversation", "timestamp", "id"],
+                name="chat_messag_convers_fa4db4_idx",
+            ),
+        ),
+        migrations.RunPython(backfill_previews, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0003_conversation_denormalized_preview"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProfileExtractionJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user_email", models.CharField(max_length=255)),
+                ("message", models.TextField()),
+                ("response", models.TextField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("run_after", models.DateTimeField(default=django.utils.timezone.now)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("last_error", models.TextField(blank=True, default="")),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["status", "run_after"],
+                        name="chat_profil_status_128fdb_idx",
+                    ),
+                    models.Index(
+                        fields=["user_email", "status"],
+                        name="chat_profil_user_em_d376be_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
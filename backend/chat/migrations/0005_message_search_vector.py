@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:00
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# The GIN index and the trigger that keeps search_vector in step with content are
+# PostgreSQL-only, so they are created here rather than declared on the model.
+# Existing rows are filled in afterwards by `manage.py backfill_search_vectors`.
+SEARCH_CONFIG = "pg_catalog.english"
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    table = schema_editor.quote_name(apps.get_model("chat", "Message")._meta.db_table)
+    schema_editor.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_search_vector_gin "
+        f"ON {table} USING gin (search_vector)"
+    )
+    schema_editor.execute(f"DROP TRIGGER IF EXISTS chat_message_search_vector ON {table}")
+    schema_editor.execute(
+        f"CREATE TRIGGER chat_message_search_vector BEFORE INSERT OR UPDATE OF content ON {table} "
+        f"FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, '{SEARCH_CONFIG}', content)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    table = schema_editor.quote_name(apps.get_model("chat", "Message")._meta.db_table)
+    schema_editor.execute(f"DROP TRIGGER IF EXISTS chat_message_search_vector ON {table}")
+    schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS chat_message_search_vector_gin")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and it keeps the table writable
+    atomic = False
+
+    dependencies = [
+        ("chat", "0004_profileextractionjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
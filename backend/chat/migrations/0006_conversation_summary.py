@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0005_message_search_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="summarized_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="summarized_through",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="summary",
+            field=models.TextField(blank=True, default=""),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0006_conversation_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="agent_session",
+            field=models.CharField(blank=True, default="", max_length=100),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="agent_session_chars",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="agent_session_turns",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="agent_session_used_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0007_conversation_agent_session"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProfileFact",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user_email", models.CharField(max_length=255)),
+                ("category", models.CharField(max_length=100)),
+                ("item", models.TextField()),
+                ("item_key", models.CharField(max_length=40)),
+                ("mentions", models.PositiveIntegerField(default=1)),
+                ("first_seen", models.DateTimeField(default=django.utils.timezone.now)),
+                ("last_seen", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user_email", "-last_seen"],
+                        name="chat_profil_user_em_536508_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="profilefact",
+            constraint=models.UniqueConstraint(
+                fields=("user_email", "category", "item_key"),
+                name="unique_profile_fact",
+            ),
+        ),
+    ]
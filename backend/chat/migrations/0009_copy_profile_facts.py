@@ -0,0 +1,67 @@
+import hashlib
+import re
+import unicodedata
+
+from django.db import migrations, transaction
+
+# Profiles are copied a batch at a time, each batch in its own transaction, so a
+# large table is never locked as a whole. Rerunning is harmless: facts that are
+# already there are skipped by the unique constraint.
+BATCH_SIZE = 500
+
+_SPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.,!?¡¿…~-:;'\""
+
+
+def normalize(item):
+    # Frozen copy of chat.text.normalize_message, which chat.profiles.fact_key hashes
+    return _SPACE.sub(" ", unicodedata.normalize("NFKC", item).casefold()).strip(_EDGE_PUNCTUATION)
+
+
+def copy_profile_facts(apps, schema_editor):
+    UserProfile = apps.get_model("chat", "UserProfile")
+    ProfileFact = apps.get_model("chat", "ProfileFact")
+    alias = schema_editor.connection.alias
+    last_id = 0
+    while True:
+        with transaction.atomic(using=alias):
+            profiles = list(
+                UserProfile.objects.using(alias).filter(id__gt=last_id).order_by("id")
+                .only("id", "user_email", "key_information", "last_updated")[:BATCH_SIZE]
+            )
+            if not profiles:
+                break
+            facts = []
+            for profile in profiles:
+                seen = set()
+                for category, items in (profile.key_information or {}).items():
+                    if not isinstance(items, list):
+                        continue
+                    category = str(category).strip().lower()[:100]
+                    for item in items:
+                        item = str(item).strip()
+                        text = normalize(item)
+                        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                        if not category or not text or (category, key) in seen:
+                            continue
+                        seen.add((category, key))
+                        facts.append(ProfileFact(
+                            user_email=profile.user_email, category=category, item=item, item_key=key,
+                            first_seen=profile.last_updated, last_seen=profile.last_updated,
+                        ))
+            ProfileFact.objects.using(alias).bulk_create(facts, batch_size=1000, ignore_conflicts=True)
+            last_id = profiles[-1].id
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own
+    atomic = False
+
+    dependencies = [
+        ("chat", "0008_profilefact"),
+    ]
+
+    operations = [
+        # The JSON column is left as it was, so going back just stops reading the facts
+        migrations.RunPython(copy_profile_facts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:19
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def fill_rollup(apps, schema_editor):
+    # One grouped pass over the feedback written so far; new feedback updates the rollup as it arrives
+    Feedback = apps.get_model("chat", "Feedback")
+    FeedbackRollup = apps.get_model("chat", "FeedbackRollup")
+    alias = schema_editor.connection.alias
+    groups = (
+        Feedback.objects.using(alias)
+        .annotate(day=TruncDate("created_at"))
+        .values("day", "feedback_type", "rating")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    FeedbackRollup.objects.using(alias).bulk_create(
+        [FeedbackRollup(**group) for group in groups], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0009_copy_profile_facts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FeedbackRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("feedback_type", models.CharField(max_length=20)),
+                ("rating", models.IntegerField()),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="feedbackrollup",
+            constraint=models.UniqueConstraint(
+                fields=("day", "feedback_type", "rating"), name="unique_feedback_rollup"
+            ),
+        ),
+        migrations.RunPython(fill_rollup, migrations.RunPython.noop),
+    ]
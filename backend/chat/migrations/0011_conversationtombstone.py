@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 21:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0010_feedbackrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConversationTombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("conversation_id", models.BigIntegerField()),
+                ("user_email", models.CharField(blank=True, max_length=255, null=True)),
+                ("deleted_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user_email", "deleted_at"],
+                        name="chat_conver_user_em_b80607_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
+from django.utils import timezone
 
 # Create your models here.
 
@@ -20,6 +22,18 @@ class Feedback(models.Model):
     def __str__(self):
         return f"Feedback by {self.user.username} - Rating: {self.rating}"
 
+class FeedbackRollup(models.Model):
+    """How many feedback items of a type got a rating on a day; kept current by chat.feedback"""
+    day = models.DateField()
+    feedback_type = models.CharField(max_length=20)
+    rating = models.IntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'feedback_type', 'rating'], name='unique_feedback_rollup'),
+        ]
+
 class Conversation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     user_email = models.CharField(max_length=255, null=True, blank=True)  # For guest users
@@ -27,27 +41,115 @@ class Conversation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # Denormalized so the sidebar can be listed without touching messages
+    last_message = models.TextField(blank=True, default='')
+    message_count = models.PositiveIntegerField(default=0)
+    # Rolling summary of every message up to and including id summarized_through (see chat.memory)
+    summary = models.TextField(blank=True, default='')
+    summarized_through = models.PositiveBigIntegerField(default=0)
+    summarized_count = models.PositiveIntegerField(default=0)
+    # Current Bedrock agent session and how much it has seen (see chat.agent_sessions)
+    agent_session = models.CharField(max_length=100, blank=True, default='')
+    agent_session_turns = models.PositiveIntegerField(default=0)
+    agent_session_chars = models.PositiveIntegerField(default=0)
+    agent_session_used_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         indexes = [
             models.Index(fields=['user_email', '-created_at']),
             models.Index(fields=['user', '-created_at']),
+            models.Index(fields=['user_email', 'is_active', '-updated_at', '-id']),
         ]
 
     def __str__(self):
         return f"Conversation {self.session_id} - {'User: ' + self.user.email if self.user else 'Guest: ' + str(self.user_email)}"
 
+class ConversationTombstone(models.Model):
+    """A deleted conversation, kept so sidebar delta syncs (chat.sync) can report it"""
+    conversation_id = models.BigIntegerField()
+    user_email = models.CharField(max_length=255, null=True, blank=True)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_email', 'deleted_at']),
+        ]
+
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
     is_user = models.BooleanField(default=False)
     user_email = models.CharField(max_length=255, null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Maintained by a database trigger on PostgreSQL (see migration 0005); unused elsewhere
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp', 'id']),
+        ]
 
 class UserProfile(models.Model):
     user_email = models.CharField(max_length=255, unique=True)
+    # Legacy blob, copied into ProfileFact by migration 0009 and no longer written
     key_information = models.JSONField(default=dict)
     last_updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Profile for {self.user_email}"
+
+
+class ProfileFact(models.Model):
+    """One thing we know about a user, e.g. ('goals', 'run a marathon')"""
+    user_email = models.CharField(max_length=255)
+    category = models.CharField(max_length=100)
+    item = models.TextField()
+    # sha1 of the normalized item, so 'Running.' and 'running' are one fact (see chat.profiles.fact_key)
+    item_key = models.CharField(max_length=40)
+    mentions = models.PositiveIntegerField(default=1)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_email', 'category', 'item_key'], name='unique_profile_fact'),
+        ]
+        indexes = [
+            models.Index(fields=['user_email', '-last_seen']),
+        ]
+
+    def __str__(self):
+        return f"{self.category}: {self.item} ({self.user_email})"
+
+
+class ProfileExtractionJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user_email = models.CharField(max_length=255)
+    message = models.TextField()
+    response = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['user_email', 'status']),
+        ]
+
+    def __str__(self):
+        return f"Profile extraction for {self.user_email} ({self.status})"
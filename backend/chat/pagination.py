@@ -0,0 +1,72 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode(values) -> str:
+    raw = json.dumps(values).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode(token: str):
+    padded = token + '=' * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+
+
+def encode_cursor(moment: datetime, pk: int) -> str:
+    """Encode a (timestamp, id) keyset position as an opaque URL-safe token"""
+    return _encode([moment.isoformat(), pk])
+
+
+def decode_cursor(token: str):
+    try:
+        moment, pk = _decode(token)
+        return datetime.fromisoformat(moment), int(pk)
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor(token)
+
+
+def encode_sync_cursor(moment: datetime) -> str:
+    """Encode the point in time a ``since=`` delta request continues from"""
+    return _encode([moment.isoformat()])
+
+
+def decode_sync_cursor(token: str) -> datetime:
+    try:
+        moment, = _decode(token)
+        return datetime.fromisoformat(moment)
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor(token)
+
+
+def encode_rank_cursor(rank: float, pk: int) -> str:
+    """Encode a (relevance, id) keyset position; ``rank`` must round-trip exactly"""
+    return _encode([rank, pk])
+
+
+def decode_rank_cursor(token: str):
+    try:
+        rank, pk = _decode(token)
+        return float(rank), int(pk)
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor(token)
+
+
+def keyset_before(field: str, token: str) -> Q:
+    """Rows strictly after the cursor when ordered by (-field, -id)"""
+    moment, pk = decode_cursor(token)
+    return Q(**{f'{field}__lt': moment}) | Q(**{field: moment, 'id__lt': pk})
+
+
+def parse_limit(value, default: int, maximum: int) -> int:
+    try:
+        limit = int(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        return default
+    return max(0, min(limit, maximum))
@@ -0,0 +1,159 @@
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, F, IntegerField, TextField, Value, When
+from django.utils import timezone
+from .instrumentation import registry as metrics
+from .models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+
+def write_messages(messages):
+    """Insert messages and roll their conversations forward in one transaction.
+
+    ``messages`` is a list of unsaved Message objects, possibly spanning
+    several conversations. Each conversation gets its message_count,
+    last_message and updated_at bumped by a single UPDATE.
+    """
+    if not messages:
+        return
+    counts = {}
+    latest = {}
+    for message in messages:
+        counts[message.conversation_id] = counts.get(message.conversation_id, 0) + 1
+        latest[message.conversation_id] = message.content
+
+    with transaction.atomic():
+        if len(counts) == 1:
+            conversation_id, count = next(iter(counts.items()))
+            updated = Conversation.objects.filter(pk=conversation_id).update(
+                message_count=F('message_count') + count,
+                last_message=latest[conversation_id],
+                updated_at=timezone.now()
+            )
+        else:
+            updated = Conversation.objects.filter(pk__in=counts).update(
+                message_count=F('message_count') + Case(
+                    *[When(pk=pk, then=Value(count)) for pk, count in counts.items()],
+                    output_field=IntegerField()
+                ),
+                last_message=Case(
+                    *[When(pk=pk, then=Value(content)) for pk, content in latest.items()],
+                    output_field=TextField()
+                ),
+                updated_at=timezone.now()
+            )
+        if updated != len(counts):
+            raise Conversation.DoesNotExist("Conversation matching query does not exist.")
+        Message.objects.bulk_create(messages)
+
+
+class WriteBehindBuffer:
+    """Collects messages and writes them in batches from a background thread.
+
+    Under high throughput this turns many small transactions into one
+    bulk_create and one UPDATE per flush. Messages still waiting in the
+    buffer are lost if the process dies, so it is off by default.
+    """
+
+    def __init__(self, flush_interval: float = 0.2, max_batch: int = 500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stats = {'flushes': 0, 'messages': 0, 'errors': 0}
+
+    def add(self, *messages):
+        with self._lock:
+            self._pending.extend(messages)
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if not batch:
+            return
+        try:
+            write_messages(batch)
+        except Exception:
+            # One bad conversation id shouldn't sink everyone else's messages
+            logger.exception("Batched message write failed; retrying per conversation")
+            by_conversation = {}
+            for message in batch:
+                by_conversation.setdefault(message.conversation_id, []).append(message)
+            for messages in by_conversation.values():
+                try:
+                    write_messages(messages)
+                except Exception:
+                    with self._lock:
+                        self._stats['errors'] += 1
+                    logger.exception("Dropping %s messages for conversation %s",
+                                     len(messages), messages[0].conversation_id)
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['messages'] += len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._pending) < self.max_batch:
+                    self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending)}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_buffer():
+    """The shared write-behind buffer, or None when writes are synchronous"""
+    global _buffer
+    config = getattr(settings, 'CHAT_PERSISTENCE', {})
+    if not config.get('WRITE_BEHIND'):
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    flush_interval=config.get('FLUSH_INTERVAL', 0.2),
+                    max_batch=config.get('MAX_BATCH', 500),
+                )
+                metrics.register_stats('write_behind', _buffer.stats)
+    return _buffer
+
+
+def save_messages(*messages):
+    buffer = get_write_buffer()
+    if buffer is not None:
+        buffer.add(*messages)
+    else:
+        write_messages(list(messages))
+
+
+def record_user_message(conversation_id, content: str, user_email: str):
+    """Persist the user's message before the reply starts streaming"""
+    # Buffered writes can't report a bad conversation id back to the caller
+    if get_write_buffer() is not None and not Conversation.objects.filter(pk=conversation_id).exists():
+        raise Conversation.DoesNotExist("Conversation matching query does not exist.")
+    save_messages(Message(conversation_id=conversation_id, content=content, user_email=user_email))
+
+
+def record_reply(conversation_id, content: str):
+    save_messages(Message(conversation_id=conversation_id, content=content))
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import re
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .bedrock import BedrockAgent
+from .scheduler import BACKGROUND
+from .context import invalidate_user_context
+from .models import ProfileFact
+from .text import normalize_message
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_PROMPT = """Based on this conversation, extract any important information about the user's:
+        - Goals
+        - Preferences
+        - Challenges
+        - Important life events
+        - First Name
+
+        {turns}
+
+        Format your response EXACTLY as a JSON object with these categories as keys, or return an empty JSON object if no important information found.
+        Example: {{"goals": ["wants to work out daily"], "challenges": ["finding time to exercise"], "first name": ["james"], "preferences": ["speak in english only"], "important life events": ["father is in the hospital"]}}
+        Only respond with the JSON object, nothing else."""
+
+
+# Phrases that usually introduce a goal, challenge, life event, name or preference (English and Spanish)
+PROFILE_CUES = re.compile(r"""\b(?:
+    my\ name|call\ me|i'?m\ called|me\ llamo|mi\ nombre
+    |want(?:ed)?\ to|goal|plan(?:ning)?\ to|trying\ to|hope\ to|would\ like|i'?d\ like|wish|dream
+    |quiero|quisiera|meta|objetivo|espero
+    |struggl\w*|hard|difficult|can'?t|cannot|stress\w*|anxi\w*|worr\w*|afraid|scared|lonely|depress\w*
+    |tired|sick|pain|problem|addict\w*|insomnia|problema|difícil|dificil|ansiedad|miedo|cansad\w*
+    |died|passed\ away|funeral|divorc\w*|married|wedding|pregnan\w*|baby|born|new\ job|lost\ my|fired
+    |laid\ off|moved|moving|hospital|surgery|diagnos\w*|graduat\w*|broke\ up|breakup|retir\w*
+    |murió|falleció|embarazada|boda|trabajo|mudé|cirugía
+    |i\ prefer|i\ (?:really\ )?(?:like|love|hate|enjoy)|don'?t\ like|prefiero|me\ gusta|odio
+    |speak\ in|in\ (?:english|spanish)|en\ (?:inglés|español)
+)""", re.IGNORECASE | re.VERBOSE)
+
+FIRST_PERSON = re.compile(r"\b(?:i|i'm|i've|my|me|mine|yo|mi|mis)\b", re.IGNORECASE)
+
+
+def should_extract(message: str, long_message_chars: int = 200) -> bool:
+    """Cheap local guess at whether a turn tells us something new about the user.
+
+    Messages with a cue phrase ("I want to", "my dad died") might; long
+    first-person messages get the benefit of the doubt; acknowledgements
+    like "ok thanks" and small talk are skipped.
+    """
+    text = normalize_message(message or '')
+    if PROFILE_CUES.search(text):
+        return True
+    return len(text) >= long_message_chars and bool(FIRST_PERSON.search(text))
+
+
+def build_extraction_prompt(turns) -> str:
+    """Fold one or more (user message, bot response) turns into a single prompt"""
+    lines = []
+    for message, response in turns:
+        lines.append(f"Previous message: {message}")
+        lines.append(f"Bot response: {response}")
+    return EXTRACTION_PROMPT.format(turns="\n        ".join(lines))
+
+
+def fact_key(item: str) -> str:
+    return hashlib.sha1(normalize_message(item).encode('utf-8')).hexdigest()
+
+
+def record_facts(user_email: str, info: dict, seen_at=None) -> int:
+    """Add extracted facts to the user's profile; returns how many were new.
+
+    Facts already known get their ``mentions`` bumped and ``last_seen``
+    refreshed in one UPDATE; the rest go in with a single INSERT ... ON
+    CONFLICT DO NOTHING, so concurrent workers never overwrite each other
+    and the cost is independent of how big the profile already is.
+    """
+    seen_at = seen_at or timezone.now()
+    facts = {}
+    for category, items in info.items():
+        if not isinstance(items, list):  # Verify items is a list
+            continue
+        category = str(category).strip().lower()[:100]
+        for item in items:
+            item = str(item).strip()
+            if category and item and normalize_message(item):
+                facts.setdefault((category, fact_key(item)), item)
+    if not facts:
+        return 0
+
+    match = Q()
+    for category, key in facts:
+        match |= Q(category=category, item_key=key)
+    known = ProfileFact.objects.filter(match, user_email=user_email)
+    existing = {(category, key): pk for pk, category, key in known.values_list('id', 'category', 'item_key')}
+    if existing:
+        ProfileFact.objects.filter(pk__in=existing.values()).update(mentions=F('mentions') + 1, last_seen=seen_at)
+    new = [
+        ProfileFact(user_email=user_email, category=category, item=item, item_key=key,
+                    first_seen=seen_at, last_seen=seen_at)
+        for (category, key), item in facts.items() if (category, key) not in existing
+    ]
+    # A fact inserted by a concurrent worker since the lookup above is simply skipped
+    ProfileFact.objects.bulk_create(new, ignore_conflicts=True)
+    return len(new)
+
+
+def update_user_profile(user_email: str, turns, bedrock: BedrockAgent = None, lease=None):
+    """Extract profile facts from a batch of turns and merge them into the profile.
+
+    Upstream failures are raised so the job queue can retry them; a reply
+    that isn't valid JSON is logged and dropped since retrying won't help.
+    Facts are only recorded while ``lease()`` (from the job queue) holds.
+    """
+    bedrock = bedrock or BedrockAgent()
+    extraction = bedrock.generate_response(build_extraction_prompt(turns), user_email, raise_errors=True,
+                                          lane=BACKGROUND)
+    # Clean the response to ensure it's valid JSON
+    extraction = extraction.strip()
+    if not extraction:
+        return
+    try:
+        info = json.loads(extraction)
+    except json.JSONDecodeError as e:
+        logger.warning("Failed to parse extraction response for %s: %s", user_email, e)
+        return
+    if not isinstance(info, dict):  # Verify we got a valid dictionary
+        return
+
+    with transaction.atomic():
+        if lease is not None and not lease():
+            logger.warning("Dropping profile facts for %s: the batch was reclaimed by another worker", user_email)
+            return
+        # Repeat mentions only reorder facts; the cached context catches up when it expires
+        if record_facts(user_email, info):
+            transaction.on_commit(lambda: invalidate_user_context(user_email))
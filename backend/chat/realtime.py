@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from urllib.parse import parse_qs
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from .instrumentation import VOICE_DECODES, VOICE_FINAL_LATENCY, VOICE_SESSIONS
+from .language import get_language, remember_language
+from .stt import SAMPLE_RATE, TranscriptionQueueFull, get_transcription_pool, resample, stt_config, trim_silence
+
+logger = logging.getLogger(__name__)
+
+VOICE_PATH = '/ws/chat/voice/'
+
+
+def voice_config() -> dict:
+    return getattr(settings, 'CHAT_VOICE', {})
+
+
+class LiveTranscript:
+    """Sliding-window decoding of a recording that is still being made.
+
+    PCM arrives in small frames; ``window()`` is the audio since the last
+    committed point, which is decoded again as it grows so the partial text
+    keeps up with the speaker. Once the window reaches ``max_window_seconds``
+    everything but its last Whisper segment is committed and dropped, so each
+    decode stays within one 30 s Whisper window however long the recording.
+    State is only touched on the event loop; ``prepare``, which resamples and
+    checks a window for speech, runs on a worker thread, and decoding happens
+    on the shared transcription pool.
+    """
+
+    def __init__(self, rate: int = SAMPLE_RATE, language: str = None, step_seconds: float = 1.0,
+                 max_window_seconds: float = 20.0, min_speech_seconds: float = 0.3):
+        self.rate = rate
+        self.language = language
+        self.step = int(step_seconds * rate)
+        self.max_window = int(max_window_seconds * rate)
+        self.min_speech = int(min_speech_seconds * SAMPLE_RATE)
+        self.chunks = deque()
+        self.buffered = 0
+        self.decoded_at = 0
+        self.received = 0
+        self.committed = []
+        self.partial = ''
+
+    def feed(self, data: bytes):
+        """Add little-endian 16-bit mono PCM at ``rate``"""
+        samples = np.frombuffer(data[:len(data) // 2 * 2], '<i2').astype(np.float32) / 32768.0
+        self.chunks.append(samples)
+        self.buffered += len(samples)
+        self.received += len(samples)
+
+    @property
+    def received_seconds(self) -> float:
+        return self.received / self.rate
+
+    def due(self) -> bool:
+        return self.buffered - self.decoded_at >= self.step
+
+    def window(self):
+        """(frames since the last committed point, samples they hold at ``rate``); hand the frames to ``prepare``"""
+        self.decoded_at = self.buffered
+        return list(self.chunks), self.buffered
+
+    def prepare(self, chunks):
+        """16 kHz audio of a window's frames, or None if it holds no speech; safe off the event loop"""
+        audio = np.concatenate(chunks) if chunks else np.zeros(0, np.float32)
+        window = resample(audio, self.rate)
+        if len(trim_silence(window)) < self.min_speech:
+            return None
+        return window
+
+    def skip(self, samples: int):
+        """A window of ``samples`` held no speech"""
+        if samples >= self.max_window:
+            # A long stretch of silence; nothing in it is worth keeping
+            self._drop(samples)
+
+    def _drop(self, samples: int):
+        remaining = min(samples, self.buffered)
+        self.buffered -= remaining
+        self.decoded_at = max(0, self.decoded_at - remaining)
+        while remaining and remaining >= len(self.chunks[0]):
+            remaining -= len(self.chunks.popleft())
+        if remaining:
+            self.chunks[0] = self.chunks[0][remaining:]
+
+    def apply(self, result: dict, samples: int, final: bool = False) -> str:
+        """Take a decode of the first ``samples`` of the window; returns the transcript so far"""
+        self.language = self.language or result.get('language')
+        text = result.get('text', '').strip()
+        segments = result.get('segments') or []
+        if final or samples >= self.max_window:
+            if not final and len(segments) > 1:
+                # The last segment may still be mid-word; keep its audio for the next window
+                text = ''.join(segment['text'] for segment in segments[:-1]).strip()
+                samples = min(samples, int(segments[-1]['start'] * self.rate))
+            if text:
+                self.committed.append(text)
+            self._drop(samples)
+            self.partial = ''
+        else:
+            self.partial = text
+        return self.text
+
+    @property
+    def text(self) -> str:
+        return ' '.join(self.committed + ([self.partial] if self.partial else []))
+
+
+async def _decode(pool, live: LiveTranscript, final: bool = False):
+    chunks, samples = live.window()
+    audio = await asyncio.to_thread(live.prepare, chunks)
+    if audio is None:
+        live.skip(samples)
+        return None
+    started = time.perf_counter()
+    future = pool.submit_all([audio], language=live.language)[0]
+    result = await asyncio.wrap_future(future)
+    VOICE_DECODES.inc(kind='final' if final else 'partial')
+    logger.debug("Decoded %.1fs of live audio in %.2fs", len(audio) / SAMPLE_RATE, time.perf_counter() - started)
+    return live.apply(result, samples, final)
+
+
+async def _send_json(send, payload: dict):
+    await send({'type': 'websocket.send', 'text': json.dumps(payload)})
+
+
+async def _reply(send, conversation_id, text: str, user_email: str):
+    """Run the chat turn for the final transcript and forward its frames over the socket"""
+    from .views import MessageView
+    turn = await sync_to_async(MessageView().start_turn)(conversation_id, text, user_email, asynchronous=True)
+    if not hasattr(turn, '__aiter__'):
+        await _send_json(send, {'type': 'error', 'status': turn.status_code, **turn.data})
+        return
+    async for frame in turn:
+        # Same payloads as the SSE stream: {"chunk": ...}, {"error": ...}
+        await _send_json(send, {'type': 'reply', **json.loads(frame[len('data: '):])})
+    await _send_json(send, {'type': 'done'})
+
+
+async def _partial(send, pool, live: LiveTranscript):
+    try:
+        text = await _decode(pool, live)
+    except TranscriptionQueueFull:
+        # The pool is saturated; skip this partial and try again with more audio
+        return
+    if text is not None:
+        await _send_json(send, {'type': 'partial', 'text': text})
+
+
+async def voice_socket(scope, receive, send):
+    """WebSocket for live voice input.
+
+    Connect to ``/ws/chat/voice/?user_email=...&conversationId=...`` (plus
+    optionally ``rate`` for PCM not at 16 kHz, ``language`` and ``reply=1``),
+    then send binary frames of 16-bit little-endian mono PCM. The server sends
+    ``{"type": "partial", "text"}`` as it decodes. Send ``{"type": "stop"}``
+    when the user is done: the server answers ``{"type": "final", "text",
+    "language"}`` and, with ``reply``, streams the chat reply as ``{"type":
+    "reply", "chunk"}`` frames and ``{"type": "done"}`` before closing.
+    """
+    config = voice_config()
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if scope['path'] != VOICE_PATH or not config.get('ENABLED', True):
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    params = {key: values[-1] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+    user_email = params.get('user_email') or 'guest'
+    conversation_id = params.get('conversationId')
+    try:
+        rate = int(params.get('rate', SAMPLE_RATE))
+    except ValueError:
+        rate = 0
+    if not 8000 <= rate <= 48000:
+        await send({'type': 'websocket.close', 'code': 4400})
+        return
+    await send({'type': 'websocket.accept'})
+
+    language = params.get('language') or await sync_to_async(get_language)(user_email, conversation_id)
+    live = LiveTranscript(
+        rate=rate,
+        language=None if language == 'auto' else language,
+        step_seconds=config.get('STEP_SECONDS', 1.0),
+        max_window_seconds=config.get('MAX_WINDOW_SECONDS', 20.0),
+        min_speech_seconds=stt_config().get('MIN_SPEECH_SECONDS', 0.3),
+    )
+    pool = get_transcription_pool()
+    max_seconds = config.get('MAX_SECONDS', 300)
+    idle_seconds = config.get('IDLE_SECONDS', 30)
+    decoding = None
+    outcome = 'disconnected'
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(receive(), idle_seconds)
+            except asyncio.TimeoutError:
+                # A client that stopped sending would otherwise hold its audio and the socket forever
+                outcome = 'idle'
+                await _send_json(send, {'type': 'error', 'error': f"No audio for {idle_seconds}s"})
+                break
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message.get('bytes'):
+                live.feed(message['bytes'])
+                if live.received_seconds > max_seconds:
+                    outcome = 'too_long'
+                    await _send_json(send, {'type': 'error', 'error': f"Recordings are limited to {max_seconds}s"})
+                    break
+                # One decode in flight per socket; audio that arrives meanwhile goes into the next one
+                if (decoding is None or decoding.done()) and live.due():
+                    decoding = asyncio.ensure_future(_partial(send, pool, live))
+                continue
+
+            control = json.loads(message.get('text') or '{}')
+            if control.get('type') != 'stop':
+                continue
+            stopped = time.perf_counter()
+            if decoding is not None:
+                await asyncio.gather(decoding, return_exceptions=True)
+            try:
+                text = await _decode(pool, live, final=True)
+            except TranscriptionQueueFull:
+                outcome = 'busy'
+                await _send_json(send, {'type': 'error', 'error': "Transcription is busy, try again shortly"})
+                break
+            text = live.text if text is None else text
+            VOICE_FINAL_LATENCY.observe(time.perf_counter() - stopped)
+            if live.language:
+                await sync_to_async(remember_language)(live.language, user_email, conversation_id)
+            await _send_json(send, {'type': 'final', 'text': text, 'language': live.language})
+            outcome = 'ok'
+            if text and (control.get('reply') or params.get('reply') in ('1', 'true')):
+                await _reply(send, conversation_id, text, user_email)
+            break
+    except Exception:
+        outcome = 'error'
+        logger.exception("Voice socket failed")
+        await _send_json(send, {'type': 'error', 'error': "Transcription failed"})
+    finally:
+        if decoding is not None and not decoding.done():
+            decoding.cancel()
+        VOICE_SESSIONS.inc(outcome=outcome)
+        await sync_to_async(close_old_connections)()
+    if outcome != 'disconnected':
+        await send({'type': 'websocket.close', 'code': 1000})
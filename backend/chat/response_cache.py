@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .instrumentation import registry as metrics
+from .text import normalize_message
+
+logger = logging.getLogger(__name__)
+
+
+def response_cache_config() -> dict:
+    return getattr(settings, 'CHAT_RESPONSE_CACHE', {})
+
+
+class CachedStream:
+    """Upstream chunks for one turn: replayed from the cache on a hit, recorded into it on a miss.
+
+    The lookup happens on iteration, so it runs wherever the stream is
+    drained (a worker thread under ASGI). ``hit`` tells the caller afterwards
+    whether the agent was called at all.
+    """
+
+    def __init__(self, cache, key: str, upstream):
+        self.cache = cache
+        self.key = key
+        self.upstream = upstream
+        self.hit = False
+
+    def __iter__(self):
+        chunks = self.cache.get(self.key)
+        if chunks is not None:
+            self.hit = True
+            self.upstream.close()
+            yield from self.cache.replay(chunks)
+            return
+        chunks = []
+        for chunk in self.upstream:
+            chunks.append(chunk)
+            yield chunk
+        self.cache.store(self.key, chunks)
+
+
+class ResponseCache:
+    """Caches whole agent replies to context-free first turns ("hi", "hello", ...).
+
+    Only turns without profile context or conversation history are
+    eligible, so a cached reply never carries one user's details to another.
+    Storage is a Django cache alias: locmem (per process, LRU with TTL),
+    file, or Redis to share it between workers.
+    """
+
+    def __init__(self, cache, timeout: int = 3600, max_message_chars: int = 120, replay_delay: float = 0.0):
+        self.cache = cache
+        self.timeout = timeout
+        self.max_message_chars = max_message_chars
+        self.replay_delay = replay_delay
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'skipped': 0, 'errors': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def key_for(self, message: str, context: str = ''):
+        """Cache key for a first turn, or None when the turn isn't eligible.
+
+        ``context`` is everything else that shapes the reply (the prompt
+        around the message, agent id/alias); it goes into the key as a hash.
+        """
+        normalized = normalize_message(message or '')
+        if not normalized or len(normalized) > self.max_message_chars:
+            self._count('skipped')
+            return None
+        context_hash = hashlib.sha256(context.encode('utf-8')).hexdigest()[:16]
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return f'chat-reply:{context_hash}:{digest}'
+
+    def skip(self):
+        """Count a turn that wasn't eligible (profile context or history)"""
+        self._count('skipped')
+
+    def get(self, key: str):
+        try:
+            chunks = self.cache.get(key)
+        except Exception:
+            # A cache outage degrades to calling the agent
+            logger.warning("Response cache lookup failed", exc_info=True)
+            self._count('errors')
+            chunks = None
+        self._count('hits' if chunks is not None else 'misses')
+        return chunks
+
+    def store(self, key: str, chunks):
+        text = ''.join(chunks)
+        # invoke_agent reports upstream failures in-band as "Error: ..."; those mustn't be replayed
+        if not text.strip() or text.startswith('Error:'):
+            return
+        try:
+            self.cache.set(key, list(chunks), self.timeout)
+        except Exception:
+            logger.warning("Response cache store failed", exc_info=True)
+            self._count('errors')
+            return
+        self._count('stores')
+
+    def replay(self, chunks):
+        # Same chunks as the original stream, so the reply renders exactly as a live one
+        for index, chunk in enumerate(chunks):
+            if index and self.replay_delay:
+                time.sleep(self.replay_delay)
+            yield chunk
+
+    def stream(self, key: str, upstream) -> CachedStream:
+        return CachedStream(self, key, upstream)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The shared response cache, or None unless CHAT_RESPONSE_CACHE['ENABLED']"""
+    global _cache
+    config = response_cache_config()
+    if not config.get('ENABLED'):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    caches[config.get('CACHE', 'chat_responses')],
+                    timeout=config.get('TIMEOUT', 3600),
+                    max_message_chars=config.get('MAX_MESSAGE_CHARS', 120),
+                    replay_delay=config.get('REPLAY_DELAY', 0.0),
+                )
+                metrics.register_stats('response_cache', _cache.stats)
+    return _cache
@@ -0,0 +1,352 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from .instrumentation import CHAT_STREAMS_DETACHED, registry as metrics
+
+
+def resume_config() -> dict:
+    return getattr(settings, 'CHAT_STREAM_RESUME', {})
+
+
+def new_stream_id() -> str:
+    # Unguessable: anyone holding the id can read the reply
+    return uuid.uuid4().hex
+
+
+def sse_event(payload: dict, event_id: str = None) -> str:
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+
+def parse_event_id(value: str):
+    """``(stream_id, seq)`` from a Last-Event-ID header, or None"""
+    stream_id, _, seq = (value or '').strip().rpartition(':')
+    if not stream_id or not seq.isdigit():
+        return None
+    return stream_id, int(seq)
+
+
+class _Stream:
+    __slots__ = ('frames', 'last', 'done', 'expires', 'waiters')
+
+    def __init__(self, expires: float):
+        self.frames = []
+        self.last = 0
+        self.done = False
+        self.expires = expires
+        self.waiters = []
+
+
+class MemoryReplayStore:
+    """Frames of in-flight and recent replies, kept in this process.
+
+    Each stream holds its newest ``max_frames`` frames and is forgotten
+    ``ttl`` seconds after its last frame (or once ``max_streams`` newer
+    streams exist). Readers that have caught up block in ``wait`` (or
+    ``await_frames`` on an event loop) until the producer appends.
+    """
+    blocking = False
+
+    def __init__(self, ttl: float = 300, max_frames: int = 1000, max_streams: int = 10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_frames = max_frames
+        self.max_streams = max_streams
+        self.clock = clock
+        self._streams = {}  # least recently appended first
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stats = {'streams': 0, 'frames': 0, 'expired': 0}
+
+    def _purge(self, now: float):
+        while self._streams:
+            stream_id, stream = next(iter(self._streams.items()))
+            if stream.expires > now and len(self._streams) <= self.max_streams:
+                break
+            del self._streams[stream_id]
+            self._stats['expired'] += 1
+
+    def _touch(self, stream_id: str, stream: _Stream):
+        # Re-inserted last, so expiry can stop at the first live stream
+        del self._streams[stream_id]
+        self._streams[stream_id] = stream
+        stream.expires = self.clock() + self.ttl
+        self._changed.notify_all()
+        for loop, future in stream.waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # The reader's event loop is gone
+        stream.waiters.clear()
+
+    def open(self, stream_id: str):
+        now = self.clock()
+        with self._lock:
+            self._purge(now)
+            self._streams[stream_id] = _Stream(now + self.ttl)
+            self._stats['streams'] += 1
+
+    def append(self, stream_id: str, payload: dict) -> int:
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                return 0
+            stream.last += 1
+            stream.frames.append((stream.last, payload))
+            if len(stream.frames) > self.max_frames:
+                del stream.frames[0]
+            self._stats['frames'] += 1
+            self._touch(stream_id, stream)
+            return stream.last
+
+    def finish(self, stream_id: str):
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is not None:
+                stream.done = True
+                self._touch(stream_id, stream)
+
+    def _read(self, stream_id: str, after: int):
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.expires <= self.clock():
+            return None
+        first = stream.frames[0][0] if stream.frames else stream.last + 1
+        if after + 1 < first or after > stream.last:
+            return None  # Frames already dropped, or an id this stream never sent
+        return [frame for frame in stream.frames if frame[0] > after], stream.done
+
+    def read(self, stream_id: str, after: int = 0):
+        """``(frames after seq ``after``, done)``, or None if the stream can't be resumed from there"""
+        with self._lock:
+            return self._read(stream_id, after)
+
+    def wait(self, stream_id: str, after: int, timeout: float):
+        with self._lock:
+            deadline = self.clock() + timeout
+            while True:
+                found = self._read(stream_id, after)
+                if found is None or found[0] or found[1]:
+                    return found
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return found
+                self._changed.wait(remaining)
+
+    async def await_frames(self, stream_id: str, after: int, timeout: float):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            found = self._read(stream_id, after)
+            if found is None or found[0] or found[1]:
+                return found
+            self._streams[stream_id].waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.read(stream_id, after)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'active': len(self._streams)}
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class CacheReplayStore:
+    """Frames kept in a Django cache, so a reconnect can land on any worker or node.
+
+    One key per frame plus a head key holding the newest sequence number; only
+    the process producing a stream writes to it. Readers poll every
+    ``poll_seconds`` while waiting for new frames.
+    """
+    blocking = True
+
+    def __init__(self, cache, ttl: float = 300, max_frames: int = 1000, poll_seconds: float = 0.1):
+        self.cache = cache
+        self.ttl = ttl
+        self.max_frames = max_frames
+        self.poll_seconds = poll_seconds
+        self._last = {}  # streams this process is producing
+        self._lock = threading.Lock()
+        self._stats = {'streams': 0, 'frames': 0}
+
+    def _key(self, stream_id: str, seq: int = None) -> str:
+        return f'chat-stream:{stream_id}' if seq is None else f'chat-stream:{stream_id}:{seq}'
+
+    def open(self, stream_id: str):
+        with self._lock:
+            self._last[stream_id] = 0
+            self._stats['streams'] += 1
+        self.cache.set(self._key(stream_id), {'last': 0, 'done': False}, self.ttl)
+
+    def append(self, stream_id: str, payload: dict) -> int:
+        with self._lock:
+            seq = self._last.get(stream_id, 0) + 1
+            self._last[stream_id] = seq
+            self._stats['frames'] += 1
+        # The frame first, so a reader never sees a head pointing past it
+        self.cache.set(self._key(stream_id, seq), payload, self.ttl)
+        self.cache.set(self._key(stream_id), {'last': seq, 'done': False}, self.ttl)
+        if seq > self.max_frames:
+            self.cache.delete(self._key(stream_id, seq - self.max_frames))
+        return seq
+
+    def finish(self, stream_id: str):
+        with self._lock:
+            last = self._last.pop(stream_id, 0)
+        self.cache.set(self._key(stream_id), {'last': last, 'done': True}, self.ttl)
+
+    def read(self, stream_id: str, after: int = 0):
+        head = self.cache.get(self._key(stream_id))
+        if head is None or after > head['last'] or after + 1 <= head['last'] - self.max_frames:
+            return None
+        keys = [self._key(stream_id, seq) for seq in range(after + 1, head['last'] + 1)]
+        found = self.cache.get_many(keys) if keys else {}
+        if len(found) < len(keys):
+            return None  # Frames expired under us
+        return [(seq, found[key]) for seq, key in zip(range(after + 1, head['last'] + 1), keys)], head['done']
+
+    def wait(self, stream_id: str, after: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            found = self.read(stream_id, after)
+            if found is None or found[0] or found[1] or time.monotonic() >= deadline:
+                return found
+            time.sleep(self.poll_seconds)
+
+    async def await_frames(self, stream_id: str, after: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            found = await asyncio.to_thread(self.read, stream_id, after)
+            if found is None or found[0] or found[1] or time.monotonic() >= deadline:
+                return found
+            await asyncio.sleep(self.poll_seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'active': len(self._last)}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_replay_store():
+    """The configured replay store, or None when resumable streams are off"""
+    global _store
+    config = resume_config()
+    if not config.get('ENABLED', True):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if config.get('BACKEND', 'memory') == 'cache':
+                    _store = CacheReplayStore(
+                        caches[config.get('CACHE', 'chat_streams')],
+                        ttl=config.get('TTL_SECONDS', 300),
+                        max_frames=config.get('MAX_FRAMES', 1000),
+                        poll_seconds=config.get('POLL_SECONDS', 0.1),
+                    )
+                else:
+                    _store = MemoryReplayStore(
+                        ttl=config.get('TTL_SECONDS', 300),
+                        max_frames=config.get('MAX_FRAMES', 1000),
+                        max_streams=config.get('MAX_STREAMS', 10000),
+                    )
+                metrics.register_stats('replay', _store.stats)
+    return _store
+
+
+def _event_id(stream_id: str, seq: int) -> str:
+    return f'{stream_id}:{seq}'
+
+
+def buffered(store, stream_id: str, frames):
+    """SSE events for the payloads of ``frames`` (sync or async), each also kept in ``store``.
+
+    If the client goes away the rest of the reply is still generated (and
+    persisted by ``frames``) into the store, where a reconnect picks it up.
+    The stream is opened here, so others can attach to it straight away.
+    """
+    store.open(stream_id)
+    if hasattr(frames, '__aiter__'):
+        return _abuffered(store, stream_id, frames)
+    return _buffered(store, stream_id, frames)
+
+
+def _buffered(store, stream_id: str, frames):
+    finished = False
+    try:
+        for payload in frames:
+            yield sse_event(payload, _event_id(stream_id, store.append(stream_id, payload)))
+        finished = True
+    finally:
+        if not finished:
+            CHAT_STREAMS_DETACHED.inc()
+            for payload in frames:
+                store.append(stream_id, payload)
+        store.finish(stream_id)
+
+
+_producers = set()
+
+
+async def _produce(store, stream_id: str, frames):
+    try:
+        async for payload in frames:
+            if store.blocking:
+                await asyncio.to_thread(store.append, stream_id, payload)
+            else:
+                store.append(stream_id, payload)
+    finally:
+        if store.blocking:
+            await asyncio.to_thread(store.finish, stream_id)
+        else:
+            store.finish(stream_id)
+
+
+async def _abuffered(store, stream_id: str, frames):
+    # The reply is generated by its own task, so a disconnect only stops this reader
+    producer = asyncio.ensure_future(_produce(store, stream_id, frames))
+    _producers.add(producer)
+    producer.add_done_callback(_producers.discard)
+    try:
+        async for event in areplay(store, stream_id):
+            yield event
+    finally:
+        if not producer.done():
+            CHAT_STREAMS_DETACHED.inc()
+
+
+def replay(store, stream_id: str, after: int = 0, wait_seconds: float = 15.0):
+    """SSE events of a stream after seq ``after``, following it until the reply ends"""
+    while True:
+        found = store.wait(stream_id, after, wait_seconds)
+        if found is None:
+            return
+        frames, done = found
+        for seq, payload in frames:
+            yield sse_event(payload, _event_id(stream_id, seq))
+            after = seq
+        if done:
+            return
+
+
+async def areplay(store, stream_id: str, after: int = 0, wait_seconds: float = 15.0):
+    while True:
+        found = await store.await_frames(stream_id, after, wait_seconds)
+        if found is None:
+            return
+        frames, done = found
+        for seq, payload in frames:
+            yield sse_event(payload, _event_id(stream_id, seq))
+            after = seq
+        if done:
+            return
@@ -0,0 +1,209 @@
+import collections
+import contextlib
+import logging
+import random
+import threading
+import time
+from django.conf import settings
+from .instrumentation import UPSTREAM_QUEUE_WAIT, UPSTREAM_REJECTED, UPSTREAM_THROTTLED, registry as metrics
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+LANES = (INTERACTIVE, BACKGROUND)
+
+# Error codes InvokeAgent uses when we're over quota
+THROTTLE_CODES = frozenset(['ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'])
+
+
+def upstream_config() -> dict:
+    return getattr(settings, 'CHAT_UPSTREAM', {})
+
+
+class UpstreamRejected(Exception):
+    """The call was not let through: ``reason`` is 'rate_limited' or 'queue_timeout'"""
+
+    def __init__(self, reason: str, retry_after: float = 1.0):
+        super().__init__(f"Upstream call rejected ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('lane', 'granted')
+
+    def __init__(self, lane: str):
+        self.lane = lane
+        self.granted = False
+
+
+class UpstreamScheduler:
+    """Admission control for agent calls in this process.
+
+    * ``admit(key)`` spends a token from the caller's bucket (``rate`` per
+      second, up to ``burst``) and rejects at once when it is empty, so a
+      retry storm is turned away before any work is done.
+    * ``slot(lane)`` holds one of the concurrent upstream slots for the
+      duration of a call. Interactive waiters are always served first;
+      background calls may hold at most ``background_share`` of the slots.
+      Waiters give up after their lane's timeout.
+    * A throttled call halves the concurrency limit and pauses new grants
+      for a jittered, exponentially growing backoff; each successful call
+      raises the limit again by about one slot per ``limit`` calls (AIMD).
+    """
+
+    def __init__(self, max_concurrent: int = 256, min_concurrent: int = 2, background_share: float = 0.25,
+                 timeouts: dict = None, rate: float = 0.5, burst: float = 5, backoff_seconds: float = 0.5,
+                 max_backoff_seconds: float = 30.0, max_buckets: int = 10000, clock=time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.min_concurrent = min(min_concurrent, max_concurrent)
+        self.background_share = background_share
+        self.timeouts = {INTERACTIVE: 10.0, BACKGROUND: 60.0, **(timeouts or {})}
+        self.rate = rate
+        self.burst = burst
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.limit = float(max_concurrent)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._waiting = {lane: collections.deque() for lane in LANES}
+        self._in_flight = {lane: 0 for lane in LANES}
+        self._buckets = {}
+        self._backoff = 0.0
+        self._paused_until = 0.0
+        self._stats = {'admitted': 0, 'rate_limited': 0, 'queue_timeouts': 0, 'throttled': 0, 'calls': 0}
+
+    # Per-caller token buckets
+
+    def admit(self, key: str):
+        """Spend one of ``key``'s tokens or raise UpstreamRejected('rate_limited')"""
+        if not key or self.rate <= 0:
+            return
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._stats['rate_limited'] += 1
+                UPSTREAM_REJECTED.inc(reason='rate_limited', lane=INTERACTIVE)
+                raise UpstreamRejected('rate_limited', retry_after=(1 - tokens) / self.rate)
+            # Re-inserted last, so the dict stays in least-recently-used order for trimming
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_buckets:
+                del self._buckets[next(iter(self._buckets))]
+            self._stats['admitted'] += 1
+
+    # Concurrency slots
+
+    def _capacity(self, lane: str) -> int:
+        limit = max(1, int(self.limit))
+        if lane == BACKGROUND:
+            return max(1, int(limit * self.background_share))
+        return limit
+
+    def _dispatch(self, now: float):
+        if now < self._paused_until:
+            return
+        for lane in LANES:
+            queue = self._waiting[lane]
+            while queue and sum(self._in_flight.values()) < self._capacity(INTERACTIVE) \
+                    and self._in_flight[lane] < self._capacity(lane):
+                waiter = queue.popleft()
+                waiter.granted = True
+                self._in_flight[lane] += 1
+                self._changed.notify_all()
+            if queue:
+                # Lower lanes wait while a higher one still has waiters
+                return
+
+    def acquire(self, lane: str = INTERACTIVE):
+        started = self.clock()
+        deadline = started + self.timeouts[lane]
+        waiter = _Waiter(lane)
+        with self._lock:
+            self._waiting[lane].append(waiter)
+            self._dispatch(started)
+            while not waiter.granted:
+                now = self.clock()
+                if now >= deadline:
+                    self._waiting[lane].remove(waiter)
+                    self._stats['queue_timeouts'] += 1
+                    UPSTREAM_REJECTED.inc(reason='queue_timeout', lane=lane)
+                    raise UpstreamRejected('queue_timeout', retry_after=max(1.0, self._paused_until - now))
+                wait = deadline - now
+                if self._paused_until > now:
+                    wait = min(wait, self._paused_until - now)
+                self._changed.wait(wait)
+                self._dispatch(self.clock())
+            self._stats['calls'] += 1
+        UPSTREAM_QUEUE_WAIT.observe(self.clock() - started, lane=lane)
+
+    def release(self, lane: str = INTERACTIVE, throttled: bool = False):
+        now = self.clock()
+        with self._lock:
+            self._in_flight[lane] -= 1
+            if throttled:
+                self._stats['throttled'] += 1
+                self.limit = max(self.min_concurrent, self.limit / 2)
+                self._backoff = min(self.max_backoff_seconds, self._backoff * 2 or self.backoff_seconds)
+                self._paused_until = max(self._paused_until, now + self._backoff * (0.5 + random.random() / 2))
+            else:
+                self.limit = min(self.max_concurrent, self.limit + 1 / self.limit)
+                self._backoff = 0.0
+            self._dispatch(now)
+            self._changed.notify_all()
+        if throttled:
+            UPSTREAM_THROTTLED.inc()
+            logger.warning("Upstream throttled; concurrency limit now %s", int(self.limit))
+
+    @contextlib.contextmanager
+    def slot(self, lane: str = INTERACTIVE):
+        """Hold an upstream slot; the body sets ``outcome['throttled']`` when the call was throttled"""
+        self.acquire(lane)
+        outcome = {'throttled': False}
+        try:
+            yield outcome
+        finally:
+            self.release(lane, outcome['throttled'])
+
+    def stats(self) -> dict:
+        now = self.clock()
+        with self._lock:
+            return {
+                **self._stats,
+                'limit': int(self.limit),
+                'in_flight': sum(self._in_flight.values()),
+                'waiting_interactive': len(self._waiting[INTERACTIVE]),
+                'waiting_background': len(self._waiting[BACKGROUND]),
+                'paused_seconds': max(0.0, self._paused_until - now),
+                'buckets': len(self._buckets),
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_upstream_scheduler() -> UpstreamScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                config = upstream_config()
+                _scheduler = UpstreamScheduler(
+                    max_concurrent=config.get('MAX_CONCURRENT', 256),
+                    min_concurrent=config.get('MIN_CONCURRENT', 2),
+                    background_share=config.get('BACKGROUND_SHARE', 0.25),
+                    timeouts={INTERACTIVE: config.get('INTERACTIVE_TIMEOUT', 10.0),
+                              BACKGROUND: config.get('BACKGROUND_TIMEOUT', 60.0)},
+                    rate=config.get('USER_RATE', 0.5),
+                    burst=config.get('USER_BURST', 5),
+                    backoff_seconds=config.get('BACKOFF_SECONDS', 0.5),
+                    max_backoff_seconds=config.get('MAX_BACKOFF_SECONDS', 30.0),
+                )
+                metrics.register_stats('upstream', _scheduler.stats)
+    return _scheduler
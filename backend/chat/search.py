@@ -0,0 +1,114 @@
+import html
+import re
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Cast
+from .models import Message
+from .pagination import decode_rank_cursor, encode_rank_cursor
+
+# Must match the configuration the trigger in migration 0005 indexes with
+SEARCH_CONFIG = 'english'
+# Highlight markers used inside the database/snippet code; swapped for <mark> after escaping
+_START, _STOP = '\x02', '\x03'
+_MAX_TERMS = 8
+_TERM = re.compile(r'[^\s"]+')
+
+
+def uses_full_text() -> bool:
+    """PostgreSQL full-text search, unless CHAT_SEARCH_BACKEND forces the LIKE fallback
+    (e.g. while ``backfill_search_vectors`` is still running)"""
+    backend = getattr(settings, 'CHAT_SEARCH_BACKEND', 'auto')
+    return backend != 'like' and connection.vendor == 'postgresql'
+
+
+def render_snippet(marked: str) -> str:
+    """HTML-escape a snippet, turning the highlight markers into <mark> tags"""
+    text = html.escape(marked)
+    return text.replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+
+def search_terms(text: str) -> list:
+    """Words for the LIKE fallback; websearch operators (``-word``, ``or``) are ignored"""
+    terms = []
+    for term in _TERM.findall(text):
+        term = term.lstrip('-')
+        if term and term.lower() != 'or' and term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms[:_MAX_TERMS]
+
+
+def build_snippet(content: str, terms, width: int = 160) -> str:
+    """A window of ``content`` around the first match, with every match marked"""
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(content)
+    start = 0
+    if match and len(content) > width:
+        start = max(0, min(match.start() - width // 3, len(content) - width))
+        # Don't open mid-word
+        space = content.rfind(' ', 0, start)
+        start = 0 if space < 0 else space + 1
+    end = min(len(content), start + width)
+    if end < len(content):
+        space = content.rfind(' ', start, end)
+        end = space if space > start else end
+    window = pattern.sub(lambda m: f'{_START}{m.group(0)}{_STOP}', content[start:end])
+    return ('… ' if start else '') + window + (' …' if end < len(content) else '')
+
+
+def _full_text(messages, text: str, cursor):
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    messages = messages.filter(search_vector=query).annotate(
+        # ts_rank returns real; as double precision the value survives the cursor round trip exactly
+        rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+        snippet=SearchHeadline(
+            'content', query, config=SEARCH_CONFIG, start_sel=_START, stop_sel=_STOP,
+            max_words=30, min_words=10, max_fragments=2, fragment_delimiter=' … ',
+        ),
+    ).order_by('-rank', '-id')
+    if cursor:
+        rank, pk = decode_rank_cursor(cursor)
+        messages = messages.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+    return messages, lambda message: message.snippet
+
+
+def _like(messages, text: str, cursor):
+    terms = search_terms(text)
+    if not terms:
+        return messages.none(), None
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    messages = messages.annotate(rank=Value(0.0, output_field=FloatField())).order_by('-id')
+    if cursor:
+        _, pk = decode_rank_cursor(cursor)
+        messages = messages.filter(id__lt=pk)
+    return messages, lambda message: build_snippet(message.content, terms)
+
+
+def search_messages(user_email: str, text: str, limit: int, cursor: str = None):
+    """One page of ``user_email``'s messages matching ``text``, best match first.
+
+    Returns (results, next_cursor); raises InvalidCursor for a bad cursor.
+    Without PostgreSQL, matching falls back to case-insensitive substrings
+    of every term, newest first.
+    """
+    messages = Message.objects.filter(conversation__user_email=user_email).only(
+        'id', 'conversation_id', 'content', 'user_email', 'timestamp'
+    )
+    search = _full_text if uses_full_text() else _like
+    messages, snippet = search(messages, text, cursor)
+    page = list(messages[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    results = [{
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'user_email': message.user_email,
+        'timestamp': message.timestamp,
+        'rank': message.rank,
+        'snippet': render_snippet(snippet(message)),
+    } for message in page]
+    next_cursor = encode_rank_cursor(page[-1].rank, page[-1].id) if has_more else None
+    return results, next_cursor
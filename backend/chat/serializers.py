@@ -2,6 +2,9 @@ from rest_framework import serializers
 from .models import Feedback, Conversation, Message
 
 class FeedbackSerializer(serializers.ModelSerializer):
+    # The UI's star rating; bounded so the analytics rollup has a fixed set of buckets
+    rating = serializers.IntegerField(min_value=1, max_value=5)
+
     class Meta:
         model = Feedback
         fields = ['feedback_type', 'message', 'rating', 'user_email']
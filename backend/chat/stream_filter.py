@@ -0,0 +1,246 @@
+import asyncio
+import json
+import re
+import time
+
+# Keys of the profile-extraction payload the agent sometimes leaks into replies
+PROFILE_KEYS = frozenset(['goals', 'preferences', 'challenges', 'important life events', 'first name'])
+
+_SPECIAL = re.compile(r'[{}"\\]')
+_OPEN, _CLOSED, _REJECTED = 'open', 'closed', 'rejected'
+
+
+def is_profile_payload(text: str) -> bool:
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(value, dict) and any(str(key).lower() in PROFILE_KEYS for key in value)
+
+
+class StructuredPayloadFilter:
+    """Drops leaked profile JSON from streamed text, even when it spans chunks.
+
+    Text outside a candidate object passes straight through. From a ``{``
+    followed by ``"`` or ``}``, text is held while braces balance (string- and
+    escape-aware); the complete object is parsed once and dropped if it is a
+    profile payload, otherwise released unchanged. Anything that stops looking
+    like JSON, or grows past ``max_hold`` characters, is released as is.
+    """
+
+    def __init__(self, max_hold: int = 8192):
+        self.max_hold = max_hold
+        self._held = []
+        self._held_size = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expect_key = False
+
+    def _scan(self, text: str, pos: int):
+        length = len(text)
+        while pos < length:
+            if self._escaped:
+                self._escaped = False
+                pos += 1
+                continue
+            if self._expect_key:
+                char = text[pos]
+                if char in ' \t\r\n':
+                    pos += 1
+                    continue
+                if char != '"' and char != '}':
+                    return pos, _REJECTED
+                self._expect_key = False
+            match = _SPECIAL.search(text, pos)
+            if match is None:
+                return length, _OPEN
+            pos = match.start()
+            char = text[pos]
+            if char == '\\':
+                self._escaped = self._in_string
+            elif char == '"':
+                self._in_string = not self._in_string
+            elif not self._in_string:
+                if char == '{':
+                    self._depth += 1
+                    self._expect_key = True
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        return pos + 1, _CLOSED
+            pos += 1
+        return pos, _OPEN
+
+    def _release(self) -> str:
+        held = ''.join(self._held)
+        self._held = []
+        self._held_size = 0
+        self._depth = 0
+        self._in_string = self._escaped = self._expect_key = False
+        return held
+
+    def feed(self, text: str) -> str:
+        """Return the part of ``text`` (plus anything released from earlier chunks) that is safe to send"""
+        out = []
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if not self._depth:
+                start = text.find('{', pos)
+                if start < 0:
+                    out.append(text[pos:])
+                    break
+                out.append(text[pos:start])
+                self._depth = 1
+                self._expect_key = True
+                segment, pos = start, start + 1
+            else:
+                segment = pos
+            pos, state = self._scan(text, pos)
+            self._held.append(text[segment:pos])
+            self._held_size += pos - segment
+            if state == _CLOSED:
+                candidate = self._release()
+                if not is_profile_payload(candidate):
+                    out.append(candidate)
+            elif state == _REJECTED or self._held_size > self.max_hold:
+                out.append(self._release())
+        return ''.join(out)
+
+    def finish(self) -> str:
+        """Release whatever is still held when the stream ends (an unterminated object isn't a payload)"""
+        return self._release()
+
+
+class ChunkCoalescer:
+    """Merges tiny upstream chunks into fewer SSE frames.
+
+    The first text goes out immediately so time-to-first-chunk is unchanged;
+    after that text is buffered until ``flush_size`` characters or
+    ``flush_interval`` seconds have accumulated. ``flush_size=0`` and
+    ``flush_interval=0`` send every chunk as it arrives.
+    """
+
+    def __init__(self, flush_size: int = 256, flush_interval: float = 0.05, clock=time.monotonic):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._parts = []
+        self._size = 0
+        self._since = None
+        self._sent = False
+
+    def add(self, text: str):
+        if not text:
+            return None
+        self._parts.append(text)
+        self._size += len(text)
+        if self._since is None:
+            self._since = self.clock()
+        if not self._sent or self._size >= self.flush_size or self.clock() - self._since >= self.flush_interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._since = None
+        self._sent = True
+        return text
+
+    def due_in(self):
+        """Seconds until buffered text should go out, or None when nothing is buffered"""
+        if self._since is None:
+            return None
+        return max(0.0, self.flush_interval - (self.clock() - self._since))
+
+
+class ReplyStream:
+    """Filter, coalesce and accumulate one streamed reply"""
+
+    def __init__(self, flush_size: int = 256, flush_interval: float = 0.05):
+        self.filter = StructuredPayloadFilter()
+        self.coalescer = ChunkCoalescer(flush_size, flush_interval)
+        self._parts = []
+
+    def feed(self, chunk: str):
+        """Returns text to send now, or None"""
+        text = self.filter.feed(chunk)
+        if not text:
+            return None
+        self._parts.append(text)
+        return self.coalescer.add(text)
+
+    def flush(self):
+        return self.coalescer.flush()
+
+    def due_in(self):
+        return self.coalescer.due_in()
+
+    def finish(self):
+        """Returns the last text to send, or None"""
+        buffered = self.coalescer.flush() or ''
+        text = self.filter.finish()
+        if text:
+            self._parts.append(text)
+        return (buffered + text) or None
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._parts)
+
+
+def coalesce(upstream, reply: ReplyStream):
+    """Yield the text to send for each upstream chunk.
+
+    Buffered text is flushed when the next chunk arrives (a blocking iterator
+    gives no chance to do it sooner) and when the stream ends.
+    """
+    for chunk in upstream:
+        text = reply.feed(chunk)
+        if text:
+            yield text
+    text = reply.finish()
+    if text:
+        yield text
+
+
+async def acoalesce(upstream, reply: ReplyStream):
+    """Async ``coalesce`` that also flushes buffered text on time while upstream is quiet"""
+    pending = None
+    try:
+        while True:
+            due = reply.due_in()
+            if due is None and pending is None:
+                # Nothing buffered: await upstream directly rather than paying for a Task per chunk
+                try:
+                    chunk = await upstream.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(upstream.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=due)
+                if not done:
+                    text = reply.flush()
+                    if text:
+                        yield text
+                    continue
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+            text = reply.feed(chunk)
+            if text:
+                yield text
+        text = reply.finish()
+        if text:
+            yield text
+    finally:
+        if pending is not None:
+            pending.cancel()
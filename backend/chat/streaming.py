@@ -0,0 +1,133 @@
+import asyncio
+import concurrent.futures
+import threading
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signals
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_stream_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Threads that drain blocking upstream iterators for async responses.
+
+    boto3 has no async API, so each in-flight upstream stream still blocks one
+    thread on its socket. Those threads are kept off the event loop and out of
+    Django's thread-sensitive executor; everything else about the response is
+    handled by the event loop.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'CHAT_STREAM_THREADS', 1024),
+                    thread_name_prefix='chat-stream'
+                )
+    return _executor
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+async def iterate_in_thread(factory, max_buffered: int = 8, executor=None):
+    """Consume the sync iterator returned by ``factory()`` from async code.
+
+    At most ``max_buffered`` items are in flight: when the consumer falls
+    behind, the producer thread blocks and stops reading upstream
+    (backpressure). If the consumer goes away (a client disconnect cancels the
+    response), the producer stops at the next item and closes the upstream
+    iterator.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    slots = threading.Semaphore(max_buffered)
+    cancelled = threading.Event()
+
+    def put(item) -> bool:
+        while not slots.acquire(timeout=0.5):
+            if cancelled.is_set():
+                return False
+        try:
+            # Cheaper than run_coroutine_threadsafe: no Task or Future per item
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            return False  # Event loop already closed
+        return True
+
+    def produce():
+        iterator = iter(factory())
+        try:
+            for item in iterator:
+                if cancelled.is_set() or not put(item):
+                    break
+        except Exception as e:
+            put(_Failure(e))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+            if not cancelled.is_set():
+                put(_DONE)
+
+    loop.run_in_executor(executor or get_stream_executor(), produce)
+    try:
+        while True:
+            item = await queue.get()
+            slots.release()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        cancelled.set()
+
+
+def cancel_on_disconnect(app):
+    """Wrap a Django ASGI app so a client disconnect cancels its request.
+
+    Django 4.2 stops reading ``receive`` once the request body is in, so a
+    streaming response keeps running after the client has gone. Here the rest
+    of ``receive`` is watched instead: on ``http.disconnect`` the request is
+    cancelled, which closes its response iterator (and with it any upstream
+    stream fed through ``iterate_in_thread``).
+    """
+    async def application(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+        body_read = asyncio.Event()
+        disconnected = False
+
+        async def read_body():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        async def watch():
+            nonlocal disconnected
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected = True
+            handler.cancel()
+
+        handler = asyncio.ensure_future(app(scope, read_body, send))
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+            # The response never reached close(), which is what sends this (closing DB connections)
+            await sync_to_async(signals.request_finished.send, thread_sensitive=True)(sender=app.__class__)
+        finally:
+            watcher.cancel()
+    return application
@@ -0,0 +1,441 @@
+import concurrent.futures
+import gc
+import io
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+import wave
+import numpy as np
+import requests
+from django.conf import settings
+from .instrumentation import (
+    STT_AUDIO_SECONDS, STT_INFERENCE, STT_PREPROCESS, STT_REJECTED, STT_TRIMMED_SECONDS, registry as metrics
+)
+
+logger = logging.getLogger(__name__)
+
+# whisper.audio.SAMPLE_RATE; kept here so importing this module doesn't pull in torch
+SAMPLE_RATE = 16000
+
+
+def stt_config() -> dict:
+    return getattr(settings, 'CHAT_STT', {})
+
+
+def load_whisper_model(name: str = 'small', device: str = 'auto', quantize: str = ''):
+    """Load Whisper weights, optionally int8-quantizing the linear layers.
+
+    torch and whisper are imported here rather than at module level so that
+    processes that never transcribe (migrate, shells, tests) don't pay for them.
+    """
+    import torch
+    import whisper
+
+    if device in (None, '', 'auto'):
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    started = time.perf_counter()
+    model = whisper.load_model(name, device=device)
+    if quantize == 'int8':
+        if device != 'cpu':
+            logger.warning("int8 quantization is CPU-only; loading Whisper %s unquantized on %s", name, device)
+        else:
+            # quantize_dynamic only swaps exact nn.Linear instances; whisper's subclass
+            # just casts weights to the input dtype, which is a no-op in fp32
+            for module in model.modules():
+                if isinstance(module, whisper.model.Linear):
+                    module.__class__ = torch.nn.Linear
+            torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            # The replaced fp32 weights sit in reference cycles; free them now rather than eventually
+            gc.collect()
+    elif quantize:
+        logger.warning("Unknown CHAT_STT quantization %r; ignoring it", quantize)
+    logger.info("Loaded Whisper %s on %s%s in %.1fs", name, device,
+                " (int8)" if quantize == 'int8' and device == 'cpu' else "", time.perf_counter() - started)
+    return model
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """The process-wide Whisper model, loaded on first use"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                config = stt_config()
+                _model = load_whisper_model(
+                    config.get('MODEL', 'small'), config.get('DEVICE', 'auto'), config.get('QUANTIZE', '')
+                )
+    return _model
+
+
+def warm_up_in_background():
+    """Load the model and run one short inference off the startup path"""
+    def run():
+        try:
+            pool = get_transcription_pool()
+            for _ in transcribe_audio(pool, np.zeros(SAMPLE_RATE, np.float32)):
+                pass
+        except Exception:
+            logger.exception("Speech-to-text warm-up failed")
+
+    thread = threading.Thread(target=run, name='stt-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+class SidecarTranscriber:
+    """Stands in for a Whisper model by forwarding audio to ``manage.py serve_stt``.
+
+    The sidecar holds the only copy of the weights, so web workers stay small
+    no matter how many of them there are.
+    """
+    device = 'sidecar'
+
+    def __init__(self, url: str, timeout: float = 300.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _post(self, path: str, audio: np.ndarray, options: dict = None) -> dict:
+        response = self.session.post(
+            f'{self.url}{path}',
+            data=np.ascontiguousarray(audio, dtype='<f4').tobytes(),
+            headers={'Content-Type': 'application/octet-stream', 'X-Transcribe-Options': json.dumps(options or {})},
+            timeout=self.timeout,
+        )
+        if response.status_code == 503:
+            raise TranscriptionQueueFull()
+        response.raise_for_status()
+        return response.json()
+
+    def transcribe(self, audio: np.ndarray, fp16=None, **options):
+        # fp16 is the sidecar's call, based on its own device
+        return self._post('/transcribe', audio, options)
+
+    def detect_language(self, audio: np.ndarray) -> str:
+        return self._post('/detect-language', audio)['language']
+
+
+class AudioDecodeError(ValueError):
+    pass
+
+
+class NoSpeechDetected(AudioDecodeError):
+    pass
+
+
+class TranscriptionQueueFull(Exception):
+    pass
+
+
+def _decode_wav(data: bytes) -> np.ndarray:
+    with wave.open(io.BytesIO(data)) as wav:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width == 2:
+        audio = np.frombuffer(frames, np.int16).astype(np.float32) / 32768.0
+    elif width == 4:
+        audio = np.frombuffer(frames, np.int32).astype(np.float32) / 2147483648.0
+    elif width == 1:
+        audio = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128.0) / 128.0
+    else:
+        raise AudioDecodeError(f"Unsupported WAV sample width: {width}")
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return resample(audio, rate)
+
+
+def resample(audio: np.ndarray, rate: int, taps: int = 63) -> np.ndarray:
+    """Resample to 16 kHz. Downsampling low-passes first so 44.1/48 kHz recordings don't alias."""
+    if rate == SAMPLE_RATE or not len(audio):
+        return audio.astype(np.float32, copy=False)
+    if rate > SAMPLE_RATE:
+        # Hamming-windowed sinc with its cutoff a little under the new Nyquist frequency
+        cutoff = 0.45 * SAMPLE_RATE / rate
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        audio = np.convolve(audio, kernel / kernel.sum(), mode='same')
+    positions = np.arange(0, len(audio), rate / SAMPLE_RATE)
+    return np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+
+
+def _decode_with_ffmpeg(data: bytes) -> np.ndarray:
+    # Same conversion as whisper.load_audio, but piped through stdin/stdout
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1",
+    ]
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except FileNotFoundError:
+        raise AudioDecodeError("ffmpeg is required to decode this audio format")
+    except subprocess.CalledProcessError as e:
+        raise AudioDecodeError(f"Failed to load audio: {e.stderr.decode(errors='replace')}")
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+
+def _decode_with_av(data: bytes):
+    """Decode in-process with PyAV (ffmpeg's libraries) when it's installed; None otherwise"""
+    try:
+        import av
+    except ImportError:
+        return None
+    try:
+        with av.open(io.BytesIO(data)) as container:
+            resampler = av.AudioResampler(format='s16', layout='mono', rate=SAMPLE_RATE)
+            chunks = []
+            for frame in container.decode(audio=0):
+                chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(frame))
+            chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(None))
+    except (av.error.FFmpegError, IndexError, ValueError) as e:
+        raise AudioDecodeError(f"Failed to load audio: {e}")
+    if not chunks:
+        return np.zeros(0, np.float32)
+    return np.concatenate(chunks).astype(np.float32) / 32768.0
+
+
+def decode_audio(data: bytes) -> np.ndarray:
+    """Decode an uploaded recording to 16 kHz mono float32 without temp files.
+
+    WAV is parsed in-process; anything else (webm/ogg from the browser's
+    MediaRecorder) is decoded in-process by PyAV if it's installed, or
+    else streamed through an ffmpeg subprocess's stdin.
+    """
+    if not data:
+        raise AudioDecodeError("Empty audio file")
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        try:
+            return _decode_wav(data)
+        except (wave.Error, EOFError):
+            pass  # Compressed or unusual WAV; let ffmpeg handle it
+    audio = _decode_with_av(data)
+    return audio if audio is not None else _decode_with_ffmpeg(data)
+
+
+def trim_silence(audio: np.ndarray, threshold_db: float = -50.0, margin_db: float = 12.0,
+                 padding_seconds: float = 0.2, max_pause_seconds: float = 0.5, frame_ms: int = 30) -> np.ndarray:
+    """Energy-based voice activity detection: cut leading and trailing silence and shorten long pauses.
+
+    A frame counts as speech when it is ``margin_db`` above the recording's
+    noise floor (its quietest frames), or 10 dB under its loud frames for
+    recordings that are nearly all speech, and never below ``threshold_db``.
+    Speech keeps ``padding_seconds`` of context on each side; pauses between
+    speech are cut down to ``max_pause_seconds``. Returns an empty array when
+    no frame is speech.
+    """
+    frame = SAMPLE_RATE * frame_ms // 1000
+    count = -(-len(audio) // frame)
+    if not count:
+        return audio[:0]
+    frames = np.zeros(count * frame, np.float32)
+    frames[:len(audio)] = audio
+    energy = 10 * np.log10(np.mean(frames.reshape(count, frame) ** 2, axis=1) + 1e-10)
+    relative = min(np.percentile(energy, 10) + margin_db, np.percentile(energy, 90) - 10)
+    speech = energy > max(threshold_db, relative)
+    if not speech.any():
+        return audio[:0]
+
+    pad = int(round(padding_seconds * 1000 / frame_ms))
+    if pad:
+        speech = np.convolve(speech, np.ones(2 * pad + 1), mode='same') > 0
+    keep = speech.copy()
+    max_pause = int(round(max_pause_seconds * 1000 / frame_ms))
+    first, last = np.flatnonzero(speech)[[0, -1]]
+    starts = np.flatnonzero(speech[:-1] & ~speech[1:]) + 1
+    ends = np.flatnonzero(~speech[:-1] & speech[1:]) + 1
+    for start, end in zip(starts[starts < last], ends[ends > first]):
+        keep[start:min(end, start + max_pause)] = True
+    return audio[np.repeat(keep, frame)[:len(audio)]]
+
+
+class PreparedAudio:
+    """A decoded upload ready for Whisper, and how much of the original it kept"""
+
+    def __init__(self, audio: np.ndarray, original_seconds: float):
+        self.audio = audio
+        self.original_seconds = original_seconds
+        self.seconds = len(audio) / SAMPLE_RATE
+        self.trimmed_seconds = original_seconds - self.seconds
+
+
+def _reject(reason: str, message: str):
+    STT_REJECTED.inc(reason=reason)
+    raise NoSpeechDetected(message)
+
+
+def prepare_audio(data: bytes, config: dict = None) -> PreparedAudio:
+    """Decode, resample and trim an upload; raises AudioDecodeError (NoSpeechDetected) for unusable clips"""
+    config = stt_config() if config is None else config
+    started = time.perf_counter()
+    try:
+        audio = decode_audio(data)
+        original_seconds = len(audio) / SAMPLE_RATE
+        if original_seconds < config.get('MIN_SECONDS', 0.3):
+            _reject('too_short', "Recording is too short")
+        if config.get('VAD', True):
+            audio = trim_silence(
+                audio,
+                threshold_db=config.get('VAD_THRESHOLD_DB', -50.0),
+                padding_seconds=config.get('VAD_PADDING_SECONDS', 0.2),
+                max_pause_seconds=config.get('VAD_MAX_PAUSE_SECONDS', 0.5),
+            )
+            if len(audio) / SAMPLE_RATE < config.get('MIN_SPEECH_SECONDS', 0.3):
+                _reject('no_speech', "No speech detected in the recording")
+    finally:
+        STT_PREPROCESS.observe(time.perf_counter() - started)
+    prepared = PreparedAudio(audio, original_seconds)
+    STT_TRIMMED_SECONDS.inc(prepared.trimmed_seconds)
+    return prepared
+
+
+def split_segments(audio: np.ndarray, seconds: float = 30.0):
+    """Split audio into Whisper-window-sized pieces that can be decoded in parallel"""
+    size = int(seconds * SAMPLE_RATE)
+    return [audio[start:start + size] for start in range(0, max(len(audio), 1), size)]
+
+
+def detect_spoken_language(model, audio: np.ndarray) -> str:
+    if isinstance(model, SidecarTranscriber):
+        return model.detect_language(audio)
+    if not model.is_multilingual:
+        return 'en'
+    import whisper
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels).to(model.device)
+    _, probs = model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+
+class TranscriptionPool:
+    """Runs Whisper inference on a fixed set of model replicas.
+
+    A replica is only ever used by one thread at a time (Whisper installs
+    per-call hooks on the model), so throughput scales with ``replicas``.
+    Admission control bounds the number of queued segments; once full,
+    ``submit_all`` raises TranscriptionQueueFull instead of piling up work.
+    """
+
+    def __init__(self, model_factory, replicas: int = 1, max_pending: int = 16):
+        self.model_factory = model_factory
+        self.replicas = replicas
+        self.max_pending = max_pending
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=replicas, thread_name_prefix='stt')
+        self._stats = {'segments': 0, 'language_detections': 0, 'rejected': 0, 'audio_seconds': 0.0, 'busy_seconds': 0.0}
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            index = self._created if self._created < self.replicas else None
+            if index is not None:
+                self._created += 1
+        if index is None:
+            return self._idle.get()
+        try:
+            return self.model_factory(index)
+        except BaseException:
+            # Give the slot back, so a later segment can try loading the replica again
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _run(self, work, audio: np.ndarray):
+        model = None
+        started = time.perf_counter()
+        try:
+            model = self._checkout()
+            return work(model, audio)
+        finally:
+            if model is not None:
+                self._idle.put(model)
+            with self._lock:
+                self._pending -= 1
+                self._stats['busy_seconds'] += time.perf_counter() - started
+
+    def _admit(self, count: int):
+        with self._lock:
+            if self._pending + count > self.max_pending:
+                self._stats['rejected'] += 1
+                raise TranscriptionQueueFull()
+            self._pending += count
+
+    def submit_all(self, segments, **options):
+        """Queue every segment of one recording, or none of them if the pool is full"""
+        self._admit(len(segments))
+        with self._lock:
+            self._stats['segments'] += len(segments)
+            self._stats['audio_seconds'] += sum(len(segment) for segment in segments) / SAMPLE_RATE
+
+        def work(model, audio):
+            started = time.perf_counter()
+            result = model.transcribe(audio, fp16=str(model.device) != 'cpu', **options)
+            STT_INFERENCE.observe(time.perf_counter() - started)
+            STT_AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
+            return result
+        return [self._executor.submit(self._run, work, segment) for segment in segments]
+
+    def detect_language(self, audio: np.ndarray) -> str:
+        """Spoken language from the first 30 s window: one encoder pass, no decoding"""
+        self._admit(1)
+        with self._lock:
+            self._stats['language_detections'] += 1
+        return self._executor.submit(self._run, detect_spoken_language, audio[:30 * SAMPLE_RATE]).result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'pending': self._pending, 'replicas': self.replicas}
+
+
+def transcribe_audio(pool: TranscriptionPool, audio: np.ndarray, segment_seconds: float = 30.0, **options):
+    """Queue every segment now; iterate (index, result) in order as each is decoded"""
+    futures = pool.submit_all(split_segments(audio, segment_seconds), **options)
+    return ((index, future.result()) for index, future in enumerate(futures))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _load_local_replica(index: int):
+    # The first replica is the shared (possibly preloaded) model
+    if index == 0:
+        return get_model()
+    config = stt_config()
+    return load_whisper_model(config.get('MODEL', 'small'), config.get('DEVICE', 'auto'), config.get('QUANTIZE', ''))
+
+
+def build_transcription_pool(config: dict, backend: str = None) -> TranscriptionPool:
+    backend = backend or config.get('BACKEND', 'local')
+    replicas = config.get('REPLICAS', 1)
+    if backend == 'sidecar':
+        url = config.get('SIDECAR_URL', 'http://127.0.0.1:8765')
+        factory = lambda index: SidecarTranscriber(url)
+    else:
+        if replicas > 1:
+            import torch
+            # Replicas run side by side; don't let each one claim every core
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // replicas))
+        factory = _load_local_replica
+    return TranscriptionPool(factory, replicas=replicas, max_pending=config.get('MAX_PENDING_SEGMENTS', 16))
+
+
+def get_transcription_pool() -> TranscriptionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = build_transcription_pool(stt_config())
+                metrics.register_stats('stt_pool', _pool.stats)
+    return _pool
@@ -0,0 +1,90 @@
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.http import parse_etags
+from .models import Conversation, ConversationTombstone, Message
+
+
+def sidebar_state(user_email: str):
+    """(newest updated_at, count) of the user's active conversations: one aggregate over the sidebar index"""
+    state = Conversation.objects.filter(user_email=user_email, is_active=True).aggregate(
+        latest=Max('updated_at'), count=Count('id')
+    )
+    return state['latest'], state['count']
+
+
+def sidebar_etag(user_email: str, latest, count: int, *params) -> str:
+    """Weak ETag for a sidebar response; changes whenever a conversation is added, updated or removed"""
+    raw = '\n'.join([user_email, latest.isoformat() if latest else '', str(count), *map(str, params)])
+    return f'W/"{hashlib.sha1(raw.encode("utf-8")).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as If-None-Match asks for
+    strip = lambda tag: tag[2:] if tag.startswith('W/') else tag
+    return strip(etag) in {strip(tag) for tag in parse_etags(if_none_match)}
+
+
+def _overlap() -> timedelta:
+    # Rows committed late can carry a timestamp a little older than a cursor
+    # already handed out, so cursors trail the clock; deltas are upserts by id
+    return timedelta(seconds=getattr(settings, 'CHAT_SYNC_OVERLAP_SECONDS', 5))
+
+
+def start_cursor():
+    """Cursor time for a client that has just fetched the full list"""
+    return timezone.now() - _overlap()
+
+
+class CursorTooOld(Exception):
+    pass
+
+
+def conversation_changes(user_email: str, since, max_changes: int, window: int):
+    """What changed in the user's sidebar after ``since``.
+
+    Returns (changed active conversations, their new messages by conversation
+    id, ids of conversations deleted or deactivated, cursor time for the next
+    call). Raises CursorTooOld when the caller should refetch in full: the
+    cursor predates CHAT_SYNC_MAX_AGE_DAYS (tombstones may be gone) or more
+    than ``max_changes`` conversations changed.
+    """
+    now = timezone.now()
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    if since < now - timedelta(days=getattr(settings, 'CHAT_SYNC_MAX_AGE_DAYS', 30)):
+        raise CursorTooOld()
+    cursor = min(now, max(since, now - _overlap()))
+
+    changed = list(Conversation.objects.filter(user_email=user_email, updated_at__gt=since).defer('summary')
+                   .order_by('-updated_at', '-id')[:max_changes + 1])
+    if len(changed) > max_changes:
+        raise CursorTooOld()
+    active = [conversation for conversation in changed if conversation.is_active]
+    deleted = [conversation.id for conversation in changed if not conversation.is_active]
+    deleted += ConversationTombstone.objects.filter(user_email=user_email, deleted_at__gt=since) \
+        .values_list('conversation_id', flat=True)
+
+    messages = {}
+    if active and window:
+        for message in Message.objects.filter(
+                conversation_id__in=[conversation.id for conversation in active], timestamp__gt=since
+        ).order_by('timestamp', 'id'):
+            messages.setdefault(message.conversation_id, []).append(message)
+        messages = {conversation_id: found[-window:] for conversation_id, found in messages.items()}
+    return active, messages, sorted(set(deleted)), cursor
+
+
+def record_tombstone(sender, instance, **kwargs):
+    """post_delete receiver for Conversation; also drops the user's tombstones too old to matter"""
+    ConversationTombstone.objects.create(conversation_id=instance.id, user_email=instance.user_email)
+    max_age = timedelta(days=getattr(settings, 'CHAT_SYNC_MAX_AGE_DAYS', 30))
+    ConversationTombstone.objects.filter(
+        user_email=instance.user_email, deleted_at__lt=timezone.now() - max_age
+    ).delete()
@@ -1,13 +1,67 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import threading
+import wave
+from datetime import timedelta
+import numpy as np
+from unittest import mock
+from asgiref.sync import iscoroutinefunction
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
 from django.contrib.auth.models import User
+from django.core import signals
+from django.utils import timezone
 from rest_framework.test import APIClient
-from .models import Conversation, Message
+from django.core.cache import caches
+from .models import Conversation, Feedback, FeedbackRollup, Message, ProfileExtractionJob, ProfileFact, UserProfile
+from .context import build_context, get_user_context, load_key_information
+from .language import detect_text_language, get_language, remember_language
+from .loadtest import QueryCounter, percentile, seed_chat_data
+from .pagination import encode_sync_cursor
+from . import instrumentation
+from .jobs import DatabaseJobBackend, ProfileJobQueue
+from .stream_filter import ChunkCoalescer, ReplyStream, StructuredPayloadFilter, acoalesce, coalesce
+from .streaming import iterate_in_thread
+from .persistence import WriteBehindBuffer, write_messages
+from .profiles import build_extraction_prompt, record_facts, should_extract, update_user_profile
+from .search import build_snippet, search_terms
+from .agent_sessions import checkout_session
+from .response_cache import ResponseCache
+from .text import normalize_message
+from .resumable import CacheReplayStore, MemoryReplayStore, parse_event_id
+from .idempotency import DONE, PENDING, CacheIdempotencyStore, MemoryIdempotencyStore
+from .memory import ConversationMemory, SummaryScheduler, load_memory, maybe_summarize, summarize_conversation
+from .bedrock import BedrockAgent, BedrockClientRegistry
+from .bedrock_stub import StubBedrockServer
+from .scheduler import BACKGROUND, INTERACTIVE, UpstreamRejected, UpstreamScheduler, get_upstream_scheduler
+from .views import MessageView
+from .realtime import LiveTranscript
+from .stt import (
+    SAMPLE_RATE, NoSpeechDetected, TranscriptionPool, TranscriptionQueueFull, decode_audio, get_model,
+    load_whisper_model, prepare_audio, resample, transcribe_audio, trim_silence
+)
 
+STUB_AWS_ENV = {
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'BEDROCK_AGENT_ID': 'AGENT',
+    'BEDROCK_AGENT_ALIAS_ID': 'ALIAS',
+}
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
 class ChatbotTests(TestCase):
     def setUp(self):
         self.client = APIClient()
         self.user = User.objects.create_user(username='testuser', password='testpassword')
         self.conversation = Conversation.objects.create(user=self.user, session_id='test-session')
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        patcher = mock.patch('chat.bedrock.get_client_registry', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_send_message(self):
         # Authenticate user
@@ -15,15 +69,20 @@ class ChatbotTests(TestCase):
 
         # Send a message
         response = self.client.post('/api/chat/message/', {
-            'conversation_id': self.conversation.id,
-            'message': 'Hi'
-        })
+            'conversationId': self.conversation.id,
+            'message': 'Hi',
+            'user_email': 'guest'
+        }, format='json')
 
-        # Check response
+        # The reply streams back as server-sent events and both turns are saved
         self.assertEqual(response.status_code, 200)
-        self.assertTrue('text' in response.data[0])
-        self.assertTrue('timestamp' in response.data[0])
-        self.assertTrue('sender' in response.data[0])
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+        stream_id = response['X-Stream-Id']
+        self.assertEqual(body, f'id: {stream_id}:1\ndata: {{"chunk": "Hello"}}\n\n'
+                               f'id: {stream_id}:2\ndata: {{"chunk": " there"}}\n\n')
+        self.assertEqual(list(self.conversation.messages.order_by('id').values_list('content', flat=True)),
+                         ['Hi', 'Hello there'])
 
     def test_get_conversation(self):
         # Authenticate user
@@ -35,3 +94,1493 @@ class ChatbotTests(TestCase):
         # Check response
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['session_id'], 'test-session')
+
+class ConversationListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.email = 'reader@example.com'
+        self.conversations = []
+        for i in range(3):
+            conversation = Conversation.objects.create(user_email=self.email, session_id=f'list-{i}')
+            for j in range(5):
+                Message.objects.create(conversation=conversation, content=f'{i}-{j}', user_email=self.email)
+            Conversation.objects.filter(pk=conversation.pk).update(last_message=f'{i}-4', message_count=5)
+            self.conversations.append(conversation)
+
+    def test_list_uses_constant_queries(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/conversations/', {'email': self.email, 'messages': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual([m['content'] for m in response.data[0]['messages']], ['2-3', '2-4'])
+        self.assertEqual(response.data[0]['lastMessage'], '2-4')
+
+    def test_list_cursor_pagination(self):
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'limit': 2})
+        self.assertEqual([c['id'] for c in response.data], [self.conversations[2].id, self.conversations[1].id])
+
+        response = self.client.get('/api/chat/conversations/', {
+            'email': self.email, 'limit': 2, 'cursor': response['X-Next-Cursor']
+        })
+        self.assertEqual([c['id'] for c in response.data], [self.conversations[0].id])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+    def test_unchanged_list_is_not_modified(self):
+        response = self.client.get('/api/chat/conversations/', {'email': self.email})
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/conversations/', {'email': self.email},
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        # Another page shape, or any change to the conversations, is a different ETag
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'limit': 2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        write_messages([Message(conversation=self.conversations[0], content='new', user_email=self.email)])
+        response = self.client.get('/api/chat/conversations/', {'email': self.email}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(CHAT_SYNC_OVERLAP_SECONDS=0)
+    def test_since_returns_only_changes(self):
+        since = self.client.get('/api/chat/conversations/', {'email': self.email})['X-Sync-Cursor']
+        first, second, third = self.conversations
+        deleted = sorted([second.id, third.id])
+        write_messages([Message(conversation=first, content='new', user_email=self.email)])
+        second.delete()
+        third.is_active = False
+        third.save()
+
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'since': since})
+        self.assertEqual([c['id'] for c in response.data['conversations']], [first.id])
+        self.assertEqual([m['content'] for m in response.data['conversations'][0]['messages']], ['new'])
+        self.assertEqual(response.data['deleted'], deleted)
+
+        # Nothing new since: an empty delta, then a 304 when the same delta is asked for again
+        since = response.data['cursor']
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'since': since})
+        self.assertEqual((response.data['conversations'], response.data['deleted']), ([], []))
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/conversations/', {'email': self.email, 'since': since},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        # Full lists and deltas never share a validator
+        full = self.client.get('/api/chat/conversations/', {'email': self.email})
+        self.assertNotEqual(full['ETag'], response['ETag'])
+
+    def test_since_rejects_bad_cursors(self):
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'since': 'nope'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/chat/conversations/', {'email': self.email, 'since': 'nope'},
+                                   HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/chat/conversations/', {
+            'email': self.email, 'since': encode_sync_cursor(timezone.now() - timedelta(days=90))
+        })
+        self.assertEqual(response.status_code, 410)
+
+    def test_message_history_keyset_pagination(self):
+        url = f'/api/chat/conversations/{self.conversations[0].id}/messages/'
+        response = self.client.get(url, {'email': self.email, 'limit': 3})
+        self.assertEqual([m['content'] for m in response.data], ['0-2', '0-3', '0-4'])
+
+        response = self.client.get(url, {'email': self.email, 'limit': 3, 'cursor': response['X-Next-Cursor']})
+        self.assertEqual([m['content'] for m in response.data], ['0-0', '0-1'])
+
+        response = self.client.get(url, {'email': 'someone-else@example.com'})
+        self.assertEqual(response.status_code, 404)
+
+class FeedbackTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def item(self, rating, feedback_type='general'):
+        return {'feedback_type': feedback_type, 'rating': rating, 'message': 'ok', 'user_email': 'a@example.com'}
+
+    def test_bulk_feedback_is_saved_and_rolled_up(self):
+        response = self.client.post('/api/chat/feedback/bulk/', [
+            self.item(5), self.item(4), self.item(5), self.item(1, 'bug'),
+        ], format='json')
+        self.assertEqual((response.status_code, response.data['created']), (201, 4))
+        self.client.post('/api/chat/feedback/', self.item(3, 'bug'), format='json')
+
+        self.assertEqual(Feedback.objects.count(), 5)
+        self.assertEqual(sorted(FeedbackRollup.objects.values_list('feedback_type', 'rating', 'count')),
+                         [('bug', 1, 1), ('bug', 3, 1), ('general', 4, 1), ('general', 5, 2)])
+
+    def test_invalid_batches_are_rejected_whole(self):
+        response = self.client.post('/api/chat/feedback/bulk/', [self.item(5), self.item(9)], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('rating', response.data[1])
+        self.assertEqual(self.client.post('/api/chat/feedback/bulk/', [], format='json').status_code, 400)
+        self.assertFalse(Feedback.objects.exists())
+        self.assertFalse(FeedbackRollup.objects.exists())
+
+    def test_analytics_read_the_rollup(self):
+        self.client.post('/api/chat/feedback/bulk/', [self.item(5), self.item(4), self.item(2, 'bug')], format='json')
+        FeedbackRollup.objects.create(day=timezone.localdate() - timedelta(days=60), feedback_type='general',
+                                      rating=1, count=10)
+
+        self.assertEqual(self.client.get('/api/chat/feedback/analytics/').status_code, 401)
+        admin = User.objects.create_user(username='admin', password='x', is_staff=True)
+        self.client.force_authenticate(admin)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/feedback/analytics/', {'days': 7})
+
+        today = timezone.localdate().isoformat()
+        self.assertEqual(response.data['days'], [
+            {'date': today, 'feedback_type': 'bug', 'count': 1, 'average_rating': 2.0, 'ratings': {'2': 1}},
+            {'date': today, 'feedback_type': 'general', 'count': 2, 'average_rating': 4.5,
+             'ratings': {'4': 1, '5': 1}},
+        ])
+        self.assertEqual(response.data['totals']['general']['count'], 2)
+        response = self.client.get('/api/chat/feedback/analytics/', {'days': 90, 'type': 'general'})
+        self.assertEqual(response.data['totals'], {
+            'general': {'count': 12, 'average_rating': 1.58, 'ratings': {'1': 10, '4': 1, '5': 1}},
+        })
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.email = 'searcher@example.com'
+        mine = Conversation.objects.create(user_email=self.email, session_id='search-mine')
+        theirs = Conversation.objects.create(user_email='other@example.com', session_id='search-theirs')
+        self.matches = [
+            Message.objects.create(conversation=mine, content=f'Exam stress day {i}: <b>study</b> plan', user_email=self.email)
+            for i in range(3)
+        ]
+        Message.objects.create(conversation=mine, content='Morning run went well')
+        Message.objects.create(conversation=theirs, content='Exam stress for someone else')
+
+    def test_search_is_scoped_and_highlighted(self):
+        response = self.client.get('/api/chat/search/', {'email': self.email, 'q': 'exam STUDY'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['id'] for r in response.data], [m.id for m in reversed(self.matches)])
+        self.assertEqual(response.data[0]['snippet'],
+                         '<mark>Exam</mark> stress day 2: &lt;b&gt;<mark>study</mark>&lt;/b&gt; plan')
+        self.assertEqual(response.data[0]['conversation_id'], self.matches[0].conversation_id)
+
+    def test_search_keyset_pagination(self):
+        response = self.client.get('/api/chat/search/', {'email': self.email, 'q': 'exam', 'limit': 2})
+        self.assertEqual(len(response.data), 2)
+
+        response = self.client.get('/api/chat/search/', {
+            'email': self.email, 'q': 'exam', 'limit': 2, 'cursor': response['X-Next-Cursor']
+        })
+        self.assertEqual([r['id'] for r in response.data], [self.matches[0].id])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+    def test_search_rejects_bad_input(self):
+        self.assertEqual(self.client.get('/api/chat/search/', {'email': self.email}).status_code, 400)
+        self.assertEqual(self.client.get('/api/chat/search/', {'q': 'exam'}).status_code, 400)
+        response = self.client.get('/api/chat/search/', {'email': self.email, 'q': 'exam', 'cursor': '!!'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_snippet_windows_long_messages(self):
+        content = ' '.join(['filler'] * 100) + ' deadline ' + ' '.join(['filler'] * 100)
+        snippet = build_snippet(content, ['deadline'], width=60)
+
+        self.assertTrue(snippet.startswith('… filler'))
+        self.assertTrue(snippet.endswith(' …'))
+        self.assertIn('\x02deadline\x03', snippet)
+        self.assertLessEqual(len(snippet), 60 + 4)
+        self.assertEqual(search_terms('"exam stress" -sleep or Exam'), ['exam', 'stress', 'sleep'])
+
+
+
+class FakeSummarizer:
+    def __init__(self, reply='They are preparing for exams.'):
+        self.reply = reply
+        self.prompts = []
+        self.sessions = []
+
+    def invoke_agent(self, prompt, session_id, **options):
+        self.prompts.append(prompt)
+        self.sessions.append(session_id)
+        yield self.reply
+
+
+class ConversationMemoryTests(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create(user_email='mem@example.com', session_id='memory')
+        self.messages = []
+        for i in range(30):
+            self.messages.append(Message.objects.create(
+                conversation=self.conversation, content=f'message {i}',
+                user_email='mem@example.com' if i % 2 == 0 else None
+            ))
+        Conversation.objects.filter(pk=self.conversation.pk).update(message_count=30)
+
+    def test_window_is_bounded_by_messages_and_tokens(self):
+        with self.assertNumQueries(2):
+            memory = load_memory(self.conversation.id, window=4, token_budget=1000)
+        self.assertEqual(memory.turns, [('User', 'message 26'), ('Assistant', 'message 27'),
+                                        ('User', 'message 28'), ('Assistant', 'message 29')])
+        self.assertEqual(memory.unsummarized, 30)
+
+        # Each message costs four estimated tokens
+        memory = load_memory(self.conversation.id, window=4, token_budget=8)
+        self.assertEqual([text for _, text in memory.turns], ['message 28', 'message 29'])
+
+    def test_summary_folds_all_but_the_window(self):
+        bedrock = FakeSummarizer()
+        self.assertTrue(summarize_conversation(self.conversation.id, bedrock=bedrock, window=4))
+
+        self.assertIn('User: message 0\nAssistant: message 1', bedrock.prompts[0])
+        self.assertNotIn('message 26', bedrock.prompts[0])
+        self.assertTrue(bedrock.sessions[0].startswith('summary-'))
+        memory = load_memory(self.conversation.id, window=10)
+        self.assertEqual(memory.summary, 'They are preparing for exams.')
+        self.assertEqual([text for _, text in memory.turns], [f'message {i}' for i in range(26, 30)])
+        self.assertEqual(memory.unsummarized, 4)
+
+        prompt = MessageView().build_prompt("", "Next", memory=memory)
+        self.assertIn("Summary of the earlier conversation:\nThey are preparing for exams.\n", prompt)
+        self.assertTrue(prompt.endswith("Assistant: message 29\nUser: Next\nAssistant:"))
+
+        # Nothing new beyond the window: no upstream call
+        self.assertFalse(summarize_conversation(self.conversation.id, bedrock=bedrock, window=4))
+        self.assertEqual(len(bedrock.prompts), 1)
+
+    @override_settings(CHAT_MEMORY={'SUMMARIZE_AFTER': 24})
+    def test_summaries_are_requested_past_the_threshold(self):
+        with mock.patch('chat.memory.get_summary_scheduler') as scheduler:
+            maybe_summarize(self.conversation.id, ConversationMemory(unsummarized=22))
+            scheduler.assert_not_called()
+            maybe_summarize(self.conversation.id, ConversationMemory(unsummarized=23))
+            scheduler.return_value.request.assert_called_once_with(self.conversation.id)
+
+        scheduler = SummaryScheduler()
+        with mock.patch.object(scheduler, '_thread', True):  # keep the worker thread out of the test
+            scheduler.request(self.conversation.id)
+            scheduler.request(self.conversation.id)
+        with mock.patch('chat.memory.summarize_conversation', return_value=True) as summarize:
+            self.assertTrue(scheduler.run_once())
+            self.assertFalse(scheduler.run_once())
+        summarize.assert_called_once_with(self.conversation.id)
+        self.assertEqual(scheduler.stats()['summarized'], 1)
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class AgentSessionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        patcher = mock.patch('chat.bedrock.get_client_registry', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.first = Conversation.objects.create(user_email='guest', session_id='first-session')
+        self.second = Conversation.objects.create(user_email='guest', session_id='second-session')
+
+    def send(self, conversation, message='Hi'):
+        response = self.client.post('/api/chat/message/', {
+            'conversationId': conversation.id, 'message': message, 'user_email': 'guest'
+        }, format='json')
+        b''.join(response.streaming_content)
+
+    def test_each_conversation_gets_its_own_session(self):
+        self.send(self.first)
+        self.send(self.second)
+        self.send(self.first, 'Again')
+
+        self.assertEqual([r['session_id'] for r in self.stub.requests],
+                         ['first-session', 'second-session', 'first-session'])
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.agent_session, 'first-session')
+        self.assertEqual(self.first.agent_session_turns, 2)
+        self.assertGreater(self.first.agent_session_chars, 0)
+
+    @override_settings(CHAT_AGENT_SESSIONS={'IDLE_SECONDS': 600, 'MAX_TURNS': 2, 'MAX_CHARS': 100000})
+    def test_history_only_seeds_a_new_session(self):
+        with mock.patch('chat.agent_sessions._end_in_background'), \
+                mock.patch('chat.views.get_upstream_scheduler', return_value=UpstreamScheduler(rate=0)):
+            for message in ('One', 'Two', 'Three'):
+                self.send(self.first, message)
+        prompts = [r['input_text'] for r in self.stub.requests]
+
+        # The live session holds "One" already; the rotated one gets the history again
+        self.assertNotIn('User: One', prompts[1])
+        self.assertTrue(prompts[1].endswith('User: Two\nAssistant:'))
+        self.assertIn('User: One', prompts[2])
+        self.assertIn('User: Two', prompts[2])
+        self.assertNotEqual(self.stub.requests[2]['session_id'], self.stub.requests[1]['session_id'])
+
+    @override_settings(CHAT_AGENT_SESSIONS={'IDLE_SECONDS': 600, 'MAX_TURNS': 3, 'MAX_CHARS': 100000})
+    def test_sessions_rotate_when_idle_or_too_large(self):
+        checkout_session(self.first.id)
+        Conversation.objects.filter(pk=self.first.pk).update(
+            agent_session_used_at=timezone.now() - timedelta(minutes=11)
+        )
+        with mock.patch('chat.agent_sessions._end_in_background') as end:
+            idle = checkout_session(self.first.id)
+            end.assert_not_called()
+            self.assertTrue(idle.session_id.startswith('first-session-'))
+
+            Conversation.objects.filter(pk=self.first.pk).update(agent_session_turns=3)
+            large = checkout_session(self.first.id)
+            end.assert_called_once_with(idle.session_id)
+        self.assertNotEqual(large.session_id, idle.session_id)
+        self.assertEqual(checkout_session(self.first.id).session_id, large.session_id)
+
+    def test_end_closes_the_session_upstream(self):
+        self.send(self.first)
+        with mock.patch('chat.agent_sessions._end_in_background') as end:
+            response = self.client.post(f'/api/chat/conversations/{self.first.id}/end/', {'user_email': 'guest'},
+                                        format='json')
+        # The request doesn't wait on the agent; the upstream session is ended in the background
+        self.assertEqual(response.status_code, 204)
+        end.assert_called_once_with('first-session')
+        self.send(self.first)
+        self.assertTrue(self.stub.requests[-1]['session_id'].startswith('first-session-'))
+
+        response = self.client.post(f'/api/chat/conversations/{self.first.id}/end/', {'user_email': 'other'},
+                                    format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+@override_settings(CHAT_RESPONSE_CACHE={'ENABLED': True, 'CACHE': 'chat_responses'})
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        for patcher in (mock.patch('chat.bedrock.get_client_registry', return_value=registry),
+                        mock.patch('chat.response_cache._cache', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        caches['chat_responses'].clear()
+
+    def send(self, message, user_email='guest', conversation=None):
+        conversation = conversation or Conversation.objects.create(
+            user_email=user_email, session_id=f'cache-{Conversation.objects.count()}'
+        )
+        response = self.client.post('/api/chat/message/', {
+            'conversationId': conversation.id, 'message': message, 'user_email': user_email
+        }, format='json')
+        # Event ids differ per stream; the payloads are what's cached
+        body = b''.join(response.streaming_content).decode()
+        return conversation, ''.join(line + '\n' for line in body.splitlines() if not line.startswith('id: '))
+
+    def test_greetings_replay_from_cache(self):
+        _, first = self.send('Hi!')
+        conversation, second = self.send('  hi ')
+
+        self.assertEqual(second, first)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(list(conversation.messages.order_by('id').values_list('content', flat=True)),
+                         ['  hi ', 'Hello there'])
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.agent_session_turns, 0)
+
+        # Later turns carry history and always go upstream
+        self.send('hi', conversation=conversation)
+        self.assertEqual(len(self.stub.requests), 2)
+
+        from .response_cache import get_response_cache
+        stats = get_response_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['skipped']), (1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_profile_context_is_never_cached(self):
+        with mock.patch.object(MessageView, 'get_relevant_context', return_value='Name: Ana'), \
+                mock.patch('chat.views.get_profile_job_queue'):
+            self.send('hello', user_email='ana@example.com')
+            self.send('hello', user_email='ana@example.com')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_failed_replies_are_not_stored(self):
+        cache = ResponseCache(caches['chat_responses'])
+        key = cache.key_for('hello')
+        cache.store(key, ['Error: ', 'throttled'])
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(cache.key_for('x' * 500))
+        self.assertEqual(normalize_message('  ¡HOLA!!  '), 'hola')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class UpstreamSchedulerTests(TestCase):
+    def test_interactive_waiters_go_first(self):
+        scheduler = UpstreamScheduler(max_concurrent=1, rate=0)
+        order = []
+
+        def call(lane):
+            with scheduler.slot(lane):
+                order.append(lane)
+
+        scheduler.acquire(INTERACTIVE)
+        threads = [threading.Thread(target=call, args=(BACKGROUND,))]
+        threads[0].start()
+        while not scheduler.stats()['waiting_background']:
+            threading.Event().wait(0.001)
+        threads.append(threading.Thread(target=call, args=(INTERACTIVE,)))
+        threads[1].start()
+        while not scheduler.stats()['waiting_interactive']:
+            threading.Event().wait(0.001)
+        scheduler.release(INTERACTIVE)
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+        self.assertEqual(scheduler.stats()['in_flight'], 0)
+
+    def test_waiters_time_out(self):
+        scheduler = UpstreamScheduler(max_concurrent=1, rate=0, timeouts={INTERACTIVE: 0.01})
+        scheduler.acquire(INTERACTIVE)
+        with self.assertRaises(UpstreamRejected) as raised:
+            scheduler.acquire(INTERACTIVE)
+        self.assertEqual(raised.exception.reason, 'queue_timeout')
+        self.assertEqual(scheduler.stats()['queue_timeouts'], 1)
+
+    def test_per_user_token_bucket(self):
+        clock = FakeClock()
+        scheduler = UpstreamScheduler(rate=0.5, burst=2, clock=clock)
+        scheduler.admit('ana@example.com')
+        scheduler.admit('ana@example.com')
+        with self.assertRaises(UpstreamRejected) as raised:
+            scheduler.admit('ana@example.com')
+        self.assertEqual(raised.exception.reason, 'rate_limited')
+        self.assertAlmostEqual(raised.exception.retry_after, 2.0)
+        scheduler.admit('bob@example.com')
+
+        clock.now = 2.0
+        scheduler.admit('ana@example.com')
+
+    def test_throttling_halves_the_limit(self):
+        stub = StubBedrockServer(chunks=['Hi'], throttle=lambda: True).start()
+        self.addCleanup(stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=stub.endpoint_url, max_attempts=1)
+        scheduler = UpstreamScheduler(max_concurrent=8, rate=0, backoff_seconds=0)
+        with mock.patch('chat.bedrock.get_upstream_scheduler', return_value=scheduler):
+            reply = BedrockAgent(registry=registry).generate_response('hello')
+
+        self.assertTrue(reply.startswith('Error:'))
+        stats = scheduler.stats()
+        self.assertEqual((stats['throttled'], stats['limit'], stats['in_flight']), (1, 4, 0))
+
+    def test_view_rejects_with_retry_after(self):
+        conversation = Conversation.objects.create(user_email='guest', session_id='busy')
+        scheduler = UpstreamScheduler(rate=0.5, burst=1)
+        with mock.patch('chat.views.get_upstream_scheduler', return_value=scheduler):
+            scheduler.admit(f'guest:{conversation.id}')
+            response = APIClient().post('/api/chat/message/', {
+                'conversationId': conversation.id, 'message': 'Hi', 'user_email': 'guest'
+            }, format='json')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertFalse(conversation.messages.exists())
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class BedrockClientRegistryTests(TestCase):
+    def setUp(self):
+        self.stub = StubBedrockServer(chunks=['Hi', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        self.registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+
+    def test_agents_share_pooled_clients(self):
+        first = BedrockAgent(registry=self.registry)
+        second = BedrockAgent(registry=self.registry)
+
+        self.assertIs(first.bedrock_agent_runtime, second.bedrock_agent_runtime)
+        self.assertEqual(first.generate_response('hello', 'a@example.com'), 'Hi there')
+        self.assertEqual(list(second.generate_stream('hello')), ['Hi', ' there'])
+
+        stats = self.registry.stats()
+        self.assertEqual(stats['clients_created'], 1)
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_transport_failures_and_abandoned_streams_are_not_successes(self):
+        self.stub.first_chunk_delay = 1.0
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url,
+                                         read_timeout=0.2, max_attempts=1)
+        durations = instrumentation.BEDROCK_DURATION.count()
+        with self.assertRaises(Exception) as raised:
+            list(BedrockAgent(registry=registry).invoke_agent('hello', 'a@example.com', raise_errors=True))
+        self.assertGreaterEqual(instrumentation.BEDROCK_ERRORS.value(code=type(raised.exception).__name__), 1)
+
+        self.stub.first_chunk_delay = 0
+        stream = BedrockAgent(registry=registry).invoke_agent('hello', 'a@example.com')
+        self.assertEqual(next(stream), 'Hi')
+        stream.close()
+
+        self.assertEqual(instrumentation.BEDROCK_DURATION.count(), durations)
+        self.assertEqual((registry.stats()['errors'], registry.stats()['in_flight']), (1, 0))
+
+    def test_warm_up_builds_all_clients(self):
+        self.registry.warm_up()
+        self.assertEqual(self.registry.stats()['clients_created'], len(BedrockClientRegistry.SERVICES))
+
+class ProfileJobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.failures = 0
+        self.queue = ProfileJobQueue(DatabaseJobBackend(), self.process, backoff_seconds=0, max_attempts=2)
+
+    def process(self, user_email, turns, lease=None):
+        self.calls.append((user_email, list(turns)))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('throttled')
+
+    def test_pending_turns_are_coalesced_per_user(self):
+        backend = self.queue.backend
+        backend.enqueue('a@example.com', 'I want to run', 'Great')
+        backend.enqueue('b@example.com', 'hello', 'hi')
+        backend.enqueue('a@example.com', 'My dad is sick', 'Sorry')
+
+        while self.queue.run_once():
+            pass
+
+        self.assertEqual(self.calls, [
+            ('a@example.com', [('I want to run', 'Great'), ('My dad is sick', 'Sorry')]),
+            ('b@example.com', [('hello', 'hi')]),
+        ])
+        self.assertEqual(ProfileExtractionJob.objects.filter(status=ProfileExtractionJob.DONE).count(), 3)
+        stats = self.queue.stats()
+        self.assertEqual((stats['batches'], stats['jobs_processed'], stats['depth']), (2, 3, 0))
+
+    def test_failed_batches_are_retried_then_given_up(self):
+        self.queue.backend.enqueue('a@example.com', 'hi', 'hello')
+        self.failures = 5
+
+        self.assertTrue(self.queue.run_once())
+        job = ProfileExtractionJob.objects.get()
+        self.assertEqual((job.status, job.attempts, job.last_error), (ProfileExtractionJob.PENDING, 1, 'throttled'))
+
+        self.assertTrue(self.queue.run_once())
+        self.assertEqual(ProfileExtractionJob.objects.get().status, ProfileExtractionJob.FAILED)
+        self.assertFalse(self.queue.run_once())
+
+    def test_stale_worker_result_is_dropped(self):
+        self.queue.backend.enqueue('a@example.com', 'I want to run', 'Great')
+        agent = mock.Mock(generate_response=mock.Mock(return_value='{"goals": ["run"]}'))
+
+        def slow_worker(user_email, turns, lease=None):
+            # The lease runs out mid-call and another worker reclaims the batch
+            ProfileExtractionJob.objects.update(started_at=timezone.now() - timedelta(hours=1))
+            self.assertIsNotNone(self.queue.backend.claim(20))
+            update_user_profile(user_email, turns, bedrock=agent, lease=lease)
+        self.queue.processor = slow_worker
+
+        self.assertTrue(self.queue.run_once())
+        self.assertFalse(ProfileFact.objects.exists())
+        self.assertEqual(ProfileExtractionJob.objects.get().status, ProfileExtractionJob.RUNNING)
+        self.assertEqual((self.queue.stats()['stale'], self.queue.stats()['batches']), (1, 0))
+
+    def test_extraction_prompt_lists_every_turn(self):
+        prompt = build_extraction_prompt([('one', 'reply one'), ('two', 'reply two')])
+        self.assertIn('Previous message: one', prompt)
+        self.assertIn('Bot response: reply two', prompt)
+
+    def test_gate_skips_small_talk(self):
+        for message in ['ok thanks', 'Hi!', 'lol', 'What time is it?', 'Thanks, that helps a lot!']:
+            self.assertFalse(should_extract(message), message)
+        for message in ['My name is Sam', 'I want to run a marathon', 'my dad passed away last week',
+                        "I'm struggling with sleep", 'Me llamo Ana', 'I ' + 'really ' * 40 + 'do']:
+            self.assertTrue(should_extract(message), message)
+
+        queue = ProfileJobQueue(DatabaseJobBackend(), self.process, gate=should_extract)
+        with mock.patch.object(queue, 'start'):
+            self.assertFalse(queue.enqueue('a@example.com', 'ok thanks', 'You are welcome'))
+            self.assertTrue(queue.enqueue('a@example.com', 'I want to run', 'Great'))
+        self.assertEqual(list(ProfileExtractionJob.objects.values_list('message', flat=True)), ['I want to run'])
+        self.assertEqual(queue.stats()['skipped'], 1)
+
+    def test_turns_wait_until_the_user_is_idle(self):
+        queue = ProfileJobQueue(DatabaseJobBackend(), self.process, idle_seconds=60, max_wait_seconds=300)
+        with mock.patch.object(queue, 'start'):
+            queue.enqueue('a@example.com', 'I want to run', 'Great')
+            queue.enqueue('a@example.com', 'My dad is sick', 'Sorry')
+        self.assertFalse(queue.run_once())
+        self.assertEqual(len(set(ProfileExtractionJob.objects.values_list('run_after', flat=True))), 1)
+
+        queue.flush('a@example.com')
+        self.assertTrue(queue.run_once())
+        self.assertEqual(self.calls, [
+            ('a@example.com', [('I want to run', 'Great'), ('My dad is sick', 'Sorry')]),
+        ])
+        self.assertEqual(queue.stats()['calls_saved_ratio'], 0.5)
+
+    def test_max_wait_caps_the_delay(self):
+        backend = DatabaseJobBackend()
+        backend.enqueue('a@example.com', 'one', 'reply', delay=60, max_wait=300)
+        ProfileExtractionJob.objects.update(created_at=timezone.now() - timedelta(seconds=290))
+        backend.enqueue('a@example.com', 'two', 'reply', delay=60, max_wait=300)
+
+        run_after = set(ProfileExtractionJob.objects.values_list('run_after', flat=True))
+        self.assertEqual(len(run_after), 1)
+        self.assertLess(run_after.pop(), timezone.now() + timedelta(seconds=15))
+
+class UserContextCacheTests(TestCase):
+    def setUp(self):
+        caches['user_context'].clear()
+        record_facts('a@example.com', {'goals': ['run a marathon']})
+
+    def test_context_is_cached_until_profile_update(self):
+        self.assertIn('Goals: run a marathon', get_user_context('a@example.com'))
+        with self.assertNumQueries(0):
+            get_user_context('a@example.com')
+
+        agent = mock.Mock()
+        agent.generate_response.return_value = '{"challenges": ["sleep"]}'
+        with self.captureOnCommitCallbacks(execute=True):
+            update_user_profile('a@example.com', [('I sleep badly', 'Sorry')], bedrock=agent)
+
+        self.assertIn('Challenges: sleep', get_user_context('a@example.com'))
+
+    def test_context_respects_character_budget(self):
+        info = {'preferences': [f'preference {i}' for i in range(50)], 'first name': ['sam']}
+        context = build_context(info, max_chars=120)
+
+        self.assertLessEqual(len(context), 120)
+        self.assertIn('First Name: sam', context.splitlines()[1])
+        self.assertIn('preference 49', context)
+
+
+class ProfileFactTests(TestCase):
+    def test_facts_are_upserted_with_counters(self):
+        earlier = timezone.now() - timedelta(days=1)
+        self.assertEqual(record_facts('a@example.com', {'goals': ['Run a marathon', 'sleep more'],
+                                                        'First Name': ['Sam'], 'bogus': 'not a list'},
+                                      seen_at=earlier), 3)
+        with self.assertNumQueries(3):
+            new = record_facts('a@example.com', {'goals': ['run a marathon.', 'learn piano']})
+        self.assertEqual(new, 1)
+
+        marathon = ProfileFact.objects.get(user_email='a@example.com', item='Run a marathon')
+        self.assertEqual((marathon.mentions, marathon.first_seen), (2, earlier))
+        self.assertGreater(marathon.last_seen, earlier)
+        # Least recent (then least mentioned) first within a category, as build_context expects
+        self.assertEqual(load_key_information('a@example.com'), {
+            'first name': ['Sam'], 'goals': ['sleep more', 'learn piano', 'Run a marathon'],
+        })
+        self.assertEqual(list(load_key_information('a@example.com', limit=1).values()), [['Run a marathon']])
+        self.assertEqual(load_key_information('b@example.com'), {})
+
+    def test_json_profiles_are_copied(self):
+        import importlib
+        from django.apps import apps
+        from django.db import connection
+        migration = importlib.import_module('chat.migrations.0009_copy_profile_facts')
+        UserProfile.objects.create(user_email='a@example.com', key_information={
+            'goals': ['run', 'Run!', ''], 'challenges': ['sleep'], 'junk': {'x': 1},
+        })
+        UserProfile.objects.create(user_email='b@example.com', key_information={})
+
+        with mock.patch.object(migration, 'BATCH_SIZE', 1):
+            migration.copy_profile_facts(apps, mock.Mock(connection=connection))
+            migration.copy_profile_facts(apps, mock.Mock(connection=connection))
+
+        self.assertEqual(sorted(ProfileFact.objects.values_list('user_email', 'category', 'item')),
+                         [('a@example.com', 'challenges', 'sleep'), ('a@example.com', 'goals', 'run')])
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class AsyncMessageStreamTests(TestCase):
+    def setUp(self):
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        patcher = mock.patch('chat.bedrock.get_client_registry', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conversation = Conversation.objects.create(user_email='guest', session_id='async-stream')
+
+    async def test_asgi_request_streams_asynchronously(self):
+        response = await AsyncClient().post('/api/chat/message/', {
+            'conversationId': self.conversation.id, 'message': 'Hi', 'user_email': 'guest'
+        }, content_type='application/json')
+
+        self.assertTrue(response.is_async)
+        body = b''.join([part async for part in response.streaming_content]).decode()
+        stream_id = response['X-Stream-Id']
+        self.assertEqual(body, f'id: {stream_id}:1\ndata: {{"chunk": "Hello"}}\n\n'
+                               f'id: {stream_id}:2\ndata: {{"chunk": " there"}}\n\n')
+
+        messages = [m.content async for m in Message.objects.filter(conversation=self.conversation).order_by('id')]
+        self.assertEqual(messages, ['Hi', 'Hello there'])
+
+    async def test_default_scheduler_serves_many_concurrent_streams(self):
+        # The scheduler built from settings, not a test double: every stream holds a slot until it ends
+        self.stub.first_chunk_delay = 1.0
+        streams = 48
+        conversations = [await Conversation.objects.acreate(user_email=f'user{i}@example.com', session_id=f'many-{i}')
+                         for i in range(streams)]
+        peak = 0
+
+        async def watch(scheduler):
+            nonlocal peak
+            while True:
+                peak = max(peak, scheduler.stats()['in_flight'])
+                await asyncio.sleep(0.02)
+
+        async def chat(conversation):
+            response = await AsyncClient().post('/api/chat/message/', {
+                'conversationId': conversation.id, 'message': 'Hi', 'user_email': conversation.user_email
+            }, content_type='application/json')
+            return response.status_code, b''.join([part async for part in response.streaming_content])
+
+        with mock.patch('chat.scheduler._scheduler', None):
+            scheduler = get_upstream_scheduler()
+            watcher = asyncio.ensure_future(watch(scheduler))
+            results = await asyncio.gather(*(chat(conversation) for conversation in conversations))
+            watcher.cancel()
+
+        self.assertEqual({status for status, _ in results}, {200})
+        self.assertTrue(all(b'Hello' in body for _, body in results))
+        self.assertEqual(scheduler.stats()['queue_timeouts'], 0)
+        self.assertGreater(peak, 32)
+
+    async def test_disconnect_stops_upstream(self):
+        closed = threading.Event()
+
+        def upstream():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.set()
+
+        stream = iterate_in_thread(upstream, max_buffered=2)
+        self.assertEqual([await stream.__anext__() for _ in range(3)], [0, 1, 2])
+        await stream.aclose()
+
+        self.assertTrue(await asyncio.to_thread(closed.wait, 5))
+
+    @override_settings(CHAT_STREAM_RESUME={'ENABLED': False})
+    async def test_client_disconnect_cancels_generation_under_asgi(self):
+        from django.db import close_old_connections
+        from soar.asgi import application
+        # Like the test client: the test transaction has to outlive the request
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+        self.addCleanup(signals.request_started.connect, close_old_connections)
+        self.addCleanup(signals.request_finished.connect, close_old_connections)
+        self.stub.chunks = [f'chunk {i} ' for i in range(100)]
+        self.stub.chunk_delay = 0.05
+        scheduler = UpstreamScheduler(rate=0)
+        body = json.dumps({'conversationId': self.conversation.id, 'message': 'Hi', 'user_email': 'guest'}).encode()
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        gone = asyncio.Event()
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message.get('body'):
+                gone.set()
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST', 'scheme': 'http',
+            'path': '/api/chat/message/', 'raw_path': b'/api/chat/message/', 'query_string': b'', 'root_path': '',
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        with mock.patch('chat.views.get_upstream_scheduler', return_value=scheduler), \
+                mock.patch('chat.bedrock.get_upstream_scheduler', return_value=scheduler):
+            await asyncio.wait_for(application(scope, receive, send), 2)
+            for _ in range(100):
+                if scheduler.stats()['in_flight'] == 0:
+                    break
+                await asyncio.sleep(0.02)
+
+        # Generation would take 5s; the upstream stream was closed and its slot released right away
+        self.assertEqual(scheduler.stats()['in_flight'], 0)
+        self.assertLess(len([m for m in sent if m.get('body')]), 10)
+        self.assertNotIn({'type': 'http.response.body'}, sent)
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class ResumableStreamTests(TestCase):
+    def setUp(self):
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        patcher = mock.patch('chat.bedrock.get_client_registry', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Several turns on one conversation; keep them clear of the per-user rate limit
+        patcher = mock.patch('chat.views.get_upstream_scheduler', return_value=UpstreamScheduler(rate=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conversation = Conversation.objects.create(user_email='guest', session_id='resume')
+
+    def send(self, **headers):
+        return self.client.post('/api/chat/message/', {
+            'conversationId': self.conversation.id, 'message': 'Hi', 'user_email': 'guest'
+        }, content_type='application/json', headers=headers)
+
+    def test_reconnect_resumes_the_same_reply(self):
+        response = self.send()
+        stream_id = response['X-Stream-Id']
+        first = next(iter(response.streaming_content)).decode()
+        self.assertEqual(first, f'id: {stream_id}:1\ndata: {{"chunk": "Hello"}}\n\n')
+        # The client drops; the reply is still generated and saved
+        response.close()
+        self.assertEqual(list(self.conversation.messages.order_by('id').values_list('content', flat=True)),
+                         ['Hi', 'Hello there'])
+
+        resumed = self.send(**{'Last-Event-ID': f'{stream_id}:1'})
+        self.assertEqual(resumed.status_code, 200)
+        self.assertEqual(b''.join(resumed.streaming_content).decode(),
+                         f'id: {stream_id}:2\ndata: {{"chunk": " there"}}\n\n')
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+    def test_unknown_stream_is_gone(self):
+        for last_event_id in ('0' * 32 + ':1', 'garbage'):
+            response = self.send(**{'Last-Event-ID': last_event_id})
+            self.assertEqual(response.status_code, 410)
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(self.conversation.messages.count(), 0)
+
+    @override_settings(CHAT_STREAM_RESUME={'ENABLED': False})
+    def test_disabled_streams_carry_no_ids(self):
+        with mock.patch('chat.resumable._store', None):
+            response = self.send()
+            self.assertFalse(response.has_header('X-Stream-Id'))
+            self.assertEqual(b''.join(response.streaming_content).decode(),
+                             'data: {"chunk": "Hello"}\n\ndata: {"chunk": " there"}\n\n')
+
+    async def test_asgi_reconnect_resumes(self):
+        client = AsyncClient()
+        data = {'conversationId': self.conversation.id, 'message': 'Hi', 'user_email': 'guest'}
+        response = await client.post('/api/chat/message/', data, content_type='application/json')
+        stream_id = response['X-Stream-Id']
+        b''.join([part async for part in response.streaming_content])
+
+        resumed = await client.post('/api/chat/message/', data, content_type='application/json',
+                                    headers={'Last-Event-ID': f'{stream_id}:0'})
+        self.assertTrue(resumed.is_async)
+        body = b''.join([part async for part in resumed.streaming_content]).decode()
+        self.assertEqual(body, f'id: {stream_id}:1\ndata: {{"chunk": "Hello"}}\n\n'
+                               f'id: {stream_id}:2\ndata: {{"chunk": " there"}}\n\n')
+        self.assertEqual(len(self.stub.requests), 1)
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        for patcher in (mock.patch('chat.bedrock.get_client_registry', return_value=registry),
+                        mock.patch('chat.views.get_upstream_scheduler', return_value=UpstreamScheduler(rate=0)),
+                        mock.patch('chat.idempotency._store', MemoryIdempotencyStore())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeated_create_returns_the_same_conversation(self):
+        first = self.client.post('/api/chat/conversation/', {'userId': 'a@example.com'},
+                                 content_type='application/json', headers={'Idempotency-Key': 'new-1'})
+        second = self.client.post('/api/chat/conversation/', {'userId': 'a@example.com'},
+                                  content_type='application/json', headers={'Idempotency-Key': 'new-1'})
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Conversation.objects.filter(user_email='a@example.com').count(), 1)
+
+        # Same key, different request
+        other = self.client.post('/api/chat/conversation/', {'userId': 'b@example.com'},
+                                 content_type='application/json', headers={'Idempotency-Key': 'new-1'})
+        self.assertEqual(other.status_code, 200)  # another owner, another scope
+        reused = self.client.post('/api/chat/conversation/', {'userId': 'a@example.com', 'x': 1},
+                                  content_type='application/json', headers={'Idempotency-Key': 'new-1'})
+        self.assertEqual(reused.status_code, 422)
+
+    def test_repeated_message_attaches_to_the_same_reply(self):
+        conversation = Conversation.objects.create(user_email='guest', session_id='idempotent')
+        data = {'conversationId': conversation.id, 'message': 'Hi', 'user_email': 'guest'}
+        first = self.client.post('/api/chat/message/', data, content_type='application/json',
+                                 headers={'Idempotency-Key': 'send-1'})
+        second = self.client.post('/api/chat/message/', data, content_type='application/json',
+                                  headers={'Idempotency-Key': 'send-1'})
+
+        self.assertEqual(second['X-Stream-Id'], first['X-Stream-Id'])
+        first_body = b''.join(first.streaming_content)
+        self.assertEqual(b''.join(second.streaming_content), first_body)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(list(conversation.messages.order_by('id').values_list('content', flat=True)),
+                         ['Hi', 'Hello there'])
+
+    def test_failures_are_not_remembered(self):
+        data = {'conversationId': 1, 'message': 'Hi', 'user_email': 'guest'}
+        with mock.patch('chat.views.MessageView.start_turn', side_effect=RuntimeError('boom')):
+            response = self.client.post('/api/chat/message/', data, content_type='application/json',
+                                        headers={'Idempotency-Key': 'send-2'})
+        self.assertEqual(response.status_code, 500)
+        response = self.client.post('/api/chat/message/', data, content_type='application/json',
+                                    headers={'Idempotency-Key': 'send-2'})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+
+class IdempotencyStoreTests(TestCase):
+    def check_store(self, store):
+        pending = {'state': PENDING, 'fingerprint': 'f'}
+        done = {'state': DONE, 'fingerprint': 'f', 'status': 200, 'data': {'id': 1}}
+        self.assertIsNone(store.claim('k', pending, 60))
+        self.assertEqual(store.claim('k', pending, 60), pending)
+
+        # A duplicate waits for the request in flight and gets its result
+        timer = threading.Timer(0.05, store.complete, ('k', done, 60))
+        timer.start()
+        self.assertEqual(store.wait('k', timeout=5), done)
+        self.assertEqual(store.claim('k', pending, 60), done)
+
+        store.release('k')
+        self.assertIsNone(store.claim('k', pending, 60))
+
+    def test_memory_store(self):
+        clock = FakeClock()
+        store = MemoryIdempotencyStore(clock=clock)
+        self.check_store(store)
+        clock.now += 61
+        self.assertIsNone(store.claim('k', {'state': PENDING, 'fingerprint': 'g'}, 60))
+
+    def test_cache_store(self):
+        caches['chat_idempotency'].clear()
+        self.check_store(CacheIdempotencyStore(caches['chat_idempotency'], poll_seconds=0.01))
+
+
+class ReplayStoreTests(TestCase):
+    def check_store(self, store):
+        store.open('s')
+        self.assertEqual(store.read('s'), ([], False))
+        for text in 'abc':
+            store.append('s', {'chunk': text})
+
+        # Only the newest two frames are kept
+        self.assertIsNone(store.read('s', 0))
+        self.assertEqual(store.read('s', 1), ([(2, {'chunk': 'b'}), (3, {'chunk': 'c'})], False))
+        self.assertIsNone(store.read('s', 4))
+        self.assertIsNone(store.read('other', 0))
+
+        # A waiting reader wakes up on the next frame
+        timer = threading.Timer(0.05, store.append, ('s', {'chunk': 'd'}))
+        timer.start()
+        self.assertEqual(store.wait('s', 3, timeout=5), ([(4, {'chunk': 'd'})], False))
+        store.finish('s')
+        self.assertEqual(store.wait('s', 4, timeout=5), ([], True))
+
+    def test_memory_store(self):
+        clock = FakeClock()
+        store = MemoryReplayStore(ttl=60, max_frames=2, clock=clock)
+        self.check_store(store)
+        clock.now += 61
+        self.assertIsNone(store.read('s', 4))
+        store.open('next')
+        self.assertEqual(store.stats(), {'streams': 2, 'frames': 4, 'expired': 1, 'active': 1})
+
+    def test_cache_store(self):
+        caches['chat_streams'].clear()
+        self.check_store(CacheReplayStore(caches['chat_streams'], max_frames=2, poll_seconds=0.01))
+
+    def test_parse_event_id(self):
+        self.assertEqual(parse_event_id(' abc:12 '), ('abc', 12))
+        self.assertIsNone(parse_event_id('abc'))
+        self.assertIsNone(parse_event_id(':3'))
+
+
+class MessagePersistenceTests(TestCase):
+    def setUp(self):
+        self.first = Conversation.objects.create(user_email='a@example.com', session_id='persist-1')
+        self.second = Conversation.objects.create(user_email='a@example.com', session_id='persist-2')
+
+    def test_turn_updates_conversation_in_one_transaction(self):
+        before = self.first.updated_at
+        with self.assertNumQueries(4):  # savepoint, UPDATE, INSERT, release
+            write_messages([
+                Message(conversation=self.first, content='Hi', user_email='a@example.com'),
+                Message(conversation=self.first, content='Hello!'),
+            ])
+
+        self.first.refresh_from_db()
+        self.assertEqual((self.first.message_count, self.first.last_message), (2, 'Hello!'))
+        self.assertGreater(self.first.updated_at, before)
+
+    def test_write_behind_buffer_flushes_many_conversations_at_once(self):
+        buffer = WriteBehindBuffer(flush_interval=60)
+        buffer._thread = threading.current_thread()  # Flush by hand instead of in the background
+        buffer.add(Message(conversation=self.first, content='one'), Message(conversation=self.second, content='two'))
+        buffer.add(Message(conversation=self.first, content='three'))
+        buffer.flush()
+
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.message_count, self.first.last_message), (2, 'three'))
+        self.assertEqual((self.second.message_count, self.second.last_message), (1, 'two'))
+        self.assertEqual(buffer.stats(), {'flushes': 1, 'messages': 3, 'errors': 0, 'pending': 0})
+
+    def test_user_message_is_saved_before_streaming(self):
+        response = self.client.post('/api/chat/message/', {
+            'conversationId': self.first.id, 'message': 'Hi', 'user_email': 'guest'
+        }, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(self.first.messages.values_list('content', flat=True)), ['Hi'])
+
+        response = self.client.post('/api/chat/message/', {
+            'conversationId': 0, 'message': 'Hi', 'user_email': 'guest'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+class FakeWhisperModel:
+    device = 'cpu'
+
+    def __init__(self, release=None):
+        self.release = release
+        self.calls = []
+
+    def transcribe(self, audio, **options):
+        if self.release:
+            self.release.wait(5)
+        self.calls.append(options)
+        return {'text': f' {len(audio) // SAMPLE_RATE}s', 'language': options.get('language') or 'en'}
+
+
+class SpeechToTextPoolTests(TestCase):
+    def test_decode_wav_without_ffmpeg(self):
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(8000)
+            wav.writeframes(np.full(8000 * 2, 16384, np.int16).tobytes())
+
+        audio = decode_audio(buffer.getvalue())
+        self.assertEqual(audio.dtype, np.float32)
+        self.assertEqual(len(audio), SAMPLE_RATE)
+        self.assertAlmostEqual(float(audio.mean()), 0.5, places=3)
+
+    def test_silence_is_trimmed_before_transcription(self):
+        rng = np.random.default_rng(0)
+        second = SAMPLE_RATE
+
+        def noise(seconds, level):
+            return (rng.standard_normal(int(seconds * second)) * level).astype(np.float32)
+        audio = np.concatenate([noise(2, 0.001), noise(1, 0.1), noise(3, 0.001), noise(1, 0.1), noise(2, 0.001)])
+
+        trimmed = trim_silence(audio, padding_seconds=0.2, max_pause_seconds=0.5)
+        # Two 1 s bursts, 0.2 s padding around each, and the 3 s pause cut to 0.5 s
+        self.assertAlmostEqual(len(trimmed) / second, 2 + 4 * 0.2 + 0.5, delta=0.1)
+        self.assertEqual(len(trim_silence(np.zeros(second, np.float32))), 0)
+        self.assertEqual(len(trim_silence(audio[2 * second:3 * second])), second)
+
+    def test_downsampling_filters_out_aliases(self):
+        t = np.arange(48000) / 48000
+        self.assertEqual(len(resample(np.sin(2 * np.pi * 1000 * t), 48000)), SAMPLE_RATE)
+        # 10 kHz is above the new Nyquist frequency and would otherwise fold back to 6 kHz
+        aliased = resample(np.sin(2 * np.pi * 10000 * t), 48000)
+        self.assertLess(float(np.abs(aliased[100:-100]).max()), 0.05)
+
+    def test_silent_uploads_are_rejected_early(self):
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            wav.writeframes(np.zeros(SAMPLE_RATE * 5, np.int16).tobytes())
+        upload = io.BytesIO(buffer.getvalue())
+        upload.name = 'clip.wav'
+        with mock.patch('chat.views.get_transcription_pool') as pool:
+            response = self.client.post('/api/chat/speech-to-text/', {'audio': upload, 'user_email': 'guest'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'No speech detected in the recording')
+        pool.assert_not_called()
+
+        with self.assertRaises(NoSpeechDetected):
+            prepare_audio(wav_bytes(0.1))
+        prepared = prepare_audio(wav_bytes(3))
+        self.assertEqual((prepared.original_seconds, prepared.trimmed_seconds), (3, 0))
+
+    def test_segments_come_back_in_order(self):
+        pool = TranscriptionPool(lambda index: FakeWhisperModel(), replicas=2)
+        audio = np.zeros(SAMPLE_RATE * 70, np.float32)
+
+        results = list(transcribe_audio(pool, audio, segment_seconds=30))
+        self.assertEqual([(i, r['text']) for i, r in results], [(0, ' 30s'), (1, ' 30s'), (2, ' 10s')])
+        self.assertEqual(pool.stats()['segments'], 3)
+        self.assertEqual(pool.stats()['pending'], 0)
+
+    def test_full_pool_rejects_whole_recording(self):
+        release = threading.Event()
+        pool = TranscriptionPool(lambda index: FakeWhisperModel(release), replicas=1, max_pending=3)
+        first = transcribe_audio(pool, np.zeros(SAMPLE_RATE * 60, np.float32), segment_seconds=30)
+
+        with self.assertRaises(TranscriptionQueueFull):
+            transcribe_audio(pool, np.zeros(SAMPLE_RATE * 60, np.float32), segment_seconds=30)
+        release.set()
+        self.assertEqual(len(list(first)), 2)
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+    def test_failed_replica_load_frees_its_slot(self):
+        attempts = []
+
+        def factory(index):
+            attempts.append(index)
+            if len(attempts) == 1:
+                raise RuntimeError("CUDA out of memory")
+            return FakeWhisperModel()
+        pool = TranscriptionPool(factory, replicas=1, max_pending=1)
+
+        with self.assertRaises(RuntimeError):
+            list(transcribe_audio(pool, np.zeros(SAMPLE_RATE * 10, np.float32)))
+        self.assertEqual(pool.stats()['pending'], 0)
+        results = list(transcribe_audio(pool, np.zeros(SAMPLE_RATE * 10, np.float32)))
+        self.assertEqual(results[0][1]['text'], ' 10s')
+        self.assertEqual(attempts, [0, 0])
+
+
+class WhisperLoadingTests(TestCase):
+    def test_model_loads_once_on_first_use(self):
+        with mock.patch('chat.stt._model', None), \
+                mock.patch('chat.stt.load_whisper_model', return_value=FakeWhisperModel()) as load:
+            self.assertIs(get_model(), get_model())
+        load.assert_called_once_with('small', 'auto', '')
+
+    def test_int8_quantizes_linear_layers(self):
+        import torch
+        from whisper.model import ModelDimensions, Whisper
+        dims = ModelDimensions(n_mels=80, n_audio_ctx=16, n_audio_state=32, n_audio_head=2, n_audio_layer=1,
+                               n_vocab=100, n_text_ctx=8, n_text_state=32, n_text_head=2, n_text_layer=1)
+        with mock.patch('whisper.load_model', return_value=Whisper(dims)):
+            model = load_whisper_model('tiny', 'cpu', 'int8')
+
+        dynamic_linear = torch.ao.nn.quantized.dynamic.Linear
+        self.assertIsInstance(model.encoder.blocks[0].mlp[0], dynamic_linear)
+        self.assertIsInstance(model.decoder.blocks[0].attn.query, dynamic_linear)
+
+
+def wav_bytes(seconds: float) -> bytes:
+    # A steady tone: loud enough to count as speech throughout, so nothing is trimmed
+    tone = np.sin(np.arange(int(seconds * SAMPLE_RATE)) * 2 * np.pi * 220 / SAMPLE_RATE) * 8000
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(tone.astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def pcm_bytes(seconds: float, rate: int = SAMPLE_RATE, amplitude: int = 8000) -> bytes:
+    tone = np.sin(np.arange(int(seconds * rate)) * 2 * np.pi * 220 / rate) * amplitude
+    return tone.astype('<i2').tobytes()
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+class VoiceSocketTests(TestCase):
+    def setUp(self):
+        self.model = FakeWhisperModel()
+        pool = TranscriptionPool(lambda index: self.model, replicas=1)
+        patcher = mock.patch('chat.realtime.get_transcription_pool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, query: str = '', path: str = '/ws/chat/voice/'):
+        from soar.asgi import application
+        inbound, outbound = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': path, 'query_string': query.encode(), 'headers': []}
+        task = asyncio.ensure_future(application(scope, inbound.get, outbound.put))
+        inbound.put_nowait({'type': 'websocket.connect'})
+        return inbound, outbound, task
+
+    async def receive_json(self, outbound):
+        message = await asyncio.wait_for(outbound.get(), 5)
+        self.assertEqual(message['type'], 'websocket.send', message)
+        return json.loads(message['text'])
+
+    async def test_partials_then_final(self):
+        inbound, outbound, task = self.connect('user_email=guest&language=en')
+        self.assertEqual((await outbound.get())['type'], 'websocket.accept')
+
+        for second in (1, 2, 3):
+            await inbound.put({'type': 'websocket.receive', 'bytes': pcm_bytes(1)})
+            self.assertEqual(await self.receive_json(outbound), {'type': 'partial', 'text': f'{second}s'})
+        await inbound.put({'type': 'websocket.receive', 'bytes': pcm_bytes(0.5)})
+        await inbound.put({'type': 'websocket.receive', 'text': '{"type": "stop"}'})
+
+        self.assertEqual(await self.receive_json(outbound), {'type': 'final', 'text': '3s', 'language': 'en'})
+        self.assertEqual((await outbound.get())['type'], 'websocket.close')
+        await task
+        self.assertEqual(len(self.model.calls), 4)
+        self.assertTrue(all(call['language'] == 'en' for call in self.model.calls))
+
+    async def test_silence_is_not_decoded(self):
+        inbound, outbound, task = self.connect('rate=8000')
+        await outbound.get()
+        await inbound.put({'type': 'websocket.receive', 'bytes': bytes(8000 * 2 * 2)})
+        await inbound.put({'type': 'websocket.receive', 'text': '{"type": "stop"}'})
+
+        self.assertEqual(await self.receive_json(outbound), {'type': 'final', 'text': '', 'language': None})
+        await task
+        self.assertEqual(self.model.calls, [])
+
+    async def test_final_transcript_starts_the_reply(self):
+        stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=stub.endpoint_url)
+        conversation = await Conversation.objects.acreate(user_email='guest', session_id='voice-reply')
+
+        with mock.patch('chat.bedrock.get_client_registry', return_value=registry):
+            inbound, outbound, task = self.connect(f'conversationId={conversation.id}&language=en')
+            await outbound.get()
+            await inbound.put({'type': 'websocket.receive', 'bytes': pcm_bytes(0.5)})
+            await inbound.put({'type': 'websocket.receive', 'text': '{"type": "stop", "reply": true}'})
+
+            replies = [await self.receive_json(outbound) for _ in range(4)]
+            await task
+        self.assertEqual(replies, [
+            {'type': 'final', 'text': '0s', 'language': 'en'},
+            {'type': 'reply', 'chunk': 'Hello'},
+            {'type': 'reply', 'chunk': ' there'},
+            {'type': 'done'},
+        ])
+        messages = [m.content async for m in Message.objects.filter(conversation=conversation).order_by('id')]
+        self.assertEqual(messages, ['0s', 'Hello there'])
+
+    async def test_idle_socket_is_closed(self):
+        with self.settings(CHAT_VOICE={'IDLE_SECONDS': 0.1}):
+            inbound, outbound, task = self.connect()
+            await outbound.get()
+            await inbound.put({'type': 'websocket.receive', 'bytes': pcm_bytes(0.2)})
+
+            self.assertEqual(await self.receive_json(outbound), {'type': 'error', 'error': 'No audio for 0.1s'})
+            self.assertEqual(await asyncio.wait_for(outbound.get(), 5), {'type': 'websocket.close', 'code': 1000})
+            await task
+
+    async def test_unknown_path_is_refused(self):
+        inbound, outbound, task = self.connect(path='/ws/other/')
+        self.assertEqual(await outbound.get(), {'type': 'websocket.close', 'code': 4404})
+        await task
+
+    def test_long_window_commits_all_but_last_segment(self):
+        live = LiveTranscript(max_window_seconds=2)
+        for _ in range(4):
+            live.feed(pcm_bytes(0.625))
+        chunks, samples = live.window()
+        self.assertIsNotNone(live.prepare(chunks))
+        text = live.apply({'text': ' one two', 'segments': [
+            {'start': 0.0, 'text': ' one'}, {'start': 1.5, 'text': ' two'},
+        ]}, samples)
+
+        self.assertEqual(text, 'one')
+        self.assertEqual(live.buffered, SAMPLE_RATE)
+        live.apply({'text': ' two three'}, live.window()[1], final=True)
+        self.assertEqual(live.text, 'one two three')
+
+
+class LanguageDetectionTests(TestCase):
+    def setUp(self):
+        caches['user_context'].clear()
+        self.model = FakeWhisperModel()
+        self.pool = TranscriptionPool(lambda index: self.model, replicas=1)
+
+    def transcribe(self, seconds: float):
+        audio = io.BytesIO(wav_bytes(seconds))
+        audio.name = 'clip.wav'
+        with mock.patch('chat.views.get_transcription_pool', return_value=self.pool), \
+                mock.patch('chat.stt.detect_spoken_language', return_value='es') as detect:
+            response = self.client.post('/api/chat/speech-to-text/', {
+                'audio': audio, 'user_email': 'a@example.com', 'conversationId': 7
+            })
+        self.assertEqual(response.status_code, 200)
+        return response.json(), detect
+
+    def test_text_detector_needs_enough_text(self):
+        self.assertEqual(detect_text_language("Hola, me gustaría hablar sobre mis metas para este año"), 'es')
+        self.assertIsNone(detect_text_language("ok"))
+
+    def test_conversation_language_wins_over_user_language(self):
+        remember_language('de', 'a@example.com', conversation_id=1)
+        remember_language('fr', 'a@example.com', conversation_id=2)
+        self.assertEqual(get_language('a@example.com', 1), 'de')
+        self.assertEqual(get_language('a@example.com', 3), 'fr')
+        self.assertIsNone(get_language('guest', 3))
+
+    def test_long_audio_detects_once_then_reuses_language(self):
+        body, detect = self.transcribe(70)
+        detect.assert_called_once()
+        self.assertEqual(body['detected_language'], 'es')
+        self.assertEqual([call['language'] for call in self.model.calls], ['es', 'es', 'es'])
+
+        body, detect = self.transcribe(70)
+        detect.assert_not_called()
+        self.assertEqual(get_language('a@example.com', 7), 'es')
+        self.assertEqual(self.pool.stats()['language_detections'], 1)
+
+    def test_short_audio_detects_while_transcribing(self):
+        body, detect = self.transcribe(5)
+        detect.assert_not_called()
+        self.assertIsNone(self.model.calls[0]['language'])
+        self.assertEqual(get_language('a@example.com', 7), 'en')
+
+    def test_language_reaches_the_prompt(self):
+        prompt = MessageView().build_prompt("", "Hola", 'es')
+        self.assertIn("language (ISO 639-1) is es", prompt)
+        self.assertNotIn("ISO 639-1", MessageView().build_prompt("", "Hi"))
+
+
+class LoadTestToolsTests(TestCase):
+    def test_seeded_data_is_deterministic(self):
+        emails = seed_chat_data(users=2, conversations=3, messages=4, seed=1)
+        first = list(Conversation.objects.filter(user_email__in=emails).order_by('session_id')
+                     .values_list('session_id', 'message_count', 'last_message'))
+        self.assertEqual(len(first), 6)
+        self.assertEqual(Message.objects.filter(conversation__user_email__in=emails).count(), 24)
+
+        seed_chat_data(users=2, conversations=3, messages=4, seed=1)
+        again = list(Conversation.objects.filter(user_email__in=emails).order_by('session_id')
+                     .values_list('session_id', 'message_count', 'last_message'))
+        self.assertEqual(first, again)
+
+    def test_query_counter_and_percentiles(self):
+        with QueryCounter() as queries:
+            list(Conversation.objects.all())
+            Message.objects.count()
+        self.assertEqual(queries.count, 2)
+        self.assertEqual(percentile([0.3, 0.1, 0.2], 50), 0.2)
+
+
+@mock.patch.dict(os.environ, STUB_AWS_ENV)
+@override_settings(INSTRUMENTATION={'ENABLED': True, 'SAMPLE_RATE': 1.0, 'METRICS_TOKEN': 'secret'})
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.stub = StubBedrockServer(chunks=['Hello', ' there']).start()
+        self.addCleanup(self.stub.stop)
+        registry = BedrockClientRegistry(region_name='us-east-1', endpoint_url=self.stub.endpoint_url)
+        patcher = mock.patch('chat.bedrock.get_client_registry', return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = instrumentation.Histogram('t_seconds', "Test", ('route',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, route='a')
+        histogram.observe(0.5, route='a')
+        self.assertEqual(list(histogram.render())[2:], [
+            't_seconds_bucket{route="a",le="0.1"} 1',
+            't_seconds_bucket{route="a",le="1.0"} 2',
+            't_seconds_bucket{route="a",le="+Inf"} 2',
+            't_seconds_sum{route="a"} 0.55',
+            't_seconds_count{route="a"} 2',
+        ])
+
+    def test_sampled_request_records_queries(self):
+        route = 'api/chat/conversations/'
+        before = instrumentation.DB_QUERIES.count(route=route)
+        with self.assertLogs('chat.instrumentation') as logs:
+            self.client.get('/api/chat/conversations/', {'email': 'nobody@example.com'})
+        self.assertEqual(instrumentation.DB_QUERIES.count(route=route), before + 1)
+        self.assertIn('"db_queries": 1', instrumentation.JsonFormatter().format(logs.records[0]))
+
+    def test_stream_and_upstream_timings(self):
+        conversation = Conversation.objects.create(user_email='guest', session_id='instrumented')
+        streams = instrumentation.STREAMS.value(outcome='ok')
+        first_chunks = instrumentation.BEDROCK_FIRST_CHUNK.count()
+        response = self.client.post('/api/chat/message/', {
+            'conversationId': conversation.id, 'message': 'Hi', 'user_email': 'guest'
+        }, content_type='application/json')
+        b''.join(response.streaming_content)
+
+        self.assertEqual(instrumentation.STREAMS.value(outcome='ok'), streams + 1)
+        self.assertEqual(instrumentation.BEDROCK_FIRST_CHUNK.count(), first_chunks + 1)
+
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE soar_http_requests_total counter', response.content)
+
+    @override_settings(INSTRUMENTATION={'ENABLED': True, 'SAMPLE_RATE': 0.0, 'METRICS_TOKEN': ''})
+    def test_metrics_without_token_are_staff_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create_user('user', password='x'))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create_user('ops', password='x', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    async def test_middleware_runs_natively_under_asgi(self):
+        async def view(request):
+            await Conversation.objects.filter(user_email='nobody@example.com').aexists()
+            return HttpResponse('ok')
+        middleware = instrumentation.InstrumentationMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        before = instrumentation.HTTP_REQUESTS.value(method='GET', route='unmatched', status=200)
+        with self.assertLogs('chat.instrumentation') as logs:
+            response = await middleware(RequestFactory().get('/'))
+        self.assertEqual(response.content, b'ok')
+        self.assertEqual(instrumentation.HTTP_REQUESTS.value(method='GET', route='unmatched', status=200), before + 1)
+        self.assertEqual(logs.records[0].fields['db_queries'], 1)
+
+        # Sync DRF views run their queries on a sync_to_async thread; those count too
+        with self.assertLogs('chat.instrumentation') as logs:
+            await AsyncClient().get('/api/chat/conversations/', {'email': 'nobody@example.com'})
+        self.assertGreater(logs.records[0].fields['db_queries'], 0)
+
+
+class StreamFilterTests(TestCase):
+    def run_filter(self, chunks):
+        reply = ReplyStream(flush_size=0, flush_interval=0)
+        sent = ''.join(coalesce(chunks, reply))
+        self.assertEqual(sent, reply.text)
+        return sent
+
+    def test_profile_json_split_across_chunks_is_dropped(self):
+        chunks = ['Great to meet you! ', '{"first', ' name": ["Sam"], "goals": ["run a \\"10k\\" {soon}"', ']}', ' See you.']
+        self.assertEqual(self.run_filter(chunks), 'Great to meet you!  See you.')
+
+    def test_json_looking_replies_are_kept(self):
+        for reply in ['42', '[1, 2]', '{"answer": 42}', 'Use {curly} braces', 'A set {1, 2}', '{ unfinished']:
+            self.assertEqual(self.run_filter(list(reply)), reply)
+
+    def test_oversized_candidate_is_released(self):
+        payload_filter = StructuredPayloadFilter(max_hold=10)
+        text = '{"goals": ["a very long goal"]}'
+        self.assertEqual(''.join(payload_filter.feed(char) for char in text) + payload_filter.finish(), text)
+
+    def test_coalescer_flushes_by_size_and_time(self):
+        now = [0.0]
+        coalescer = ChunkCoalescer(flush_size=6, flush_interval=0.05, clock=lambda: now[0])
+        self.assertEqual(coalescer.add('a'), 'a')  # First text goes straight out
+        self.assertIsNone(coalescer.add('b'))
+        self.assertEqual(coalescer.add('cdefg'), 'bcdefg')
+        self.assertIsNone(coalescer.add('h'))
+        now[0] = 0.06
+        self.assertEqual(coalescer.add('i'), 'hi')
+
+    async def test_async_flushes_while_upstream_is_quiet(self):
+        async def upstream():
+            for chunk in ['Hel', 'lo', ' there']:
+                yield chunk
+            await asyncio.sleep(0.3)
+            yield '!'
+
+        frames = [text async for text in acoalesce(upstream(), ReplyStream(flush_size=100, flush_interval=0.05))]
+        self.assertEqual(frames, ['Hel', 'lo there', '!'])
@@ -0,0 +1,11 @@
+import re
+import unicodedata
+
+_SPACE = re.compile(r'\s+')
+_EDGE_PUNCTUATION = ' \t\n.,!?¡¿…~-:;\'"'
+
+
+def normalize_message(text: str) -> str:
+    """Fold case, width and whitespace, and drop edge punctuation: 'Hi!! ' and 'hi' are the same turn"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return _SPACE.sub(' ', text).strip(_EDGE_PUNCTUATION)
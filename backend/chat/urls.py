@@ -1,10 +1,15 @@
 from django.urls import path
-from .views import FeedbackCreateView, ConversationView, MessageView, SpeechToTextView, ConversationListView
+from .views import FeedbackCreateView, FeedbackBulkCreateView, FeedbackAnalyticsView, ConversationView, MessageView, SpeechToTextView, ConversationListView, ConversationMessagesView, MessageSearchView, ConversationEndView
 
 urlpatterns = [
     path('feedback/', FeedbackCreateView.as_view(), name='create_feedback'),
+    path('feedback/bulk/', FeedbackBulkCreateView.as_view(), name='bulk_create_feedback'),
+    path('feedback/analytics/', FeedbackAnalyticsView.as_view(), name='feedback_analytics'),
     path('conversation/', ConversationView.as_view(), name='get_conversation'),
     path('message/', MessageView.as_view(), name='send_message'),
     path('speech-to-text/', SpeechToTextView.as_view(), name='speech_to_text'),
     path('conversations/', ConversationListView.as_view(), name='conversation_list'),
+    path('conversations/<int:conversation_id>/messages/', ConversationMessagesView.as_view(), name='conversation_messages'),
+    path('conversations/<int:conversation_id>/end/', ConversationEndView.as_view(), name='end_conversation'),
+    path('search/', MessageSearchView.as_view(), name='search_messages'),
 ]
\ No newline at end of file
@@ -1,69 +1,267 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .models import Feedback, Conversation, Message, UserProfile
+from .models import Feedback, Conversation, Message
 from .serializers import FeedbackSerializer, ConversationSerializer, MessageSerializer
+from .pagination import InvalidCursor, decode_sync_cursor, encode_cursor, encode_sync_cursor, keyset_before, parse_limit
 import requests
 import uuid
-from langdetect import detect
-import whisper
-import tempfile
-import threading
 import logging
+import math
 import time
+from .instrumentation import CHAT_STREAM_RESUMES, StreamTimer, annotate
 from .bedrock import BedrockAgent
+from .context import get_user_context
+from .jobs import get_profile_job_queue
+from .persistence import record_reply, record_user_message
+from .search import search_messages
+from .sync import CursorTooOld, conversation_changes, etag_matches, sidebar_etag, sidebar_state, start_cursor
+from .feedback import feedback_summary, record_feedback
+from .idempotency import idempotent
+from .stream_filter import ReplyStream, acoalesce, coalesce
+from .streaming import iterate_in_thread
+from .language import detect_text_language, get_language, remember_language
+from .memory import ConversationMemory, load_memory, maybe_summarize
+from .agent_sessions import AgentSession, checkout_session, end_session, record_turn
+from .response_cache import get_response_cache
+from .resumable import areplay, buffered, get_replay_store, new_stream_id, parse_event_id, replay, sse_event
+from .scheduler import UpstreamRejected, get_upstream_scheduler
+from .stt import (
+    SAMPLE_RATE, AudioDecodeError, TranscriptionQueueFull, get_transcription_pool, prepare_audio, transcribe_audio
+)
 from django.http import StreamingHttpResponse
 import json
 from rest_framework.decorators import api_view
 
+logger = logging.getLogger(__name__)
+
+def serialize_message(msg):
+    return {
+        'id': msg.id,
+        'content': msg.content,
+        'user_email': msg.user_email,
+        'timestamp': msg.timestamp,
+        'image': None
+    }
+
+def serialize_conversation(conv, messages=()):
+    return {
+        'id': conv.id,
+        'title': f"Conversation {conv.id}",
+        'lastMessage': conv.last_message,
+        'messageCount': conv.message_count,
+        'timestamp': conv.updated_at,
+        'messages': [serialize_message(msg) for msg in messages]
+    }
+
+def busy_payload(error: UpstreamRejected) -> dict:
+    return {'error': 'The assistant is busy; try again shortly', 'retryAfter': math.ceil(error.retry_after)}
+
 class ConversationListView(APIView):
     def get(self, request):
         user_email = request.GET.get('email')
         if not user_email:
             return Response({"error": "Email required"}, status=status.HTTP_400_BAD_REQUEST)
-            
+
+        limit = parse_limit(request.GET.get('limit'), settings.CHAT_CONVERSATION_PAGE_SIZE,
+                            settings.CHAT_CONVERSATION_MAX_PAGE_SIZE) or 1
+        window = parse_limit(request.GET.get('messages'), settings.CHAT_CONVERSATION_MESSAGE_WINDOW,
+                             settings.CHAT_MESSAGE_MAX_PAGE_SIZE)
+
+        since = request.GET.get('since')
+        if since:
+            # Validated before any 304, which would otherwise answer a malformed cursor
+            try:
+                since_time = decode_sync_cursor(since)
+            except InvalidCursor:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+        cursor = request.GET.get('cursor')
+        # Every parameter shaping the body is in the ETag, so full lists and deltas never share one
+        etag_params = ('since', since, window) if since else ('list', limit, window, cursor or '')
+        etag = None
+        if request.headers.get('If-None-Match'):
+            # Steady state: one aggregate query and an empty 304
+            etag = sidebar_etag(user_email, *sidebar_state(user_email), *etag_params)
+            if etag_matches(request.headers['If-None-Match'], etag):
+                return self.with_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+        if since:
+            return self.changes(user_email, since_time, window, etag or sidebar_etag(
+                user_email, *sidebar_state(user_email), *etag_params
+            ))
+
+        sync_cursor = encode_sync_cursor(start_cursor())
         conversations = Conversation.objects.filter(
             user_email=user_email,
             is_active=True
-        ).order_by('-updated_at')
-        
-        conversation_data = []
-        for conv in conversations:
-            messages = conv.messages.all().order_by('timestamp')
-            conversation_data.append({
-                'id': conv.id,
-                'title': f"Conversation {conv.id}",
-                'lastMessage': messages.last().content if messages.exists() else "",
-                'timestamp': conv.updated_at,
-                'messages': [{
-                    'content': msg.content,
-                    'user_email': msg.user_email,
-                    'timestamp': msg.timestamp,
-                    'image': None
-                } for msg in messages]
-            })
-            
-        return Response(conversation_data)
-    
+        ).defer('summary').order_by('-updated_at', '-id')
+
+        if cursor:
+            try:
+                conversations = conversations.filter(keyset_before('updated_at', cursor))
+            except InvalidCursor:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Newest N messages per conversation in one extra query (window function under the hood)
+        if window:
+            conversations = conversations.prefetch_related(Prefetch(
+                'messages',
+                queryset=Message.objects.order_by('-timestamp', '-id')[:window],
+                to_attr='recent_messages'
+            ))
+
+        page = list(conversations[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        conversation_data = [
+            serialize_conversation(conv, reversed(getattr(conv, 'recent_messages', []))) for conv in page
+        ]
+
+        if etag is None:
+            # A first page holding every conversation already has the newest updated_at and the count
+            state = (page[0].updated_at if page else None, len(page)) if not (cursor or has_more) \
+                else sidebar_state(user_email)
+            etag = sidebar_etag(user_email, *state, *etag_params)
+        response = self.with_validators(Response(conversation_data), etag)
+        # Where a later ?since= request picks up
+        response['X-Sync-Cursor'] = sync_cursor
+        if has_more:
+            response['X-Next-Cursor'] = encode_cursor(page[-1].updated_at, page[-1].id)
+        return response
+
+    def changes(self, user_email: str, since, window: int, etag: str):
+        """Conversations and messages added or changed after the ``since`` cursor time, plus deletions"""
+        try:
+            active, messages, deleted, cursor = conversation_changes(
+                user_email, since, settings.CHAT_CONVERSATION_MAX_PAGE_SIZE, window
+            )
+        except CursorTooOld:
+            return Response({"error": "Too much has changed; fetch the list again"}, status=status.HTTP_410_GONE)
+        response = self.with_validators(Response({
+            'conversations': [serialize_conversation(conv, messages.get(conv.id, [])) for conv in active],
+            'deleted': deleted,
+            'cursor': encode_sync_cursor(cursor),
+        }), etag)
+        response['X-Sync-Cursor'] = encode_sync_cursor(cursor)
+        return response
+
+    def with_validators(self, response: Response, etag: str) -> Response:
+        response['ETag'] = etag
+        # Browsers keep the list but revalidate it every time, so a plain refetch turns into a 304
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+class ConversationMessagesView(APIView):
+    def get(self, request, conversation_id):
+        user_email = request.GET.get('email')
+        if not user_email:
+            return Response({"error": "Email required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        conversation = get_object_or_404(Conversation, id=conversation_id, user_email=user_email)
+        limit = parse_limit(request.GET.get('limit'), settings.CHAT_MESSAGE_PAGE_SIZE,
+                            settings.CHAT_MESSAGE_MAX_PAGE_SIZE) or 1
+
+        # Walk backwards from the newest message, keyed on (timestamp, id)
+        messages = conversation.messages.order_by('-timestamp', '-id')
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                messages = messages.filter(keyset_before('timestamp', cursor))
+            except InvalidCursor:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        page = list(messages[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        response = Response([serialize_message(msg) for msg in reversed(page)])
+        if has_more:
+            response['X-Next-Cursor'] = encode_cursor(page[-1].timestamp, page[-1].id)
+        return response
+
+class MessageSearchView(APIView):
+    def get(self, request):
+        user_email = request.GET.get('email')
+        query = request.GET.get('q', '').strip()
+        if not user_email:
+            return Response({"error": "Email required"}, status=status.HTTP_400_BAD_REQUEST)
+        if not query:
+            return Response({"error": "Query required"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(query) > settings.CHAT_SEARCH_MAX_QUERY_LENGTH:
+            return Response({"error": "Query too long"}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = parse_limit(request.GET.get('limit'), settings.CHAT_SEARCH_PAGE_SIZE,
+                            settings.CHAT_SEARCH_MAX_PAGE_SIZE) or 1
+        try:
+            results, next_cursor = search_messages(user_email, query, limit, request.GET.get('cursor'))
+        except InvalidCursor:
+            return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = Response(results)
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
+
+class ConversationEndView(APIView):
+    def post(self, request, conversation_id):
+        user_email = request.data.get('user_email')
+        if not user_email:
+            return Response({"error": "Email required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        conversation = get_object_or_404(Conversation, id=conversation_id, user_email=user_email)
+        if user_email != 'guest':
+            # Extract what this conversation taught us now rather than waiting for the user to go idle
+            get_profile_job_queue().flush(user_email)
+        end_session(conversation.id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 class FeedbackCreateView(APIView):
     def post(self, request):
         try:
-            # Print the received data for debugging
-            print("Received feedback data:", request.data)
-            
             serializer = FeedbackSerializer(data=request.data)
             if serializer.is_valid():
-                serializer.save()
+                record_feedback([serializer.validated_data])
                 return Response({'message': 'Feedback submitted successfully'})
-            # Print validation errors if any
-            print("Validation errors:", serializer.errors)
+            logger.info("Feedback validation failed: %s", serializer.errors)
             return Response(serializer.errors, status=400)
         except Exception as e:
-            # Print the actual error
-            print("Error submitting feedback:", str(e))
+            logger.exception("Error submitting feedback")
             return Response({'error': str(e)}, status=500)
 
+class FeedbackBulkCreateView(APIView):
+    def post(self, request):
+        if not isinstance(request.data, list) or not request.data:
+            return Response({"error": "Expected a non-empty list of feedback items"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > settings.FEEDBACK_BULK_MAX_ITEMS:
+            return Response({"error": f"At most {settings.FEEDBACK_BULK_MAX_ITEMS} items per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = FeedbackSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            logger.info("Bulk feedback validation failed: %s", serializer.errors)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        created = record_feedback(serializer.validated_data)
+        return Response({'message': 'Feedback submitted successfully', 'created': len(created)},
+                        status=status.HTTP_201_CREATED)
+
+class FeedbackAnalyticsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        try:
+            days = int(request.GET.get('days', settings.FEEDBACK_ANALYTICS_DAYS))
+        except ValueError:
+            return Response({"error": "days must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        days = max(1, min(days, settings.FEEDBACK_ANALYTICS_MAX_DAYS))
+        return Response(feedback_summary(days, request.GET.get('type') or None))
+
 class ConversationView(APIView):
     def get(self, request):
         user = request.user if request.user.is_authenticated else None
@@ -77,7 +275,11 @@ class ConversationView(APIView):
     def post(self, request):
         user = request.user if request.user.is_authenticated else None
         user_email = request.data.get('userId')
-        
+        # A retried or double-clicked create returns the conversation made the first time
+        return idempotent(request, 'conversation', user_email or 'guest',
+                          lambda: self.create_conversation(user, user_email))
+
+    def create_conversation(self, user, user_email):
         session_id = str(uuid.uuid4())
         conversation = Conversation.objects.create(
             user=user,
@@ -94,180 +296,300 @@ class ConversationView(APIView):
         })
 
 class MessageView(APIView):
-    def update_user_profile(self, user_email: str, message_content: str, bot_response: str):
-        bedrock = BedrockAgent()
-        
-        prompt = """Based on this conversation, extract any important information about the user's:
-        - Goals
-        - Preferences
-        - Challenges
-        - Important life events
-        - First Name
-
-        Previous message: {message}
-        Bot response: {response}
-
-        Format your response EXACTLY as a JSON object with these categories as keys, or return an empty JSON object if no important information found.
-        Example: {{"goals": ["wants to work out daily"], "challenges": ["finding time to exercise"], "first name": ["james"], "preferences": ["speak in english only"], "important life events": ["father is in the hospital"]}}
-        Only respond with the JSON object, nothing else.""".format(
-            message=message_content,
-            response=bot_response
+    def get_relevant_context(self, user_email: str) -> str:
+        return get_user_context(user_email)
+
+    def build_prompt(self, context: str, user_message: str, language: str = None,
+                     memory: ConversationMemory = None) -> str:
+        language_line = (
+            f"The user's language (ISO 639-1) is {language}; reply in it unless they ask otherwise.\n"
+            if language else ""
+        )
+        return (
+            f"{context}\n"
+            f"{language_line}"
+            f"{(memory or ConversationMemory()).render()}"
+            f"User: {user_message}\n"
+            "Assistant:"
         )
 
+    def response_cache_key(self, context: str, user_message: str, language: str, memory: ConversationMemory):
+        """Key for replaying a cached reply, or None unless caching is on and this is a context-free first turn"""
+        cache = get_response_cache()
+        if cache is None:
+            return None
+        if context or memory.summary or memory.turns:
+            cache.skip()
+            return None
+        agent = BedrockAgent()
+        surroundings = f"{agent.agent_id}:{agent.agent_alias_id}\n{self.build_prompt('', '', language, memory)}"
+        return cache.key_for(user_message, surroundings)
+
+    def post(self, request):
+        asynchronous = isinstance(request._request, ASGIRequest)
         try:
-            extraction = bedrock.generate_response(prompt, user_email)
-            # Clean the response to ensure it's valid JSON
-            extraction = extraction.strip()
-            if extraction:
-                try:
-                    info = json.loads(extraction)
-                    if isinstance(info, dict):  # Verify we got a valid dictionary
-                        profile, created = UserProfile.objects.get_or_create(user_email=user_email)
-                        
-                        # Update existing information
-                        for category, items in info.items():
-                            if isinstance(items, list):  # Verify items is a list
-                                if category not in profile.key_information:
-                                    profile.key_information[category] = items
-                                else:
-                                    # Convert to set to remove duplicates
-                                    existing_items = set(profile.key_information[category])
-                                    new_items = set(items)
-                                    profile.key_information[category] = list(existing_items | new_items)
-                        
-                        profile.save()
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse extraction response: {extraction}")
-                    print(f"JSON Error: {e}")
+            # A retry of a dropped stream picks up the running (or finished) reply instead of a new turn
+            last_event_id = request.headers.get('Last-Event-ID')
+            if last_event_id:
+                return self.resume(last_event_id, asynchronous)
+
+            # Repeats of a keyed request attach to the reply the first one started
+            return idempotent(
+                request, 'message', request.data.get('user_email') or 'guest',
+                lambda: self.send(request, asynchronous),
+                replay_stream=lambda stream_id: self.resume(f'{stream_id}:0', asynchronous),
+            )
         except Exception as e:
-            print(f"Error updating user profile: {e}")
+            return Response({'error': str(e)}, status=500)
 
-    def get_relevant_context(self, user_email: str) -> str:
+    def send(self, request, asynchronous: bool = False):
+        store = get_replay_store()
+        stream_id = new_stream_id() if store is not None else None
+        turn = self.start_turn(request.data.get('conversationId'), request.data.get('message'),
+                               request.data.get('user_email'), asynchronous=asynchronous, stream_id=stream_id)
+        if isinstance(turn, Response):
+            return turn
+        response = StreamingHttpResponse(turn, content_type='text/event-stream')
+        if stream_id:
+            # Lets a client that lost the stream before its first event resume with "<id>:0"
+            response['X-Stream-Id'] = stream_id
+        return response
+
+    def resume(self, last_event_id: str, asynchronous: bool = False):
+        store = get_replay_store()
+        event = parse_event_id(last_event_id)
+        if store is None or event is None or store.read(*event) is None:
+            CHAT_STREAM_RESUMES.inc(outcome='expired')
+            return Response({'error': 'This reply can no longer be resumed'}, status=status.HTTP_410_GONE)
+        CHAT_STREAM_RESUMES.inc(outcome='resumed')
+        stream_id, after = event
+        frames = areplay(store, stream_id, after) if asynchronous else replay(store, stream_id, after)
+        response = StreamingHttpResponse(frames, content_type='text/event-stream')
+        response['X-Stream-Id'] = stream_id
+        return response
+
+    def start_turn(self, conversation_id, user_message: str, user_email: str, asynchronous: bool = False,
+                   stream_id: str = None):
+        """Admit, record and start one chat turn.
+
+        Returns the reply's SSE frames (an async generator when ``asynchronous``)
+        or, when the turn can't start, an error Response. With a ``stream_id``
+        the frames carry event ids and are kept in the replay store, and the
+        reply is generated to the end even if the client goes away. Voice
+        sockets call this directly with the final transcript.
+        """
+        # Get user context if logged in
+        context = ""
+        if user_email and user_email != 'guest':
+            context = self.get_relevant_context(user_email)
+
+        # Cheap text detection; messages too short to call keep the language seen last
+        known_language = get_language(user_email, conversation_id)
+        language = detect_text_language(user_message) or known_language
+        if language != known_language:
+            remember_language(language, user_email, conversation_id)
+
+        # Per-user token bucket: a burst of retries is turned away before any work is done
         try:
-            profile = UserProfile.objects.get(user_email=user_email)
-            if profile.key_information:
-                context = "Important information about this user:\n"
-                for category, items in profile.key_information.items():
-                    context += f"{category.title()}: {', '.join(items)}\n"
-                print(context)
-                return context
-        except UserProfile.DoesNotExist:
-            return ""
-        return ""
+            get_upstream_scheduler().admit(
+                user_email if user_email and user_email != 'guest' else f'guest:{conversation_id}'
+            )
+        except UpstreamRejected as e:
+            response = Response({'error': 'Too many messages; try again shortly'},
+                                status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = str(math.ceil(e.retry_after))
+            return response
 
-    def post(self, request):
+        # One agent session per conversation, so threads (and guests) don't share upstream context
+        session = checkout_session(conversation_id)
+        if session is None:
+            return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Bounded history of this conversation: rolling summary plus the newest turns
+        memory = load_memory(conversation_id)
+
+        # Prepare the prompt with user context. A live agent session already holds the earlier turns,
+        # so only a new (or rotated) one is seeded with the history
+        system_message = self.build_prompt(context, user_message, language,
+                                           memory if session.turns == 0 else None)
+        cache_key = self.response_cache_key(context, user_message, language, memory)
+
+        # Saved up front so the user's message survives a dropped stream
         try:
-            conversation_id = request.data.get('conversationId')
-            user_message = request.data.get('message')
-            user_email = request.data.get('user_email')
+            record_user_message(conversation_id, user_message, user_email)
+        except Conversation.DoesNotExist:
+            return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
 
-            # Get user context if logged in
-            context = ""
-            if user_email and user_email != 'guest':
-                context = self.get_relevant_context(user_email)
-
-            # Prepare the prompt with user context
-            system_message = (
-                f"{context}\n"
-                "Current conversation:\n"
-                f"User: {user_message}\n"
-                "Assistant:"
-            )
+        # Under ASGI the stream runs on the event loop instead of pinning a worker thread
+        if asynchronous:
+            payloads = self.agenerate_reply(system_message, conversation_id, user_message, user_email,
+                                            memory, session, cache_key)
+            if stream_id:
+                return buffered(get_replay_store(), stream_id, payloads)
+            return (sse_event(payload) async for payload in payloads)
+        payloads = self.generate_reply(system_message, conversation_id, user_message, user_email,
+                                       memory, session, cache_key)
+        if stream_id:
+            return buffered(get_replay_store(), stream_id, payloads)
+        return (sse_event(payload) for payload in payloads)
 
-            return StreamingHttpResponse(
-                self.stream_response(system_message, conversation_id, user_message, user_email),
-                content_type='text/event-stream'
-            )
-            
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
+    def new_reply(self) -> ReplyStream:
+        return ReplyStream(settings.CHAT_STREAM_FLUSH_SIZE, settings.CHAT_STREAM_FLUSH_INTERVAL)
 
-    def stream_response(self, prompt: str, conversation_id: str, user_message: str, user_email: str):
+    def upstream(self, bedrock: BedrockAgent, prompt: str, user_email: str, session: AgentSession = None,
+                 cache_key: str = None):
+        upstream = bedrock.generate_stream(prompt, user_email=user_email,
+                                           session_id=session.session_id if session else None)
+        if cache_key:
+            # Replays a cached reply chunk for chunk, or records this one
+            upstream = get_response_cache().stream(cache_key, upstream)
+        return upstream
+
+    def generate_reply(self, prompt: str, conversation_id: str, user_message: str, user_email: str,
+                       memory: ConversationMemory = None, session: AgentSession = None, cache_key: str = None):
+        """Stream the agent's reply as ``{'chunk': ...}`` payloads (or one ``{'error': ...}``) and save it"""
         bedrock = BedrockAgent()
-        full_response = ""
-        
+        reply = self.new_reply()
+        timer = StreamTimer(conversation_id=conversation_id, asgi=False)
+        outcome = 'disconnected'
+
         try:
-            # Generate chat response first
-            for chunk in bedrock.generate_stream(prompt, user_email=user_email):
-                # Only filter out valid JSON objects that match our expected format
-                try:
-                    json_obj = json.loads(chunk)
-                    expected_keys = ['goals', 'preferences', 'challenges', 'important life events', 'first name']
-                    if any(key.lower() in json_obj for key in expected_keys):
-                        continue  # Skip profile update JSON
-                except json.JSONDecodeError:
-                    # Not a JSON object, send it to the user
-                    full_response += chunk
-                    yield f"data: {json.dumps({'chunk': chunk})}\n\n"
-            
-            # Save the message after getting full response
-            conversation = Conversation.objects.get(id=conversation_id)
-            
-            # Save user message
-            Message.objects.create(
-                conversation=conversation,
-                content=user_message,
-                user_email=user_email
-            )
+            # Leaked profile JSON is dropped and tiny chunks are merged before they go out
+            upstream = self.upstream(bedrock, prompt, user_email, session, cache_key)
+            for text in coalesce(upstream, reply):
+                timer.chunk(text)
+                yield {'chunk': text}
+            full_response = reply.text
+            turn_seconds = time.perf_counter() - timer.started
             
             # Save bot response
-            Message.objects.create(
-                conversation=conversation,
-                content=full_response.strip()
-            )
+            record_reply(conversation_id, full_response.strip())
+            # A cached reply never reached the agent session
+            if session is not None and not getattr(upstream, 'hit', False):
+                record_turn(session, len(prompt) + len(full_response), turn_seconds)
+            if memory is not None:
+                maybe_summarize(conversation_id, memory)
             
             # Update user profile with new information
             if user_email and user_email != 'guest':
-                # Do this in the background to not affect response time
-                threading.Thread(
-                    target=self.update_user_profile,
-                    args=(user_email, user_message, full_response)
-                ).start()
+                # Queued for the background workers so it never delays the stream
+                get_profile_job_queue().enqueue(user_email, user_message, full_response)
+            outcome = 'ok'
                 
+        except UpstreamRejected as e:
+            outcome = 'rejected'
+            yield busy_payload(e)
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-class SpeechToTextUtils:
-    _instance = None
+            outcome = 'error'
+            logger.exception("Chat stream failed")
+            yield {'error': str(e)}
+        finally:
+            timer.finish(outcome)
 
-    def __new__(cls, model_size="small"):
-        if cls._instance is None:
-            cls._instance = super(SpeechToTextUtils, cls).__new__(cls)
-            cls._instance.model = whisper.load_model(model_size)
-        return cls._instance
+    async def agenerate_reply(self, prompt: str, conversation_id: str, user_message: str, user_email: str,
+                              memory: ConversationMemory = None, session: AgentSession = None,
+                              cache_key: str = None):
+        bedrock = BedrockAgent()
+        reply = self.new_reply()
+        timer = StreamTimer(conversation_id=conversation_id, asgi=True)
+        outcome = 'disconnected'
 
-    def detect_language(self, file_path):
-        audio = whisper.load_audio(file_path)
-        audio = whisper.pad_or_trim(audio)
-        mel = whisper.log_mel_spectrogram(audio).to(self.model.device)
-        _, probs = self.model.detect_language(mel)
-        return max(probs, key=probs.get)
+        try:
+            source = self.upstream(bedrock, prompt, user_email, session, cache_key)
+            upstream = iterate_in_thread(lambda: source, max_buffered=settings.CHAT_STREAM_MAX_BUFFERED_CHUNKS)
+            frames = acoalesce(upstream, reply)
+            try:
+                async for text in frames:
+                    timer.chunk(text)
+                    yield {'chunk': text}
+            finally:
+                await frames.aclose()
+            full_response = reply.text
+            turn_seconds = time.perf_counter() - timer.started
 
-    def transcribe(self, file_path):
-        return self.model.transcribe(file_path)
+            # Transactions are sync-only, so the write hops to a thread
+            await sync_to_async(record_reply)(conversation_id, full_response.strip())
+            if session is not None and not getattr(source, 'hit', False):
+                await sync_to_async(record_turn)(session, len(prompt) + len(full_response), turn_seconds)
+            if memory is not None:
+                maybe_summarize(conversation_id, memory)
 
-# stt utils instantiation for model loading upon server startup
-speech_to_text_utils = SpeechToTextUtils('small')
+            if user_email and user_email != 'guest':
+                await sync_to_async(get_profile_job_queue().enqueue)(user_email, user_message, full_response)
+            outcome = 'ok'
 
+        except asyncio.CancelledError:
+            # Client left an unbuffered stream; iterate_in_thread stops the upstream stream
+            raise
+        except UpstreamRejected as e:
+            outcome = 'rejected'
+            yield busy_payload(e)
+        except Exception as e:
+            outcome = 'error'
+            logger.exception("Chat stream failed")
+            yield {'error': str(e)}
+        finally:
+            timer.finish(outcome)
 
 class SpeechToTextView(APIView):
     def post(self, request):
         audio_file = request.FILES.get('audio')
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_audio:
-            for chunk in audio_file.chunks():
-                temp_audio.write(chunk)
-            temp_audio_path = temp_audio.name
-
         if not audio_file:
             return Response({"error": "No audio file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        response = speech_to_text_utils.transcribe(temp_audio_path)
-        
-        transcribed_text = response['text']
-        detected_lang = response['language']
+        try:
+            # Decoded, resampled and trimmed of silence before anything is queued for Whisper
+            prepared = prepare_audio(audio_file.read())
+        except AudioDecodeError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        audio = prepared.audio
+        annotate(audio_seconds=round(prepared.original_seconds, 2), speech_seconds=round(prepared.seconds, 2))
+
+        conversation_id = request.data.get('conversationId')
+        user_email = request.data.get('user_email')
+        segment_seconds = settings.CHAT_STT['SEGMENT_SECONDS']
+        pool = get_transcription_pool()
+        try:
+            # 'auto' forces detection, e.g. after the user switches language
+            language = request.data.get('language') or get_language(user_email, conversation_id)
+            if language == 'auto':
+                language = None
+            if language is None and len(audio) > segment_seconds * SAMPLE_RATE:
+                # Detect once up front so the segments don't each run their own detection pass.
+                # A single segment detects as part of its own transcription at no extra cost.
+                language = pool.detect_language(audio)
+            # Long recordings are split and their segments decoded in parallel
+            segments = transcribe_audio(pool, audio, segment_seconds, language=language)
+        except TranscriptionQueueFull:
+            response = Response({"error": "Transcription is busy, try again shortly"},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = '2'
+            return response
+
+        if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+            return StreamingHttpResponse(self.stream_transcript(segments, user_email, conversation_id),
+                                         content_type='text/event-stream')
+
+        results = [result for _, result in segments]
+        transcribed_text = "".join(result['text'] for result in results).strip()
+        detected_lang = results[0]['language']
+        remember_language(detected_lang, user_email, conversation_id)
 
         if not transcribed_text:
             return Response({"error": "Could not transcribe audio"}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({"text": transcribed_text, "detected_language": detected_lang})
\ No newline at end of file
+        return Response({"text": transcribed_text, "detected_language": detected_lang})
+
+    def stream_transcript(self, segments, user_email=None, conversation_id=None):
+        """Send each segment's text as soon as it and everything before it is done"""
+        parts = []
+        detected_lang = None
+        try:
+            for index, result in segments:
+                parts.append(result['text'])
+                detected_lang = detected_lang or result['language']
+                yield f"data: {json.dumps({'index': index, 'partial': result['text']})}\n\n"
+            remember_language(detected_lang, user_email, conversation_id)
+            yield f"data: {json.dumps({'text': ''.join(parts).strip(), 'detected_language': detected_lang})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
@@ -13,4 +13,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'soar.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from chat.realtime import voice_socket  # noqa: E402
+from chat.streaming import cancel_on_disconnect  # noqa: E402
+
+# Stops a reply's generation (and frees its upstream slot) when the client goes away
+django_application = cancel_on_disconnect(django_application)
+
+
+async def application(scope, receive, send):
+    # Django only speaks HTTP; WebSockets (live voice input) are handled by chat.realtime
+    if scope['type'] == 'websocket':
+        return await voice_socket(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -14,6 +14,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 import os
 from datetime import timedelta
+from corsheaders.defaults import default_headers
 
 load_dotenv()
 
@@ -49,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.instrumentation.InstrumentationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -148,3 +150,240 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True  # Only for development, configure properly for production
+CORS_EXPOSE_HEADERS = ['X-Next-Cursor', 'X-Sync-Cursor', 'ETag', 'X-Stream-Id', 'Idempotent-Replayed']
+CORS_ALLOW_HEADERS = (*default_headers, 'last-event-id', 'idempotency-key', 'if-none-match')
+
+# Chat history pagination
+CHAT_CONVERSATION_PAGE_SIZE = int(os.getenv('CHAT_CONVERSATION_PAGE_SIZE', 50))
+CHAT_CONVERSATION_MAX_PAGE_SIZE = 100
+CHAT_CONVERSATION_MESSAGE_WINDOW = int(os.getenv('CHAT_CONVERSATION_MESSAGE_WINDOW', 20))
+CHAT_MESSAGE_PAGE_SIZE = 50
+CHAT_MESSAGE_MAX_PAGE_SIZE = 200
+# Sidebar delta syncs (?since=): each cursor overlaps the previous one by OVERLAP_SECONDS so rows
+# committed late aren't missed; older cursors than MAX_AGE_DAYS (tombstone retention) get a 410
+CHAT_SYNC_OVERLAP_SECONDS = 5
+CHAT_SYNC_MAX_AGE_DAYS = 30
+
+# Message search: PostgreSQL full text ('auto') or substring matching ('like', also used on other databases).
+# Force 'like' until `manage.py backfill_search_vectors` has indexed existing messages.
+CHAT_SEARCH_BACKEND = os.getenv('CHAT_SEARCH_BACKEND', 'auto')
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 50
+CHAT_SEARCH_MAX_QUERY_LENGTH = 200
+
+# Async (ASGI) chat streaming; concurrent streams per process are capped by CHAT_UPSTREAM['MAX_CONCURRENT']
+CHAT_STREAM_THREADS = int(os.getenv('CHAT_STREAM_THREADS', 1024))
+CHAT_STREAM_MAX_BUFFERED_CHUNKS = 8
+# After the first chunk, merge upstream chunks into one SSE frame per this many characters or seconds
+CHAT_STREAM_FLUSH_SIZE = int(os.getenv('CHAT_STREAM_FLUSH_SIZE', 256))
+CHAT_STREAM_FLUSH_INTERVAL = float(os.getenv('CHAT_STREAM_FLUSH_INTERVAL', 0.05))
+
+# Resumable replies: SSE events carry "<stream id>:<seq>" ids and are kept for TTL_SECONDS after the
+# last one (newest MAX_FRAMES per reply). A POST with Last-Event-ID resumes the reply, which goes on
+# generating after a disconnect. BACKEND 'memory' is per process; 'cache' uses CACHES['chat_streams'].
+CHAT_STREAM_RESUME = {
+    'ENABLED': os.getenv('CHAT_STREAM_RESUME', 'true').lower() in ('1', 'true', 'yes'),
+    'BACKEND': os.getenv('CHAT_STREAM_RESUME_BACKEND', 'memory'),
+    'CACHE': 'chat_streams',
+    'TTL_SECONDS': int(os.getenv('CHAT_STREAM_RESUME_TTL_SECONDS', 300)),
+    'MAX_FRAMES': 1000,
+    'MAX_STREAMS': 10000,
+    'POLL_SECONDS': 0.1,
+}
+
+# Idempotency-Key on POST conversation/ and message/: results are replayed for TTL_SECONDS (a reply
+# only while its stream is still in CHAT_STREAM_RESUME) and repeats of a request still running wait
+# up to WAIT_SECONDS for it. BACKEND 'memory' is per process; 'cache' uses CACHES['chat_idempotency'].
+CHAT_IDEMPOTENCY = {
+    'ENABLED': os.getenv('CHAT_IDEMPOTENCY', 'true').lower() in ('1', 'true', 'yes'),
+    'BACKEND': os.getenv('CHAT_IDEMPOTENCY_BACKEND', 'memory'),
+    'CACHE': 'chat_idempotency',
+    'TTL_SECONDS': int(os.getenv('CHAT_IDEMPOTENCY_TTL_SECONDS', 86400)),
+    'LOCK_SECONDS': 60,
+    'WAIT_SECONDS': 10,
+    'MAX_KEYS': 100000,
+    'POLL_SECONDS': 0.05,
+}
+
+# Buffer chat message writes and flush them in batches (off by default; buffered messages are lost on a crash)
+CHAT_PERSISTENCE = {
+    'WRITE_BEHIND': os.getenv('CHAT_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'),
+    'FLUSH_INTERVAL': 0.2,
+    'MAX_BATCH': 500,
+}
+
+# Speech-to-text. Whisper loads on first use unless PRELOAD (load in AppConfig.ready, so
+# `gunicorn --preload` workers share one copy) or WARM_UP (load in the background at startup).
+# BACKEND 'sidecar' sends audio to `manage.py serve_stt` and never loads the model in web workers.
+CHAT_STT = {
+    'BACKEND': os.getenv('CHAT_STT_BACKEND', 'local'),
+    'SIDECAR_URL': os.getenv('CHAT_STT_SIDECAR_URL', 'http://127.0.0.1:8765'),
+    'MODEL': os.getenv('CHAT_STT_MODEL', 'small'),
+    'DEVICE': os.getenv('CHAT_STT_DEVICE', 'auto'),
+    'QUANTIZE': os.getenv('CHAT_STT_QUANTIZE', ''),  # 'int8': dynamic int8 linear layers, CPU only
+    'PRELOAD': os.getenv('CHAT_STT_PRELOAD', '').lower() in ('1', 'true', 'yes'),
+    'WARM_UP': os.getenv('CHAT_STT_WARM_UP', '').lower() in ('1', 'true', 'yes'),
+    'REPLICAS': int(os.getenv('CHAT_STT_REPLICAS', 1)),
+    'MAX_PENDING_SEGMENTS': int(os.getenv('CHAT_STT_MAX_PENDING_SEGMENTS', 16)),
+    'SEGMENT_SECONDS': 30,
+    # Energy VAD before transcription: leading/trailing silence is cut and pauses shortened to
+    # VAD_MAX_PAUSE_SECONDS; clips under MIN_SECONDS, or with under MIN_SPEECH_SECONDS of speech, get a 400
+    'VAD': os.getenv('CHAT_STT_VAD', 'true').lower() in ('1', 'true', 'yes'),
+    'VAD_THRESHOLD_DB': -50.0,
+    'VAD_PADDING_SECONDS': 0.2,
+    'VAD_MAX_PAUSE_SECONDS': 0.5,
+    'MIN_SECONDS': 0.3,
+    'MIN_SPEECH_SECONDS': 0.3,
+}
+
+# Live voice input over a WebSocket at /ws/chat/voice/ (see chat.realtime): the growing window is
+# re-decoded every STEP_SECONDS of new audio and committed once it reaches MAX_WINDOW_SECONDS
+CHAT_VOICE = {
+    'ENABLED': os.getenv('CHAT_VOICE_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'STEP_SECONDS': float(os.getenv('CHAT_VOICE_STEP_SECONDS', 1.0)),
+    'MAX_WINDOW_SECONDS': 20.0,
+    'MAX_SECONDS': int(os.getenv('CHAT_VOICE_MAX_SECONDS', 300)),
+    # Sockets that send nothing for this long are closed
+    'IDLE_SECONDS': float(os.getenv('CHAT_VOICE_IDLE_SECONDS', 30)),
+}
+
+# Conversation memory in prompts: a rolling summary (refreshed in the background once more than
+# SUMMARIZE_AFTER messages are unsummarized) plus the newest WINDOW_MESSAGES messages, within HISTORY_TOKENS
+CHAT_MEMORY = {
+    'SUMMARIES': os.getenv('CHAT_MEMORY_SUMMARIES', 'true').lower() in ('1', 'true', 'yes'),
+    'WINDOW_MESSAGES': int(os.getenv('CHAT_MEMORY_WINDOW_MESSAGES', 12)),
+    'HISTORY_TOKENS': int(os.getenv('CHAT_MEMORY_HISTORY_TOKENS', 1500)),
+    'SUMMARY_TOKENS': 400,
+    'SUMMARIZE_AFTER': 24,
+    'MAX_FOLD_MESSAGES': 100,
+}
+
+# Bedrock agent sessions, one per conversation. A fresh session starts after IDLE_SECONDS without
+# use (the agent's own idle TTL defaults to 600s) or once a session has seen MAX_TURNS turns or
+# MAX_CHARS characters; history then comes from CHAT_MEMORY alone.
+CHAT_AGENT_SESSIONS = {
+    'IDLE_SECONDS': int(os.getenv('CHAT_AGENT_SESSION_IDLE_SECONDS', 600)),
+    'MAX_TURNS': int(os.getenv('CHAT_AGENT_SESSION_MAX_TURNS', 40)),
+    'MAX_CHARS': int(os.getenv('CHAT_AGENT_SESSION_MAX_CHARS', 100000)),
+}
+
+# Upstream agent calls, per process: a concurrency cap shared by interactive chat and background
+# work (profile extraction, summaries), per-user token buckets on chat messages, and AIMD backoff
+# when Bedrock throttles. Each live chat stream holds a slot for its whole reply, so MAX_CONCURRENT
+# is also the number of concurrent streams a process serves; it defaults to the Bedrock connection
+# pool size, past which calls would only queue inside botocore. Throttling shrinks it as needed.
+CHAT_UPSTREAM = {
+    'MAX_CONCURRENT': int(os.getenv('CHAT_UPSTREAM_MAX_CONCURRENT', os.getenv('BEDROCK_MAX_POOL_CONNECTIONS', 256))),
+    'MIN_CONCURRENT': 2,
+    'BACKGROUND_SHARE': 0.25,
+    'INTERACTIVE_TIMEOUT': float(os.getenv('CHAT_UPSTREAM_INTERACTIVE_TIMEOUT', 10.0)),
+    'BACKGROUND_TIMEOUT': 60.0,
+    'USER_RATE': float(os.getenv('CHAT_UPSTREAM_USER_RATE', 0.5)),  # messages per second, sustained
+    'USER_BURST': int(os.getenv('CHAT_UPSTREAM_USER_BURST', 5)),
+    'BACKOFF_SECONDS': 0.5,
+    'MAX_BACKOFF_SECONDS': 30.0,
+}
+
+# Caches; locmem is per-process and LRU. Point 'user_context' at Redis/Memcached to share it.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'user_context': {
+        'BACKEND': os.getenv('USER_CONTEXT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('USER_CONTEXT_CACHE_LOCATION', 'user-context'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Cached replies to context-free first turns. Use FileBasedCache or RedisCache
+    # (django.core.cache.backends.redis.RedisCache, needs redis-py) to share them between workers.
+    'chat_responses': {
+        'BACKEND': os.getenv('CHAT_RESPONSE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CHAT_RESPONSE_CACHE_LOCATION', 'chat-responses'),
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+    # Replay buffers of chat streams when CHAT_STREAM_RESUME['BACKEND'] is 'cache'; must be shared
+    # (e.g. RedisCache) for a reconnect to resume on another worker
+    'chat_streams': {
+        'BACKEND': os.getenv('CHAT_STREAM_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CHAT_STREAM_CACHE_LOCATION', 'chat-streams'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # Idempotency-Key records when CHAT_IDEMPOTENCY['BACKEND'] is 'cache'; needs an atomic add()
+    # (RedisCache, Memcached) to be shared between workers
+    'chat_idempotency': {
+        'BACKEND': os.getenv('CHAT_IDEMPOTENCY_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CHAT_IDEMPOTENCY_CACHE_LOCATION', 'chat-idempotency'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Replay agent replies to repeated greeting-style first turns (no profile context, no history)
+CHAT_RESPONSE_CACHE = {
+    'ENABLED': os.getenv('CHAT_RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes'),
+    'CACHE': 'chat_responses',
+    'TIMEOUT': int(os.getenv('CHAT_RESPONSE_CACHE_TIMEOUT', 3600)),
+    'MAX_MESSAGE_CHARS': 120,
+    'REPLAY_DELAY': 0.0,  # seconds between replayed chunks
+}
+
+# Last detected language per conversation/user, reused for prompts and to skip Whisper's detection pass
+CHAT_LANGUAGE_CACHE = 'user_context'
+CHAT_LANGUAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Feedback: items accepted per bulk request, and the analytics window (days)
+FEEDBACK_BULK_MAX_ITEMS = 500
+FEEDBACK_ANALYTICS_DAYS = 30
+FEEDBACK_ANALYTICS_MAX_DAYS = 366
+
+# Profile context injected into chat prompts
+USER_CONTEXT_CACHE = 'user_context'
+USER_CONTEXT_CACHE_TIMEOUT = 900
+USER_CONTEXT_MAX_CHARS = int(os.getenv('USER_CONTEXT_MAX_CHARS', 2000))
+# Most recently seen profile facts read when building the context
+USER_CONTEXT_MAX_FACTS = int(os.getenv('USER_CONTEXT_MAX_FACTS', 200))
+
+# Background profile extraction ('db' or 'redis')
+PROFILE_JOBS = {
+    'BACKEND': os.getenv('PROFILE_JOBS_BACKEND', 'db'),
+    'REDIS_URL': os.getenv('PROFILE_JOBS_REDIS_URL', 'redis://localhost:6379/0'),
+    'WORKERS': int(os.getenv('PROFILE_JOBS_WORKERS', 2)),
+    'BATCH_SIZE': 20,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_SECONDS': 2.0,
+    'MAX_BACKOFF_SECONDS': 300.0,
+    'LEASE_SECONDS': 300,
+    # Turns wait until the user has been quiet this long (or MAX_WAIT_SECONDS have passed, or the
+    # conversation ends) and are then extracted in one call; 0 extracts as soon as a worker is free
+    'IDLE_SECONDS': int(os.getenv('PROFILE_JOBS_IDLE_SECONDS', 120)),
+    'MAX_WAIT_SECONDS': 900,
+    # Local keyword/length check that skips turns unlikely to hold goals, challenges or life events
+    'GATE': {
+        'ENABLED': os.getenv('PROFILE_JOBS_GATE', 'true').lower() in ('1', 'true', 'yes'),
+        'LONG_MESSAGE_CHARS': 200,
+    },
+}
+
+# Request/stream metrics (Prometheus text at /metrics) and structured logs. SAMPLE_RATE is the
+# fraction of requests that also get SQL spans and a log line; slow requests are always logged.
+# Scrapers authenticate with METRICS_TOKEN; while it is unset, /metrics is for staff users only.
+INSTRUMENTATION = {
+    'ENABLED': os.getenv('INSTRUMENTATION_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'SAMPLE_RATE': float(os.getenv('INSTRUMENTATION_SAMPLE_RATE', 0.1)),
+    'SLOW_REQUEST_SECONDS': float(os.getenv('INSTRUMENTATION_SLOW_REQUEST_SECONDS', 1.0)),
+    'METRICS_TOKEN': os.getenv('METRICS_TOKEN', ''),
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'chat.instrumentation.JsonFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': os.getenv('LOG_FORMAT', 'json')},
+    },
+    'loggers': {
+        'chat': {'handlers': ['console'], 'level': os.getenv('CHAT_LOG_LEVEL', 'INFO'), 'propagate': False},
+    },
+}
@@ -28,7 +28,6 @@ const convertBackendMessage = (message: any): Message => {
 
 interface Conversation {
   id: string;
-  messages: Message[];
   title: string;
   lastMessage: string;
   timestamp: Date;
@@ -39,14 +38,13 @@ interface ConversationResponse {
   title: string;
   lastMessage: string;
   timestamp: string;
-  messages: Array<{
-    content?: string;
-    text?: string;
-    user_email?: string;
-    timestamp: string;
-  }>;
 }
 
+const API_URL = 'http://localhost:8000/api/chat';
+
+// The list and message endpoints page by cursor; the next one comes back in X-Next-Cursor
+const nextCursor = (headers: any): string | null => headers['x-next-cursor'] || null;
+
 const ChatRoom = () => {
   const { user } = useAuth();
   const [currentConversation, setCurrentConversation] = useState<Conversation | null>(null);
@@ -58,50 +56,58 @@ const ChatRoom = () => {
   const audioChunksRef = useRef<BlobPart[]>([]);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const [conversations, setConversations] = useState<Conversation[]>([]);
+  const [conversationsCursor, setConversationsCursor] = useState<string | null>(null);
   const [activeConversationId, setActiveConversationId] = useState<string | null>(null);
+  const [earlierMessagesCursor, setEarlierMessagesCursor] = useState<string | null>(null);
   const [streamingMessage, setStreamingMessage] = useState<string>('');
   const [isStreaming, setIsStreaming] = useState(false);
   const { t } = useLanguage();
 
 
-  console.log(messages);
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
 
+  // One page of the sidebar; messages=0 because history is loaded when a conversation is opened
+  const fetchConversationPage = async (cursor: string | null = null) => {
+    const params = new URLSearchParams({ email: user?.email || '', messages: '0' });
+    if (cursor) {
+      params.set('cursor', cursor);
+    }
+    const response = await axios.get<ConversationResponse[]>(`${API_URL}/conversations/?${params}`);
+    return {
+      conversations: response.data.map((conv): Conversation => ({
+        id: conv.id,
+        title: conv.title,
+        lastMessage: conv.lastMessage,
+        timestamp: new Date(conv.timestamp)
+      })),
+      cursor: nextCursor(response.headers)
+    };
+  };
+
+  // The newest page of a conversation's history, or the one before ``cursor``, oldest message first
+  const fetchMessagePage = async (conversationId: string, cursor: string | null = null) => {
+    const params = new URLSearchParams({ email: user?.email || '' });
+    if (cursor) {
+      params.set('cursor', cursor);
+    }
+    const response = await axios.get(`${API_URL}/conversations/${conversationId}/messages/?${params}`);
+    return {
+      messages: response.data.map((msg: any) => ({ ...convertBackendMessage(msg), user_email: msg.user_email })),
+      cursor: nextCursor(response.headers)
+    };
+  };
+
   useEffect(() => {
     const fetchConversations = async () => {
       try {
-        const response = await axios.get(`http://localhost:8000/api/chat/conversations/?email=${user?.email}`);
-        
-        if (response.data.length > 0) {
-          const conversationsWithParsedDates = response.data.map((conv: any) => ({
-            ...conv,
-            timestamp: new Date(conv.timestamp),
-            messages: conv.messages.map((msg: any) => ({
-              ...msg,
-              sender: msg.user_email ? 'user' : 'bot',
-              text: msg.content || msg.text || '',
-              timestamp: new Date(msg.timestamp),
-              user_email: msg.user_email
-            }))
-          }));
-          
-          setConversations(conversationsWithParsedDates);
-          
-          // If there's an active conversation, update its messages
-          if (activeConversationId) {
-            const activeConv = conversationsWithParsedDates.find((conv: Conversation) => conv.id === activeConversationId);
-            if (activeConv) {
-              setCurrentConversation(activeConv);
-              setMessages(activeConv.messages);
-            }
-          } else {
-            // Set the first conversation as active if none is selected
-            setActiveConversationId(conversationsWithParsedDates[0].id);
-            setCurrentConversation(conversationsWithParsedDates[0]);
-            setMessages(conversationsWithParsedDates[0].messages);
-          }
+        const page = await fetchConversationPage();
+        setConversations(page.conversations);
+        setConversationsCursor(page.cursor);
+        // Set the first conversation as active if none is selected
+        if (page.conversations.length > 0) {
+          setActiveConversationId(prev => prev ?? page.conversations[0].id);
         }
       } catch (error) {
         console.error('Error fetching conversations:', error);
@@ -113,30 +119,64 @@ const ChatRoom = () => {
     }
   }, [user]);
 
+  const loadMoreConversations = async () => {
+    if (!conversationsCursor) return;
+    try {
+      const page = await fetchConversationPage(conversationsCursor);
+      setConversations(prev => {
+        const loaded = new Set(prev.map(conv => conv.id));
+        return [...prev, ...page.conversations.filter(conv => !loaded.has(conv.id))];
+      });
+      setConversationsCursor(page.cursor);
+    } catch (error) {
+      console.error('Error fetching conversations:', error);
+    }
+  };
+
   useEffect(() => {
+    setCurrentConversation(conversations.find(conv => conv.id === activeConversationId) || null);
+  }, [activeConversationId, conversations]);
+
+  useEffect(() => {
+    if (!activeConversationId || !user?.email) return;
+    let cancelled = false;
+
     const fetchConversationMessages = async () => {
-      if (!activeConversationId) return;
-      
       try {
-        const selectedConversation = conversations.find(conv => conv.id === activeConversationId);
-        if (selectedConversation) {
-          setCurrentConversation(selectedConversation);
-          // Ensure messages exist and convert them
-          const messages = selectedConversation.messages || [];
-          const convertedMessages = messages.map(msg => convertBackendMessage(msg));
-          setMessages(convertedMessages);
+        const page = await fetchMessagePage(activeConversationId);
+        if (!cancelled) {
+          setMessages(page.messages);
+          setEarlierMessagesCursor(page.cursor);
         }
       } catch (error) {
         console.error('Error fetching conversation messages:', error);
       }
     };
 
+    setMessages([]);
+    setEarlierMessagesCursor(null);
     fetchConversationMessages();
-  }, [activeConversationId, conversations]);
+    return () => {
+      cancelled = true;
+    };
+  }, [activeConversationId, user]);
+
+  const loadEarlierMessages = async () => {
+    if (!activeConversationId || !earlierMessagesCursor) return;
+    try {
+      const page = await fetchMessagePage(activeConversationId, earlierMessagesCursor);
+      setMessages(prev => [...page.messages, ...prev]);
+      setEarlierMessagesCursor(page.cursor);
+    } catch (error) {
+      console.error('Error fetching conversation messages:', error);
+    }
+  };
 
+  // Only follow new messages at the bottom; loading earlier ones keeps the scroll position
+  const newestMessage = messages[messages.length - 1];
   useEffect(() => {
     scrollToBottom();
-  }, [messages]);
+  }, [newestMessage]);
 
   const formatTime = (date: Date) => {
     return new Date(date).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
@@ -159,6 +199,11 @@ const ChatRoom = () => {
         
         const formData = new FormData();
         formData.append('audio', audioBlob);
+        // Lets the server reuse the language it already detected for this conversation
+        formData.append('user_email', user?.email || 'guest');
+        if (currentConversation) {
+          formData.append('conversationId', String(currentConversation.id));
+        }
 
         try {
           const response = await axios.post('http://localhost:8000/api/chat/speech-to-text/', formData);
@@ -200,8 +245,14 @@ const ChatRoom = () => {
       const response = await axios.post('http://localhost:8000/api/chat/conversation/', {
         userId: user?.email
       });
-      setConversations(prev => [response.data, ...prev]);
-      setActiveConversationId(response.data.id);
+      const conversation: Conversation = {
+        id: response.data.id,
+        title: response.data.title,
+        lastMessage: response.data.lastMessage,
+        timestamp: new Date(response.data.timestamp)
+      };
+      setConversations(prev => [conversation, ...prev]);
+      setActiveConversationId(conversation.id);
     } catch (error) {
       console.error('Error creating new conversation:', error);
     }
@@ -227,34 +278,12 @@ const ChatRoom = () => {
 
   const refreshConversations = async () => {
     try {
-      const response = await axios.get<ConversationResponse[]>(
-        `http://localhost:8000/api/chat/conversations/?email=${user?.email}`
-      );
-      
-      if (response.data.length > 0) {
-        const conversationsWithParsedDates: Conversation[] = response.data.map((conv: ConversationResponse) => ({
-          ...conv,
-          timestamp: new Date(conv.timestamp),
-          messages: conv.messages.map((msg): Message => ({
-            ...msg,
-            sender: msg.user_email ? ('user' as const) : ('bot' as const),
-            text: msg.content || msg.text || '',
-            timestamp: new Date(msg.timestamp),
-            user_email: msg.user_email
-          }))
-        }));
-        
-        setConversations(conversationsWithParsedDates);
-        
-        // Update current conversation if it's active
-        if (activeConversationId) {
-          const activeConv = conversationsWithParsedDates.find((conv: Conversation) => conv.id === activeConversationId);
-          if (activeConv) {
-            setCurrentConversation(activeConv);
-            setMessages(activeConv.messages);
-          }
-        }
-      }
+      // Only the first page can have changed order; pages loaded further down stay where they are
+      const page = await fetchConversationPage();
+      setConversations(prev => {
+        const fresh = new Set(page.conversations.map(conv => conv.id));
+        return [...page.conversations, ...prev.filter(conv => !fresh.has(conv.id))];
+      });
     } catch (error) {
       console.error('Error refreshing conversations:', error);
     }
@@ -373,6 +402,8 @@ const ChatRoom = () => {
                 activeConversationId={activeConversationId}
                 onConversationSelect={setActiveConversationId}
                 onNewConversation={handleNewConversation}
+                hasMore={conversationsCursor !== null}
+                onLoadMore={loadMoreConversations}
               />
             </Paper>
           </Grid.Col>
@@ -398,6 +429,11 @@ const ChatRoom = () => {
               <>
                 <ScrollArea style={{ height: 'calc(100vh - 250px)', marginBottom: '1rem' }}>
                   <Stack gap="md" p="md">
+                    {earlierMessagesCursor && (
+                      <Button variant="subtle" onClick={loadEarlierMessages}>
+                        {t('chat.loadEarlierMessages')}
+                      </Button>
+                    )}
                     {messages.map((message, index) => (
                       <Flex
                         key={index}
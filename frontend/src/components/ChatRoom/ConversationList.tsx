@@ -13,6 +13,8 @@ interface ConversationListProps {
   activeConversationId: string | null;
   onConversationSelect: (id: string) => void;
   onNewConversation: () => void;
+  hasMore: boolean;
+  onLoadMore: () => void;
 }
 
 export const ConversationList = ({
@@ -20,6 +22,8 @@ export const ConversationList = ({
   activeConversationId,
   onConversationSelect,
   onNewConversation,
+  hasMore,
+  onLoadMore,
 }: ConversationListProps) => {
   const { user } = useAuth();
   const { t } = useLanguage();
@@ -66,6 +70,11 @@ export const ConversationList = ({
               </UnstyledButton>
             ))
           )}
+          {hasMore && (
+            <Button variant="subtle" onClick={onLoadMore} fullWidth>
+              {t('chat.loadMoreConversations')}
+            </Button>
+          )}
         </Stack>
       </ScrollArea>
     </Stack>
@@ -24,7 +24,9 @@ export const translations = {
       errorMessage: 'Failed to send message',
       retryButton: 'Retry',
       deleteConversation: 'Delete conversation',
-      conversationDeleted: 'Conversation deleted successfully'
+      conversationDeleted: 'Conversation deleted successfully',
+      loadMoreConversations: 'Load more conversations',
+      loadEarlierMessages: 'Load earlier messages'
     },
     resources: {
       title: 'Mental Health Resources',
@@ -146,7 +148,9 @@ export const translations = {
       errorMessage: 'Échec de l\'envoi du message',
       retryButton: 'Réessayer',
       deleteConversation: 'Supprimer la conversation',
-      conversationDeleted: 'Conversation supprimée avec succès'
+      conversationDeleted: 'Conversation supprimée avec succès',
+      loadMoreConversations: 'Afficher plus de conversations',
+      loadEarlierMessages: 'Afficher les messages précédents'
     },
     resources: {
       title: 'Ressources en santé mentale',